@@ -1,9 +1,9 @@
 from django.contrib import admin
-from .models import Book, Character, Conversation, Message
+from .models import Book, Character, Conversation, Message, IngestJob
 
 @admin.register(Book)
 class BookAdmin(admin.ModelAdmin):
-    list_display = ('title', 'author', 'publication_year', 'is_processed', 'created_at')
+    list_display = ('title', 'author', 'publication_year', 'is_processed', 'ingest_status', 'created_at')
     list_filter = ('is_processed', 'author')
     search_fields = ('title', 'author')
     readonly_fields = ('is_processed', 'vector_store_path', 'created_at')
@@ -23,32 +23,33 @@ class BookAdmin(admin.ModelAdmin):
     )
     
     def process_books_for_rag(self, request, queryset):
-        """Admin action to process selected books for RAG"""
-        from .rag_processor import process_book_for_rag
-        
-        success_count = 0
-        errors = []
+        """Admin action to queue selected books for RAG processing"""
+        from .ingest_queue import enqueue_book
         
+        queued_count = 0
         for book in queryset:
-            try:
-                if process_book_for_rag(book):
-                    success_count += 1
-                else:
-                    errors.append(f"{book.title}: Processing failed")
-            except Exception as e:
-                errors.append(f"{book.title}: {str(e)}")
-        
-        if success_count > 0:
-            self.message_user(
-                request, 
-                f"Successfully processed {success_count} of {queryset.count()} books."
-            )
+            job, created = enqueue_book(book)
+            if created:
+                queued_count += 1
         
-        if errors:
-            for error in errors:
-                self.message_user(request, f"ERROR: {error}", level='ERROR')
+        self.message_user(
+            request,
+            f"Queued {queued_count} of {queryset.count()} books for processing. "
+            "Run `python manage.py run_ingest_worker` to process them."
+        )
     
     process_books_for_rag.short_description = "Process selected books for RAG"
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('ingest_jobs')
+    
+    def ingest_status(self, obj):
+        jobs = obj.ingest_jobs.all()  # Prefetched, newest first
+        if not jobs:
+            return "-"
+        job = jobs[0]
+        return f"{job.get_status_display()} ({job.progress()})"
+    ingest_status.short_description = 'Ingestion'
 
 @admin.register(Character)
 class CharacterAdmin(admin.ModelAdmin):
@@ -58,7 +59,7 @@ class CharacterAdmin(admin.ModelAdmin):
     
     fieldsets = (
         ('Character Information', {
-            'fields': ('book', 'name', 'description', 'personality_traits')
+            'fields': ('book', 'name', 'aliases', 'description', 'personality_traits')
         }),
         ('Voice Settings', {
             'fields': ('voice',),  # Changed from voice_name
@@ -68,6 +69,12 @@ class CharacterAdmin(admin.ModelAdmin):
             'fields': ('avatar',)
         }),
     )
+    
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Refresh which passages mention the character, without re-embedding the book
+        from .character_index import update_character_index
+        update_character_index(obj.book)
 
 
 @admin.register(Conversation)
@@ -84,4 +91,24 @@ class MessageAdmin(admin.ModelAdmin):
     
     def content_preview(self, obj):
         return obj.content[:100] + "..." if len(obj.content) > 100 else obj.content
-    content_preview.short_description = 'Content'
\ No newline at end of file
+    content_preview.short_description = 'Content'
+
+@admin.register(IngestJob)
+class IngestJobAdmin(admin.ModelAdmin):
+    list_display = ('book', 'status', 'progress', 'attempts', 'max_attempts', 'updated_at')
+    list_filter = ('status',)
+    readonly_fields = ('book', 'chunks_done', 'chunks_total', 'attempts', 'error', 'created_at', 'updated_at')
+    actions = ['retry_jobs']
+    
+    def retry_jobs(self, request, queryset):
+        """Admin action to put failed jobs back on the queue"""
+        from django.utils import timezone
+        
+        count = queryset.filter(status=IngestJob.STATUS_FAILED).update(
+            status=IngestJob.STATUS_QUEUED,
+            attempts=0,
+            run_after=timezone.now()
+        )
+        self.message_user(request, f"Requeued {count} failed jobs.")
+    
+    retry_jobs.short_description = "Retry selected failed jobs"
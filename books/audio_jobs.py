@@ -0,0 +1,149 @@
+"""
+Background TTS jobs.
+
+A chat turn returns its text as soon as the reply exists and hands the
+speech synthesis to a job on a thread pool; the browser fetches the audio
+through ``/audio-job/<id>/`` (long-polling) when it is ready, so a slow or
+failing TTS call never holds up the text. Jobs for the same clips (same
+text, voice and settings) that are still running are shared, so one
+synthesis serves every simultaneous request.
+
+Jobs live in the memory of the process that created them, like the other
+runtime caches: behind several worker processes, route a session's polls
+to the same one (or poll through the streaming endpoint).
+"""
+import asyncio
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .tracing import stage
+from .tts_generator import _tts_executor, audio_cache, generate_speech_audio, speech_request, split_sentences
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.TTS_MAX_WORKERS,
+    thread_name_prefix='tts-job'
+)
+
+
+class AudioJob:
+    """Speech for one reply, synthesized in the background."""
+
+    def __init__(self, texts, character):
+        self.id = uuid.uuid4().hex
+        self.texts = texts
+        self.character = character
+        self.finished_at = None
+        self.future = None
+
+    @property
+    def status(self):
+        """'pending', 'done', 'failed' (no audio) or 'error' (the job raised)."""
+        if not self.future.done():
+            return 'pending'
+        if self.future.exception() is not None:
+            return 'error'
+        return 'done' if self.future.result()[1] else 'failed'
+
+    def result(self):
+        """(audio_url, audio_playlist) once done, else (None, [])."""
+        if not self.future.done() or self.future.exception() is not None:
+            return None, []
+        return self.future.result()
+
+    def as_dict(self):
+        audio_url, audio_playlist = self.result()
+        return {
+            'audio_job': self.id,
+            'status': self.status,
+            'audio_url': audio_url,
+            'audio_playlist': audio_playlist,
+        }
+
+    def run(self):
+        with stage('tts'):
+            if len(self.texts) == 1:
+                audio_url = generate_speech_audio(self.texts[0], self.character)
+                return audio_url, [audio_url] if audio_url else []
+            # Sentence segments are synthesized concurrently on the TTS pool
+            futures = [
+                _tts_executor.submit(generate_speech_audio, text, self.character)
+                for text in self.texts
+            ]
+            return None, [url for url in (future.result() for future in futures) if url]
+
+
+class AudioJobs:
+    """Registry of background TTS jobs, merging identical ones in flight."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._jobs = {}  # id -> AudioJob
+        self._running = {}  # clip filenames -> AudioJob still synthesizing
+        self._lock = threading.Lock()
+
+    def start(self, text, character, on_done=None):
+        """
+        Start (or join) the synthesis of a reply.
+
+        Args:
+            text: The reply
+            character: Character whose voice speaks it
+            on_done: Optional callback(audio_url, audio_playlist), run once
+                when a new job finishes
+
+        Returns:
+            AudioJob
+        """
+        texts = split_sentences(text) if settings.TTS_SENTENCE_CHUNKING else [text]
+        key = tuple(speech_request(text, character).filename for text in texts)
+        with self._lock:
+            self._expire()
+            job = self._running.get(key)
+            if job is not None:
+                return job
+            job = AudioJob(texts, character)
+            self._jobs[job.id] = job
+            self._running[key] = job
+            job.future = _executor.submit(job.run)
+
+        def finished(future):
+            with self._lock:
+                self._running.pop(key, None)
+                job.finished_at = time.monotonic()
+            if on_done is not None and not future.exception():
+                on_done(*future.result())
+
+        job.future.add_done_callback(finished)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    async def await_job(self, job, timeout):
+        """Wait up to timeout seconds for a job to finish (without cancelling it)."""
+        if timeout > 0 and not job.future.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), timeout)
+            except Exception:
+                # Timed out or failed; the job's status tells which
+                pass
+        return job
+
+    def cached(self, text, character):
+        """(audio_url, audio_playlist) when every clip of a reply is already cached, else None."""
+        texts = split_sentences(text) if settings.TTS_SENTENCE_CHUNKING else [text]
+        urls = [audio_cache.get(speech_request(text, character).filename) for text in texts]
+        if not urls or not all(urls):
+            return None
+        return (urls[0] if len(urls) == 1 else None), urls
+
+
+audio_jobs = AudioJobs(settings.AUDIO_JOB_TTL)
@@ -0,0 +1,116 @@
+"""
+HTTP delivery of cached TTS clips.
+
+Clips are immutable once written, so they are served with a strong ETag
+(sha256 of the file), a long-lived ``Cache-Control`` and ``Range`` support
+for seeking and mobile players. Whole files go out through FileResponse,
+which the server can send with sendfile; with AUDIO_X_ACCEL_REDIRECT set,
+nginx serves the file itself from an internal location.
+"""
+import hashlib
+import os
+import re
+from functools import lru_cache
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.http import parse_etags, quote_etag
+
+CONTENT_TYPES = {
+    'mp3': 'audio/mpeg',
+    'ogg': 'audio/ogg',
+}
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+@lru_cache(maxsize=4096)
+def _digest(path, version):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_etag(path, stat):
+    """Strong ETag from the file content, hashed once per version of the file."""
+    return quote_etag(_digest(str(path), (stat.st_mtime_ns, stat.st_size)))
+
+
+def parse_range(header, size):
+    """
+    Parse a single ``bytes=`` range.
+
+    Returns:
+        tuple: (start, end) inclusive, None for a missing, invalid or
+        multi-part header (serve the whole file), or False if it can't be
+        satisfied
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None  # Invalid, so ignored (RFC 9110 14.1.1)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        if int(last) == 0:
+            return False
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def etag_matches(header, etag):
+    """Whether an ``If-None-Match`` header matches an ETag, by weak comparison."""
+    tags = parse_etags(header) if header else []
+    if tags == ['*']:
+        return True
+    return etag.removeprefix('W/') in [tag.removeprefix('W/') for tag in tags]
+
+
+def _cache_headers(response, etag, content_type):
+    response['ETag'] = etag
+    response['Cache-Control'] = f"public, max-age={settings.AUDIO_CACHE_MAX_AGE}, immutable"
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Type'] = content_type
+    return response
+
+
+def audio_response(request, path):
+    """Serve an audio file honouring If-None-Match, Range and If-Range."""
+    stat = os.stat(path)
+    etag = file_etag(path, stat)
+    content_type = CONTENT_TYPES.get(path.suffix.lstrip('.'), 'application/octet-stream')
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return _cache_headers(HttpResponse(status=304), etag, content_type)
+
+    if settings.AUDIO_X_ACCEL_REDIRECT:
+        # nginx handles ranges and the transfer from an internal location
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = settings.AUDIO_X_ACCEL_REDIRECT.rstrip('/') + '/' + path.name
+        return _cache_headers(response, etag, content_type)
+
+    byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+    if_range = request.headers.get('If-Range')
+    if byte_range and if_range and if_range != etag:
+        byte_range = None  # The client's partial copy is stale
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{stat.st_size}"
+        return _cache_headers(response, etag, content_type)
+    if byte_range:
+        start, end = byte_range
+        with open(path, 'rb') as f:
+            f.seek(start)
+            response = HttpResponse(f.read(end - start + 1), status=206)
+        response['Content-Range'] = f"bytes {start}-{end}/{stat.st_size}"
+        return _cache_headers(response, etag, content_type)
+
+    return _cache_headers(FileResponse(open(path, 'rb')), etag, content_type)
@@ -0,0 +1,259 @@
+"""
+Offline stand-ins and helpers for benchmarking the RAG path.
+
+The fakes are deterministic and never touch the network, so benchmark
+numbers reflect our own code (store loading, search, prompt building)
+and can be compared across commits.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import subprocess
+import time
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+from django.conf import settings
+from .character_index import save_character_index
+from .compact_store import write_compact_from_faiss
+from .lexical_index import BM25Index, STOPWORDS
+from .rag_processor import chunk_ids, read_chunks
+
+DEFAULT_QUESTIONS = [
+    "Who are you?",
+    "Tell me about your family.",
+    "What are your deepest fears?",
+    "What drives your decisions?",
+    "What is your greatest regret?",
+    "How do you feel about love and marriage?",
+    "Describe the place where you live.",
+    "What do you think of the people around you?",
+    "What happened on the night everything changed?",
+    "What would you do differently if you could?",
+]
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings using the hashing trick."""
+
+    model = "bench/hashing"
+
+    def __init__(self, size=256):
+        self.size = size
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(token.encode()).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.size
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeChatModel:
+    """Echoes a canned reply after a fixed simulated latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def _reply(self, prompt):
+        return FakeResponse(f"I must say, that is a question I have often asked myself. ({len(prompt)} chars of context)")
+
+    def invoke(self, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._reply(prompt)
+
+    async def ainvoke(self, prompt):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._reply(prompt)
+
+    async def astream(self, prompt):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for piece in re.findall(r"\S+\s*", self._reply(prompt).content):
+            yield FakeResponse(piece)
+
+
+class FakeSpeechSynthesizer:
+    """Returns fake audio bytes sized like a real MP3 after a simulated latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def synthesize(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return b"\0" * (len(text) * 100)
+
+
+def git_commit():
+    """Short hash of the checked-out commit, so results can be compared across commits."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples):
+    """p50/p95/p99/mean (in milliseconds) of a list of durations in seconds."""
+    values = sorted(sample * 1000 for sample in samples)
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values), 3) if values else None,
+        'p50_ms': round(percentile(values, 0.50), 3) if values else None,
+        'p95_ms': round(percentile(values, 0.95), 3) if values else None,
+        'p99_ms': round(percentile(values, 0.99), 3) if values else None,
+    }
+
+
+def build_bench_store(book, embeddings, path):
+    """
+    Build a throwaway store for a book the way ingestion does (same chunks,
+    configured format, BM25 and character indexes alongside), embedded with
+    ``embeddings``.
+
+    Returns:
+        list: The book's chunk texts, in book order
+    """
+    chunks = list(read_chunks(book))
+    texts = [chunk.text for chunk in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    ids = chunk_ids(texts)
+    vector_store = FAISS.from_embeddings(
+        list(zip(texts, embeddings.embed_documents(texts))),
+        embeddings,
+        metadatas=metadatas,
+        ids=ids
+    )
+    if settings.VECTOR_STORE_FORMAT == 'compact':
+        write_compact_from_faiss(path, vector_store)
+    else:
+        vector_store.save_local(str(path))
+    BM25Index.build(texts, metadatas, ids).save(path)
+    save_character_index(path, book.characters.all(), texts)
+    return texts
+
+
+_SENTENCE = re.compile(r'[^.!?]*[.!?]')
+
+
+def make_retrieval_queries(chunks, count, seed=0):
+    """
+    Generate keyword-style questions with known answers from a book's chunks.
+
+    A sentence is sampled from a random chunk and a random half of its
+    content words become the question; every chunk containing the whole
+    sentence counts as relevant.
+
+    Returns:
+        list: dicts with ``question`` and ``relevant`` (set of chunk texts)
+    """
+    rng = random.Random(seed)
+    queries = []
+    attempts = 0
+    while len(queries) < count and attempts < count * 20:
+        attempts += 1
+        sentences = [
+            ' '.join(sentence.split()) for sentence in _SENTENCE.findall(rng.choice(chunks))
+            if 8 <= len(sentence.split()) <= 40
+        ]
+        if not sentences:
+            continue
+        sentence = rng.choice(sentences)
+        words = [word.strip(',;:"\'') for word in sentence.rstrip('.!?').split()]
+        words = [word for word in words if word and word.lower() not in STOPWORDS]
+        if len(words) < 4:
+            continue
+        kept = sorted(rng.sample(range(len(words)), max(3, len(words) // 2)))
+        relevant = {chunk for chunk in chunks if sentence in ' '.join(chunk.split())}
+        if relevant:
+            queries.append({
+                'question': "Tell me about " + ' '.join(words[i] for i in kept),
+                'sentence': sentence,
+                'relevant': relevant,
+            })
+    return queries
+
+
+PARAPHRASE_PROMPT = """Here is a sentence from a novel:
+
+{sentence}
+
+Write one question a reader might ask whose answer is this sentence. Use your own words: do not
+reuse its names or distinctive words where a synonym or description would do. Reply with the
+question only."""
+
+
+def paraphrase_queries(queries, chat_model):
+    """
+    Natural-language versions of generated queries, reworded by the chat model.
+
+    Keyword queries share their words with the answer, which flatters BM25;
+    paraphrases test whether a search finds the passage by meaning.
+
+    Returns:
+        list: dicts with ``question`` and ``relevant``, like the input
+    """
+    paraphrased = []
+    for query in queries:
+        try:
+            question = chat_model.invoke(PARAPHRASE_PROMPT.format(sentence=query['sentence'])).content.strip()
+        except Exception as e:
+            print(f"❌ Could not paraphrase a question: {str(e)}")
+            continue
+        if question:
+            paraphrased.append({'question': question, 'sentence': query['sentence'], 'relevant': query['relevant']})
+    return paraphrased
+
+
+def load_retrieval_queries(path, chunks):
+    """
+    Hand-written questions from a JSON Lines file.
+
+    Each line is ``{"question": ..., "passage": ...}``; every chunk that
+    contains the passage text (whitespace-normalized) counts as relevant.
+
+    Returns:
+        list: dicts with ``question`` and ``relevant``; lines whose passage
+        isn't in the book are skipped
+    """
+    normalized = {chunk: ' '.join(chunk.split()) for chunk in chunks}
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            passage = ' '.join(item['passage'].split())
+            relevant = {chunk for chunk, text in normalized.items() if passage in text}
+            if relevant:
+                queries.append({'question': item['question'], 'sentence': passage, 'relevant': relevant})
+    return queries
@@ -0,0 +1,130 @@
+"""
+Per-character passage index.
+
+For every Character of a book, the positions of the chunks that mention
+the character (by name or alias) are saved as ``characters.json`` next to
+the book's vector store. Retrieval for that character then boosts, or with
+CHARACTER_SCOPE='restrict' keeps only, those passages. The index is built
+from the chunk texts held by the BM25 index, so it can be refreshed when a
+character is added or renamed without re-reading or re-embedding the book.
+"""
+import hashlib
+import json
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+from .lexical_index import load_lexical_index
+
+INDEX_FILE = "characters.json"
+
+# Words that don't identify a character on their own
+_TITLES = {'mr', 'mrs', 'miss', 'ms', 'dr', 'sir', 'lady', 'lord', 'the', 'old', 'young', 'captain', 'colonel'}
+
+
+class CharacterScope(NamedTuple):
+    keys: frozenset  # text_key of each passage mentioning the character
+    positions: frozenset  # The same passages' chunk positions in the book
+
+
+def text_key(text):
+    """
+    Content hash identifying a passage across store formats.
+
+    Also the chunk id of a passage's first occurrence in a book (see
+    ``rag_processor.chunk_ids``).
+    """
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def character_terms(character):
+    """
+    Names a character goes by in the text.
+
+    Without aliases, each significant word of the name counts ("Mr. Darcy"
+    matches "Darcy"); with aliases set, only the full name and the aliases
+    are matched, so shared surnames can be left out.
+    """
+    name = ' '.join(character.name.split())
+    terms = {name}
+    aliases = [alias.strip() for alias in character.aliases.split(',') if alias.strip()]
+    if aliases:
+        terms.update(aliases)
+    else:
+        words = [word.strip('.,') for word in name.split()]
+        terms.update(word for word in words if len(word) > 2 and word.lower() not in _TITLES)
+    return sorted(terms)
+
+
+def build_character_index(characters, texts):
+    """
+    Find the chunks mentioning each character.
+
+    Args:
+        characters: Character instances of one book
+        texts: The book's chunk texts, in book order
+
+    Returns:
+        dict: Serializable index (terms and chunk positions per character id)
+    """
+    index = {'terms': {}, 'chunks': {}}
+    for character in characters:
+        terms = character_terms(character)
+        pattern = re.compile(r"\b(" + "|".join(re.escape(term) for term in terms) + r")\b", re.IGNORECASE)
+        index['terms'][str(character.id)] = terms
+        index['chunks'][str(character.id)] = [position for position, text in enumerate(texts) if pattern.search(text)]
+    return index
+
+
+def save_character_index(path, characters, texts):
+    """Write ``path/characters.json`` via a temp file and rename."""
+    index_path = Path(path) / INDEX_FILE
+    tmp_path = index_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(build_character_index(characters, texts)))
+    os.replace(tmp_path, index_path)
+
+
+def update_character_index(book):
+    """Rebuild the character index of a processed book from its stored chunks."""
+    lexical = load_lexical_index(book.vector_store_path)
+    if lexical is None:
+        return False
+    save_character_index(book.vector_store_path, book.characters.all(), lexical.texts)
+    return True
+
+
+@lru_cache(maxsize=128)
+def _load_scopes(path, version):
+    lexical = load_lexical_index(path)
+    if lexical is None:
+        return {}
+    index = json.loads((Path(path) / INDEX_FILE).read_text())
+    return {
+        int(character_id): (
+            tuple(index['terms'][character_id]),
+            CharacterScope(
+                frozenset(text_key(lexical.texts[position]) for position in positions),
+                frozenset(positions),
+            ),
+        )
+        for character_id, positions in index['chunks'].items()
+    }
+
+
+def character_scope(book, character):
+    """
+    The passages that mention a character.
+
+    Returns:
+        CharacterScope or None if the book has no character index, the
+        character isn't in it, or its names have changed since it was built
+    """
+    index_path = Path(book.vector_store_path) / INDEX_FILE if book.vector_store_path else None
+    if index_path is None or not index_path.exists():
+        return None
+    scopes = _load_scopes(str(book.vector_store_path), os.stat(index_path).st_mtime_ns)
+    terms, scope = scopes.get(character.id, ((), None))
+    if scope is None or list(terms) != character_terms(character):
+        return None
+    return scope
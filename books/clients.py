@@ -0,0 +1,139 @@
+"""
+Shared Google API clients.
+
+Building an embeddings, chat or TTS client sets up auth and a fresh
+connection pool, so each one is created lazily once per process and then
+reused by every request. All clients here are safe to share between
+threads: the TTS client multiplexes calls over one gRPC channel and the
+Gemini clients keep a pooled HTTP session. Async gRPC clients are bound to
+the event loop that created them, so those are kept per loop.
+"""
+import asyncio
+import threading
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from google.cloud import texttospeech
+from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+from django.conf import settings
+from .embedding_cache import CachedEmbeddings
+
+EMBEDDING_MODEL = "models/embedding-001"
+CHAT_MODEL = "gemini-2.0-flash"
+
+_clients = {}
+_loop_clients = weakref.WeakKeyDictionary()  # event loop -> {name: client}
+_lock = threading.Lock()
+_creations = Counter()
+_reuses = Counter()
+
+
+def _get_or_create(name, factory, loop=None):
+    """Return the named client, creating it with ``factory`` on first use."""
+    with _lock:
+        clients = _clients if loop is None else _loop_clients.setdefault(loop, {})
+        client = clients.get(name)
+        if client is not None:
+            _reuses[name] += 1
+            return client
+
+        client = factory()
+        clients[name] = client
+        _creations[name] += 1
+        return client
+
+
+def _create_embeddings():
+    embeddings = GoogleGenerativeAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        google_api_key=settings.GOOGLE_API_KEY
+    )
+    if not settings.EMBEDDING_CACHE_ENABLED:
+        return embeddings
+    return CachedEmbeddings(
+        embeddings,
+        EMBEDDING_MODEL,
+        settings.EMBEDDING_CACHE_PATH,
+        settings.EMBEDDING_CACHE_MAX_BYTES
+    )
+
+
+def get_embeddings():
+    """
+    Shared embeddings client used for both ingestion and queries.
+
+    Wrapped in the persistent embedding cache unless EMBEDDING_CACHE_ENABLED
+    is off.
+    """
+    return _get_or_create('embeddings', _create_embeddings)
+
+
+def embedding_cache_stats():
+    """Hit/miss and size stats of the embedding cache, if it is in use."""
+    embeddings = get_embeddings()
+    return embeddings.stats() if isinstance(embeddings, CachedEmbeddings) else None
+
+
+def get_chat_model():
+    """Shared Gemini chat model used to generate character responses."""
+    return _get_or_create('chat_model', lambda: ChatGoogleGenerativeAI(
+        model=CHAT_MODEL,
+        google_api_key=settings.GOOGLE_API_KEY
+    ))
+
+
+def get_tts_client():
+    """Shared Google Cloud Text-to-Speech client."""
+    return _get_or_create('tts', lambda: texttospeech.TextToSpeechClient(
+        client_options={"api_key": settings.GOOGLE_API_KEY}
+    ))
+
+
+def get_async_tts_client():
+    """Async Text-to-Speech client for the running event loop."""
+    return _get_or_create('tts_async', lambda: texttospeech.TextToSpeechAsyncClient(
+        client_options={"api_key": settings.GOOGLE_API_KEY}
+    ), loop=asyncio.get_running_loop())
+
+
+def client_stats():
+    """
+    Creation and reuse counters for each client.
+
+    Returns:
+        dict: {client name: {'created': int, 'reused': int}}
+    """
+    with _lock:
+        return {
+            name: {'created': _creations[name], 'reused': _reuses[name]}
+            for name in set(_creations) | set(_reuses)
+        }
+
+
+@contextmanager
+def use_clients(**clients):
+    """
+    Temporarily replace shared clients, e.g. with offline fakes in benchmarks.
+
+    Args:
+        clients: Client by name ('embeddings', 'chat_model', 'tts')
+    """
+    with _lock:
+        saved = {name: _clients.get(name) for name in clients}
+        _clients.update(clients)
+    try:
+        yield
+    finally:
+        with _lock:
+            for name, client in saved.items():
+                if client is None:
+                    _clients.pop(name, None)
+                else:
+                    _clients[name] = client
+
+
+def reset_clients():
+    """Drop all shared clients (e.g. after the API key changes)."""
+    with _lock:
+        _clients.clear()
+        _loop_clients.clear()
@@ -0,0 +1,144 @@
+"""
+Compact, memory-mapped vector store format.
+
+A regular store is a float32 FAISS index plus a pickled docstore, loaded
+fully into RAM by every worker process. The compact format instead holds:
+
+- ``index.compact.faiss``: a scalar-quantized (SQ8) index, IVF-partitioned
+  for large books, opened with FAISS's mmap IO flags
+- ``docs.jsonl``: one JSON document per line (text, id and metadata)
+- ``docs.offsets.npy``: byte offset of each line, memory-mapped
+
+Nothing is unpickled and the data files are mapped read-only, so every
+worker on the machine shares the same pages through the OS page cache.
+"""
+import json
+import math
+import mmap
+from pathlib import Path
+import faiss
+import numpy as np
+from asgiref.sync import sync_to_async
+from langchain_core.documents import Document
+from django.conf import settings
+
+INDEX_FILE = "index.compact.faiss"
+DOCS_FILE = "docs.jsonl"
+OFFSETS_FILE = "docs.offsets.npy"
+FORMAT_FILE = "format.json"
+
+# Zero-copy mapping where this FAISS build supports it
+_MMAP_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+
+
+def is_compact_store(path):
+    return (Path(path) / FORMAT_FILE).exists()
+
+
+def _index_factory(count):
+    if settings.COMPACT_INDEX_FACTORY:
+        return settings.COMPACT_INDEX_FACTORY
+    if count < settings.COMPACT_IVF_MIN_VECTORS:
+        return "SQ8"
+    # Rule of thumb: about 4 * sqrt(n) inverted lists
+    return f"IVF{int(4 * math.sqrt(count))},SQ8"
+
+
+def write_compact_store(path, documents, vectors):
+    """
+    Write documents and their embeddings in the compact format.
+
+    Args:
+        path: Directory to write to (created if missing)
+        documents: List of LangChain Documents, in index order
+        vectors: float32 array of shape (len(documents), dim)
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+    factory = _index_factory(len(vectors))
+    index = faiss.index_factory(vectors.shape[1], factory)
+    index.train(vectors)
+    index.add(vectors)
+    faiss.write_index(index, str(path / INDEX_FILE))
+
+    offsets = [0]
+    with open(path / DOCS_FILE, 'wb') as f:
+        for doc in documents:
+            line = json.dumps({'id': doc.id, 'text': doc.page_content, 'metadata': doc.metadata}).encode() + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.save(path / OFFSETS_FILE, np.asarray(offsets, dtype=np.uint64))
+
+    (path / FORMAT_FILE).write_text(json.dumps({
+        'format': 'compact',
+        'index': factory,
+        'dim': int(vectors.shape[1]),
+        'count': len(documents),
+    }))
+
+
+def write_compact_from_faiss(path, vector_store):
+    """Convert a LangChain FAISS store (flat index) to the compact format."""
+    count = vector_store.index.ntotal
+    vectors = vector_store.index.reconstruct_n(0, count)
+    documents = []
+    for position in range(count):
+        doc_id = vector_store.index_to_docstore_id[position]
+        doc = vector_store.docstore.search(doc_id)
+        documents.append(Document(page_content=doc.page_content, metadata=doc.metadata, id=doc_id))
+    write_compact_store(path, documents, vectors)
+
+
+class CompactVectorStore:
+    """
+    Read-only store over the compact format.
+
+    Implements the similarity search methods the query path uses from
+    LangChain's FAISS store.
+    """
+
+    def __init__(self, path, embeddings):
+        self.path = Path(path)
+        self.embedding_function = embeddings
+        self.index = faiss.read_index(str(self.path / INDEX_FILE), _MMAP_FLAG | faiss.IO_FLAG_READ_ONLY)
+        if isinstance(self.index, faiss.IndexIVF):
+            self.index.nprobe = settings.COMPACT_IVF_NPROBE
+        self.offsets = np.load(self.path / OFFSETS_FILE, mmap_mode='r')
+        with open(self.path / DOCS_FILE, 'rb') as f:
+            self._docs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def load_local(cls, path, embeddings):
+        return cls(path, embeddings)
+
+    def get_document(self, position):
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        record = json.loads(self._docs[start:end])
+        return Document(page_content=record['text'], metadata=record['metadata'], id=record['id'])
+
+    def __len__(self):
+        return self.index.ntotal
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        query = np.asarray([embedding], dtype=np.float32)
+        scores, positions = self.index.search(query, k)
+        return [
+            (self.get_document(int(position)), float(score))
+            for position, score in zip(positions[0], scores[0])
+            if position != -1
+        ]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k, **kwargs)
+
+    async def asimilarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return await sync_to_async(self.similarity_search_by_vector, thread_sensitive=False)(embedding, k, **kwargs)
+
+    async def asimilarity_search(self, query, k=4, **kwargs):
+        embedding = await self.embedding_function.aembed_query(query)
+        return await self.asimilarity_search_by_vector(embedding, k, **kwargs)
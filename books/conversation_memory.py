@@ -0,0 +1,130 @@
+"""
+Conversation history for prompts, under a fixed token budget.
+
+The most recent messages since the conversation's rolling summary are
+loaded in one query and packed newest first until HISTORY_TOKEN_BUDGET is
+spent. Once enough turns have fallen out of the budget they are folded
+into ``Conversation.summary`` by one LLM call, so the prompt (and its
+latency) stays bounded however long a conversation runs.
+"""
+from django.conf import settings
+from .clients import get_chat_model
+from .tracing import stage
+from .turn_store import pending_messages
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English)."""
+    return len(text) // 4 + 1
+
+
+def _speaker(message, character):
+    return character.name if message.role == 'character' else "User"
+
+
+async def aload_recent_messages(conversation, before_id=None):
+    """
+    Fetch the newest messages not yet folded into the summary, in one query
+    (plus any still queued in the write-behind buffer).
+
+    Args:
+        conversation: Conversation model instance
+        before_id: Only messages older than this one (e.g. the message
+            being answered)
+
+    Returns:
+        list: Message instances, oldest first
+    """
+    messages = conversation.messages.filter(id__gt=conversation.summary_through)
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    messages = messages.order_by('-id')[:settings.HISTORY_MAX_MESSAGES]
+    with stage('db_read'):
+        recent = [message async for message in messages]
+    if before_id is None:
+        recent = pending_messages(conversation.id)[::-1] + recent
+    return recent[:settings.HISTORY_MAX_MESSAGES][::-1]
+
+
+def pack_history(messages, budget):
+    """
+    Keep the newest messages that fit in the token budget.
+
+    Returns:
+        tuple: (kept messages, older messages that did not fit), both oldest first
+    """
+    kept = []
+    used = 0
+    for index in range(len(messages) - 1, -1, -1):
+        cost = estimate_tokens(messages[index].content)
+        if used + cost > budget:
+            return messages[index + 1:], messages[:index + 1]
+        kept.append(messages[index])
+        used += cost
+    return messages, []
+
+
+def format_history(summary, messages, character):
+    """Render the summary and recent turns for the prompt."""
+    lines = []
+    if summary:
+        lines.append(f"(Earlier in this conversation: {summary})")
+    lines.extend(f"{_speaker(message, character)}: {message.content}" for message in messages)
+    return "\n".join(lines)
+
+
+async def abuild_history(conversation, before_id=None):
+    """
+    Build the prompt history for the next reply.
+
+    Returns:
+        tuple: (formatted history, messages that fell out of the budget)
+    """
+    if settings.HISTORY_TOKEN_BUDGET <= 0:
+        return '', []
+    recent = await aload_recent_messages(conversation, before_id)
+    kept, overflow = pack_history(recent, settings.HISTORY_TOKEN_BUDGET)
+    return format_history(conversation.summary, kept, conversation.character), overflow
+
+
+SUMMARY_PROMPT = """Summarize this conversation between a user and {name} from "{title}" so {name} can remember it.
+Keep names, facts the user shared, questions asked and anything {name} promised. Write at most {words} words.
+
+{existing}Conversation:
+{turns}
+
+Summary:"""
+
+
+async def aupdate_summary(conversation, overflow):
+    """
+    Fold messages that no longer fit the history budget into the summary.
+
+    Nothing happens until at least HISTORY_SUMMARY_BATCH messages have
+    fallen out, so the summarizer runs once every few turns rather than on
+    every message.
+    """
+    if not settings.HISTORY_SUMMARY_ENABLED or len(overflow) < settings.HISTORY_SUMMARY_BATCH:
+        return
+    if overflow[-1].id is None:
+        return  # Still in the write-behind buffer; summarize once it has an id
+    character = conversation.character
+    existing = f"Summary so far: {conversation.summary}\n\n" if conversation.summary else ""
+    prompt = SUMMARY_PROMPT.format(
+        name=character.name,
+        title=character.book.title,
+        words=settings.HISTORY_SUMMARY_WORDS,
+        existing=existing,
+        turns="\n".join(f"{_speaker(message, character)}: {message.content}" for message in overflow),
+    )
+    try:
+        with stage('summary'):
+            response = await get_chat_model().ainvoke(prompt)
+    except Exception as e:
+        print(f"❌ Could not summarize conversation {conversation.id}: {str(e)}")
+        return
+
+    conversation.summary = response.content.strip()
+    conversation.summary_through = overflow[-1].id
+    with stage('db_write'):
+        await conversation.asave(update_fields=['summary', 'summary_through'])
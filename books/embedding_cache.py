@@ -0,0 +1,173 @@
+"""
+Persistent, content-addressed cache of embedding vectors.
+
+Vectors are stored in a local SQLite file keyed by sha256(model name, task
+type, text), so re-processing a book with unchanged chunks, or embedding a
+question that has been asked before, never calls the embedding API twice.
+Documents and queries are embedded with different task types, so the same
+text gets a separate entry for each. The file is shared by every process
+on the machine (WAL mode) and trimmed least recently used first once it
+grows past its size budget. The async methods do their SQLite reads and
+writes on a worker thread so they never block the event loop.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from asgiref.sync import sync_to_async
+from langchain_core.embeddings import Embeddings
+
+# SQLite limits the number of bound parameters per statement
+_LOOKUP_BATCH = 500
+
+# Task types the Gemini embeddings client uses for each method
+DOCUMENT_TASK = 'RETRIEVAL_DOCUMENT'
+QUERY_TASK = 'RETRIEVAL_QUERY'
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves repeated texts from a SQLite cache."""
+
+    def __init__(self, embeddings, model_name, path, max_bytes):
+        self.embeddings = embeddings
+        self.model = model_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        # Running estimate of the file's payload; recounted exactly before evicting
+        self._total_bytes = self._count_bytes()
+
+    def _count_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def _key(self, text, task_type):
+        return hashlib.sha256(f"{self.model}\0{task_type}\0{text}".encode()).hexdigest()
+
+    def _lookup(self, keys):
+        """Return {key: vector} for the keys present, touching their access time."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), _LOOKUP_BATCH):
+                batch = unique_keys[start:start + _LOOKUP_BATCH]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if rows:
+                    self._db.execute(
+                        f"UPDATE embeddings SET last_access = ? WHERE key IN ({','.join('?' * len(rows))})",
+                        [time.time()] + [key for key, _ in rows]
+                    )
+        return found
+
+    def _store(self, items):
+        """Store (key, vector) pairs and evict if the cache is over budget."""
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._total_bytes += sum(row[2] for row in rows)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        total = self._count_bytes()
+        self._total_bytes = total
+        if total <= self.max_bytes:
+            return
+        # Trim to 90% of the budget so we don't evict again on every insert
+        excess = total - int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM embeddings ORDER BY last_access"):
+            doomed.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key in doomed])
+        self._total_bytes -= freed
+        self.evictions += len(doomed)
+
+    def _resolve(self, texts, task_type):
+        """Split texts into cached vectors and the keys/texts still to embed."""
+        keys = [self._key(text, task_type) for text in texts]
+        found = self._lookup(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        with self._lock:
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts):
+        keys, found, missing = self._resolve(texts, DOCUMENT_TASK)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new = list(zip(missing.keys(), vectors))
+            self._store(new)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        keys, found, missing = self._resolve([text], QUERY_TASK)
+        if missing:
+            vector = self.embeddings.embed_query(text)
+            self._store([(keys[0], vector)])
+            return vector
+        return found[keys[0]]
+
+    async def aembed_documents(self, texts):
+        keys, found, missing = await sync_to_async(self._resolve, thread_sensitive=False)(texts, DOCUMENT_TASK)
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            new = list(zip(missing.keys(), vectors))
+            await sync_to_async(self._store, thread_sensitive=False)(new)
+            found.update(new)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text):
+        keys, found, missing = await sync_to_async(self._resolve, thread_sensitive=False)([text], QUERY_TASK)
+        if missing:
+            vector = await self.embeddings.aembed_query(text)
+            await sync_to_async(self._store, thread_sensitive=False)([(keys[0], vector)])
+            return vector
+        return found[keys[0]]
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings"
+            ).fetchone()
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'entries': entries,
+                'size_bytes': size,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,199 @@
+"""
+Batched, rate-limited and resumable embedding of book chunks.
+
+Chunks are pulled from an iterable in fixed-size batches and embedded
+across a thread pool, with only a few batches in flight at once, so a
+book is never held in memory as a whole. Every request first takes a
+token from a shared token bucket, so the pool never exceeds the
+configured requests per minute, and failed batches are retried with
+exponential backoff. Each finished batch is written to an on-disk
+checkpoint, so re-running an interrupted ingestion only embeds the
+batches that are still missing.
+"""
+import hashlib
+import random
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at ``rate`` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until ``tokens`` are available, then take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class EmbeddingCheckpoint:
+    """
+    Completed batches of an embedding run, stored as one .npy file each.
+
+    A batch file is named after its position and a digest of the model and
+    the batch's texts, so a batch whose chunks changed is simply embedded
+    again and its stale file replaced.
+    """
+
+    def __init__(self, directory, model_name):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+
+    def _path(self, index, texts):
+        digest = hashlib.sha256(self.model_name.encode())
+        for text in texts:
+            digest.update(hashlib.sha256(text.encode()).digest())
+        return self.directory / f"batch_{index:06d}_{digest.hexdigest()[:16]}.npy"
+
+    def load(self, index, texts):
+        path = self._path(index, texts)
+        return np.load(path) if path.exists() else None
+
+    def save(self, index, texts, vectors):
+        path = self._path(index, texts)
+        # Write then rename so a crash never leaves a truncated batch behind
+        tmp_path = path.with_suffix('.tmp.npy')
+        np.save(tmp_path, np.asarray(vectors, dtype=np.float32))
+        tmp_path.replace(path)
+        for stale in self.directory.glob(f"batch_{index:06d}_*.npy"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _embed_batch(embeddings, texts, bucket, max_retries, base_delay):
+    """Embed one batch, retrying with exponential backoff and jitter."""
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = base_delay * 2 ** attempt * (1 + random.random())
+            print(f"⚠️ Embedding batch failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _embed_and_checkpoint(index, texts, embeddings, bucket, checkpoint):
+    vectors = _embed_batch(
+        embeddings, texts, bucket, settings.EMBEDDING_MAX_RETRIES, settings.EMBEDDING_RETRY_BASE_DELAY
+    )
+    # Saved from the worker, so batches finished before a failure elsewhere survive it
+    if checkpoint:
+        checkpoint.save(index, texts, vectors)
+    return vectors
+
+
+def iter_embedded_batches(chunks, embeddings, checkpoint_dir=None, progress_callback=None, total=None):
+    """
+    Embed text chunks in batches across a thread pool, streaming.
+
+    Chunks are read from ``chunks`` only as fast as the pool embeds them:
+    at most two batches per worker are in flight.
+
+    Args:
+        chunks: Iterable of chunk texts
+        embeddings: LangChain Embeddings instance
+        checkpoint_dir: Optional directory to checkpoint finished batches in
+        progress_callback: Optional callable(chunks_done, chunks_total)
+        total: Number of chunks, for progress reports
+
+    Yields:
+        tuple: (batch texts, one embedding vector per text), in order
+    """
+    batch_size = settings.INGEST_BATCH_SIZE
+    max_in_flight = settings.INGEST_MAX_WORKERS * 2
+
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = EmbeddingCheckpoint(checkpoint_dir, getattr(embeddings, 'model', type(embeddings).__name__))
+
+    rate = settings.EMBEDDING_REQUESTS_PER_MINUTE / 60
+    bucket = TokenBucket(rate, capacity=settings.INGEST_MAX_WORKERS)
+
+    done = resumed = 0
+    if progress_callback:
+        progress_callback(done, total)
+
+    chunks = iter(chunks)
+    with ThreadPoolExecutor(max_workers=settings.INGEST_MAX_WORKERS, thread_name_prefix='embed') as executor:
+        in_flight = deque()
+        try:
+            index = 0
+            while True:
+                texts = list(islice(chunks, batch_size))
+                if texts:
+                    vectors = checkpoint.load(index, texts) if checkpoint else None
+                    if vectors is not None:
+                        resumed += len(texts)
+                        in_flight.append((texts, vectors))
+                    else:
+                        in_flight.append((texts, executor.submit(
+                            _embed_and_checkpoint, index, texts, embeddings, bucket, checkpoint
+                        )))
+                    index += 1
+                if not in_flight:
+                    break
+                if texts and len(in_flight) < max_in_flight:
+                    continue
+
+                texts, vectors = in_flight.popleft()
+                if isinstance(vectors, Future):
+                    vectors = vectors.result()
+                done += len(texts)
+                if progress_callback:
+                    progress_callback(done, total)
+                yield texts, vectors
+        finally:
+            # Start no new batches; ones already in flight still get checkpointed
+            for _, vectors in in_flight:
+                if isinstance(vectors, Future):
+                    vectors.cancel()
+
+    if resumed:
+        print(f"♻️ Resumed from checkpoint: {resumed} chunks were already embedded")
+
+
+def embed_chunks(chunks, embeddings, checkpoint_dir=None, progress_callback=None):
+    """
+    Embed text chunks in batches across a thread pool.
+
+    Args:
+        chunks: List of chunk texts
+        embeddings: LangChain Embeddings instance
+        checkpoint_dir: Optional directory to checkpoint finished batches in
+        progress_callback: Optional callable(chunks_done, chunks_total)
+
+    Returns:
+        list: One embedding vector per chunk, in order
+    """
+    return [
+        vector
+        for _, vectors in iter_embedded_batches(chunks, embeddings, checkpoint_dir, progress_callback, len(chunks))
+        for vector in vectors
+    ]
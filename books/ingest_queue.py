@@ -0,0 +1,150 @@
+"""
+Database-backed queue for book ingestion.
+
+The admin enqueues an IngestJob per book and returns immediately; the
+``run_ingest_worker`` management command claims queued jobs and runs
+them, recording progress and retrying failures with exponential backoff.
+No external broker is needed: the jobs table is the queue.
+"""
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import IngestJob
+from .rag_processor import build_vector_store
+from .vector_store_cache import invalidate_vector_store
+
+ACTIVE_STATUSES = (IngestJob.STATUS_QUEUED, IngestJob.STATUS_RUNNING)
+
+
+def enqueue_book(book):
+    """
+    Queue a book for ingestion unless it already has a pending job.
+
+    Returns:
+        tuple: (IngestJob, created)
+    """
+    job = book.ingest_jobs.filter(status__in=ACTIVE_STATUSES).first()
+    if job:
+        return job, False
+    job = IngestJob.objects.create(book=book, max_attempts=settings.INGEST_MAX_ATTEMPTS)
+    return job, True
+
+
+def claim_next_job():
+    """
+    Atomically claim the oldest runnable job.
+
+    The claim is a conditional UPDATE, so several workers can poll the same
+    table without running a job twice.
+
+    Returns:
+        IngestJob or None
+    """
+    while True:
+        job = IngestJob.objects.filter(
+            status=IngestJob.STATUS_QUEUED,
+            run_after__lte=timezone.now()
+        ).order_by('run_after', 'id').first()
+        if job is None:
+            return None
+
+        claimed = IngestJob.objects.filter(id=job.id, status=IngestJob.STATUS_QUEUED).update(
+            status=IngestJob.STATUS_RUNNING,
+            attempts=F('attempts') + 1,
+            updated_at=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def requeue_stale_jobs():
+    """
+    Handle jobs whose worker died mid-run (no progress for a long time).
+
+    A dying worker never records its failure, so the death counts as a
+    failed attempt here: the job is retried with the usual backoff, or
+    marked failed once it is out of attempts, so a book that crashes its
+    worker can't take down every new worker in turn.
+
+    Returns:
+        int: Number of jobs requeued
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.INGEST_STALE_AFTER)
+    requeued = 0
+    for job in IngestJob.objects.filter(status=IngestJob.STATUS_RUNNING, updated_at__lt=cutoff):
+        error = f"Worker died or stalled: no progress for {settings.INGEST_STALE_AFTER}s"
+        if job.attempts < job.max_attempts:
+            changes = {'status': IngestJob.STATUS_QUEUED, 'run_after': timezone.now() + _retry_delay(job)}
+        else:
+            changes = {'status': IngestJob.STATUS_FAILED}
+        # Conditional, in case the worker was only slow and has moved the job on since
+        updated = IngestJob.objects.filter(
+            id=job.id, status=IngestJob.STATUS_RUNNING, updated_at__lt=cutoff
+        ).update(error=error, updated_at=timezone.now(), **changes)
+        if updated and changes['status'] == IngestJob.STATUS_QUEUED:
+            requeued += 1
+        elif updated:
+            print(f"❌ Ingest job {job.id} failed: its worker died on each of {job.attempts} attempts")
+    return requeued
+
+
+def run_job(job):
+    """
+    Run a claimed job: build the book's vector store, then mark the job done
+    and the book processed in one transaction.
+
+    Returns:
+        bool: True if the job succeeded
+    """
+    book = job.book
+
+    def report_progress(chunks_done, chunks_total):
+        IngestJob.objects.filter(id=job.id).update(
+            chunks_done=chunks_done,
+            chunks_total=chunks_total,
+            updated_at=timezone.now()
+        )
+
+    try:
+        vector_store_path = build_vector_store(book, progress_callback=report_progress)
+    except Exception as e:
+        print(f"❌ Ingest job {job.id} for {book.title} failed: {str(e)}")
+        _record_failure(job, traceback.format_exc())
+        return False
+
+    # Book.is_processed only flips once the job is committed as done
+    with transaction.atomic():
+        book.vector_store_path = vector_store_path
+        book.is_processed = True
+        book.save(update_fields=['vector_store_path', 'is_processed'])
+        IngestJob.objects.filter(id=job.id).update(
+            status=IngestJob.STATUS_DONE,
+            error='',
+            updated_at=timezone.now()
+        )
+        transaction.on_commit(lambda: invalidate_vector_store(book))
+
+    print(f"✅ Ingest job {job.id}: processed {book.title}")
+    return True
+
+
+def _retry_delay(job):
+    """Exponential backoff after the job's latest attempt."""
+    return timedelta(seconds=settings.INGEST_RETRY_DELAY * 2 ** (job.attempts - 1))
+
+
+def _record_failure(job, error):
+    job.refresh_from_db()
+    if job.attempts < job.max_attempts:
+        delay = _retry_delay(job)
+        job.status = IngestJob.STATUS_QUEUED
+        job.run_after = timezone.now() + delay
+        print(f"🔁 Retrying in {delay.total_seconds():.0f}s (attempt {job.attempts} of {job.max_attempts})")
+    else:
+        job.status = IngestJob.STATUS_FAILED
+    job.error = error
+    job.save(update_fields=['status', 'run_after', 'error', 'updated_at'])
@@ -0,0 +1,137 @@
+"""
+BM25 keyword index over a book's chunks.
+
+Vector search is good at paraphrase but weak at exact names ("what did
+Mr. Collins say"); BM25 is the opposite. The index is built when a book is
+processed and saved as ``bm25.json`` next to its vector store. It holds
+the chunk texts too, so lexical hits can be returned without touching the
+vector store (whatever its format, or when the unified index is used).
+"""
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from pathlib import Path
+from langchain_core.documents import Document
+
+INDEX_FILE = "bm25.json"
+
+K1 = 1.5
+B = 0.75
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset("""
+a an and are as at be but by did do does for from had has have he her him his how i if in is it its
+me my no not of on or our she so that the their them they this to was we were what when where which
+who whom why will with would you your
+""".split())
+
+
+def tokenize(text):
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """In-memory BM25 index; positions are chunk indexes in book order."""
+
+    def __init__(self, texts, metadatas, lengths, postings, ids=None):
+        self.texts = texts
+        self.metadatas = metadatas
+        self.lengths = lengths
+        self.postings = postings  # term -> [[position, term frequency], ...]
+        self.ids = ids or [None] * len(texts)
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    @classmethod
+    def build(cls, texts, metadatas=None, ids=None):
+        postings = defaultdict(list)
+        lengths = []
+        for position, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings[term].append([position, frequency])
+        return cls(list(texts), metadatas or [{} for _ in texts], lengths, dict(postings), ids)
+
+    def save(self, path):
+        """Write the index to ``path/bm25.json`` via a temp file and rename."""
+        index_path = Path(path) / INDEX_FILE
+        tmp_path = index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({
+            'k1': K1,
+            'b': B,
+            'ids': self.ids,
+            'texts': self.texts,
+            'metadatas': self.metadatas,
+            'lengths': self.lengths,
+            'postings': self.postings,
+        }))
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, path):
+        data = json.loads((Path(path) / INDEX_FILE).read_text())
+        return cls(data['texts'], data['metadatas'], data['lengths'], data['postings'], data['ids'])
+
+    def __len__(self):
+        return len(self.texts)
+
+    def search(self, query, k=4, positions=None):
+        """
+        Rank chunks by BM25 score for a query.
+
+        Args:
+            query: Query string
+            k: Number of chunks to return
+            positions: Optional set of chunk positions to limit the search to
+
+        Returns:
+            list: (Document, score) pairs, best first (ties in book order)
+        """
+        scores = defaultdict(float)
+        count = len(self.texts)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings:
+                if positions is not None and position not in positions:
+                    continue
+                norm = K1 * (1 - B + B * self.lengths[position] / self.average_length)
+                scores[position] += idf * frequency * (K1 + 1) / (frequency + norm)
+
+        # Broken by position, as the scores' order depends on set iteration
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [(self.document(position), score) for position, score in best]
+
+    def document(self, position):
+        return Document(
+            page_content=self.texts[position],
+            metadata=self.metadatas[position],
+            id=self.ids[position]
+        )
+
+
+def has_lexical_index(path):
+    return bool(path) and (Path(path) / INDEX_FILE).exists()
+
+
+@lru_cache(maxsize=32)
+def _load_cached(path, version):
+    return BM25Index.load(path)
+
+
+def load_lexical_index(path):
+    """
+    The BM25 index saved in a vector store directory, cached per process.
+
+    Returns:
+        BM25Index or None if the store was built without one
+    """
+    if not has_lexical_index(path):
+        return None
+    return _load_cached(str(path), os.stat(Path(path) / INDEX_FILE).st_mtime_ns)
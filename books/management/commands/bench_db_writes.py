@@ -0,0 +1,172 @@
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.utils import timezone
+from books.benchmarking import git_commit, summarize
+from books.models import Book, Character, Conversation, Message
+
+
+def _sqlite_variants(tmp_dir):
+    """Temporary SQLite databases with the stock and the tuned connection settings."""
+    return {
+        'sqlite_default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': str(Path(tmp_dir) / 'default.sqlite3'),
+        },
+        'sqlite_tuned': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': str(Path(tmp_dir) / 'tuned.sqlite3'),
+            'OPTIONS': settings.SQLITE_OPTIONS,
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test chat-turn writes: concurrent threads each fetch their conversation and "
+        "save a user and a character message per turn (in one INSERT, as chat turns do); "
+        "reports throughput and latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=8,
+            help="Concurrent writers (one conversation each)"
+        )
+        parser.add_argument(
+            '--turns', type=int, default=100,
+            help="Chat turns per writer"
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help="Database alias to load (default: the configured database)"
+        )
+        parser.add_argument(
+            '--compare-sqlite', action='store_true',
+            help="Also run against temporary SQLite files with stock and with SQLITE_* tuned settings"
+        )
+        parser.add_argument(
+            '--separate-inserts', action='store_true',
+            help="Save the two messages with two autocommit INSERTs instead, for comparison"
+        )
+        parser.add_argument(
+            '--output', default='bench_db_writes.json',
+            help="Where to write the JSON results"
+        )
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['turns'] < 1:
+            raise CommandError("--threads and --turns must be positive")
+
+        results = {}
+        self.separate_inserts = options['separate_inserts']
+        results[options['database']] = self.run(options['database'], options['threads'], options['turns'])
+
+        if options['compare_sqlite']:
+            with tempfile.TemporaryDirectory(prefix='bench_db_') as tmp_dir:
+                for alias, config in _sqlite_variants(tmp_dir).items():
+                    connections.settings[alias] = connections.configure_settings(
+                        {'default': settings.DATABASES['default'], alias: config}
+                    )[alias]
+                    call_command('migrate', database=alias, verbosity=0)
+                    try:
+                        results[alias] = self.run(alias, options['threads'], options['turns'])
+                    finally:
+                        connections[alias].close()
+
+        self.stdout.write(
+            f"{'database':<20}{'turns/s':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        )
+        for alias, result in results.items():
+            latency = result['turn_latency']
+            self.stdout.write(
+                f"{alias:<20}{result['throughput_per_s']:>10.1f}{result['errors']:>8}"
+                f"{latency['p50_ms']:>10.2f}{latency['p95_ms']:>10.2f}{latency['p99_ms']:>10.2f}"
+            )
+
+        Path(options['output']).write_text(json.dumps({
+            'timestamp': timezone.now().isoformat(),
+            'commit': git_commit(),
+            'config': {
+                'threads': options['threads'],
+                'turns': options['turns'],
+                'separate_inserts': options['separate_inserts'],
+                'database_engine': settings.DATABASES[options['database']]['ENGINE'],
+            },
+            'results': results,
+        }, indent=2))
+        self.stdout.write(f"💾 Results written to {options['output']}")
+
+    def run(self, alias, threads, turns):
+        """Run the load against one database alias and clean up the rows it wrote."""
+        book = Book.objects.using(alias).create(
+            title="Load test", author="bench_db_writes", description="Temporary", text_file='books/load_test.txt'
+        )
+        character = Character.objects.using(alias).create(
+            book=book, name="Load Tester", description="-", personality_traits="-"
+        )
+        conversation_ids = [
+            Conversation.objects.using(alias).create(character=character, user_session=f"bench-{i}").id
+            for i in range(threads)
+        ]
+
+        samples = []
+        errors = []
+        lock = threading.Lock()
+        start_barrier = threading.Barrier(threads)
+
+        def writer(conversation_id):
+            latencies = []
+            failures = 0
+            start_barrier.wait()
+            try:
+                for turn in range(turns):
+                    started = time.perf_counter()
+                    try:
+                        conversation = Conversation.objects.using(alias).select_related(
+                            'character__book'
+                        ).get(id=conversation_id)
+                        messages = [
+                            Message(conversation=conversation, role='user', content=f"Question {turn}"),
+                            Message(conversation=conversation, role='character', content=f"Answer {turn} " * 20),
+                        ]
+                        if self.separate_inserts:
+                            for message in messages:
+                                message.save(using=alias)
+                        else:
+                            Message.objects.using(alias).bulk_create(messages)
+                    except OperationalError:
+                        failures += 1  # e.g. "database is locked"
+                        continue
+                    latencies.append(time.perf_counter() - started)
+            finally:
+                connections[alias].close()
+            with lock:
+                samples.extend(latencies)
+                errors.append(failures)
+
+        self.stdout.write(f"⏱️ {alias}: {threads} writers × {turns} turns")
+        workers = [threading.Thread(target=writer, args=(conversation_id,)) for conversation_id in conversation_ids]
+        wall_start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall_time = time.perf_counter() - wall_start
+
+        book.delete()  # Cascades to the conversations and messages
+        return {
+            'engine': connections[alias].settings_dict['ENGINE'],
+            'options': dict(connections[alias].settings_dict['OPTIONS']),
+            'turns': len(samples),
+            'errors': sum(errors),
+            'wall_time_s': round(wall_time, 3),
+            'throughput_per_s': round(len(samples) / wall_time, 3) if wall_time else None,
+            'turn_latency': summarize(samples),
+        }
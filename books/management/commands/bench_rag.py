@@ -0,0 +1,190 @@
+import asyncio
+import copy
+import json
+import logging
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from books.benchmarking import (
+    DEFAULT_QUESTIONS, FakeChatModel, FakeSpeechSynthesizer, HashingEmbeddings, build_bench_store, git_commit,
+    summarize
+)
+from books.clients import use_clients
+from books.models import Book, Character
+from books.rag_query import aquery_character
+from books.response_cache import alookup_response, remember_response
+from books.tracing import stage, trace
+from books.tts_generator import speech_request
+from books.vector_store_cache import vector_store_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the RAG query path offline: chat turns run through the production "
+        "response cache, retrieval and generation code with a deterministic local "
+        "embedder and fake LLM/TTS backends, and per-stage latencies are written as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--book', type=int, action='append', dest='book_ids',
+            help="Book id to benchmark (repeatable; default: all processed books)"
+        )
+        parser.add_argument(
+            '--questions',
+            help="Text file with one question per line (default: a built-in set)"
+        )
+        parser.add_argument(
+            '--iterations', type=int, default=5,
+            help="How many times each question is asked per book"
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=4,
+            help="Number of turns run concurrently"
+        )
+        parser.add_argument(
+            '--cached-stores', action='store_true',
+            help="Keep stores in the LRU cache between turns instead of loading them from disk on every turn"
+        )
+        parser.add_argument(
+            '--llm-latency', type=float, default=0.0,
+            help="Simulated generation latency in seconds"
+        )
+        parser.add_argument(
+            '--tts-latency', type=float, default=0.0,
+            help="Simulated speech synthesis latency in seconds"
+        )
+        parser.add_argument(
+            '--output', default='bench_rag.json',
+            help="Where to write the JSON results"
+        )
+
+    def handle(self, *args, **options):
+        books = Book.objects.filter(is_processed=True)
+        if options['book_ids']:
+            books = Book.objects.filter(id__in=options['book_ids'])
+        books = [book for book in books if book.text_file]
+        if not books:
+            raise CommandError("No books with a text file to benchmark")
+        if options['concurrency'] < 1:
+            raise CommandError("--concurrency must be positive")
+
+        if options['questions']:
+            lines = Path(options['questions']).read_text(encoding='utf-8').splitlines()
+            questions = [line.strip() for line in lines if line.strip()]
+        else:
+            questions = DEFAULT_QUESTIONS
+
+        embeddings = HashingEmbeddings()
+        llm = FakeChatModel(options['llm_latency'])
+        synthesizer = FakeSpeechSynthesizer(options['tts_latency'])
+
+        with tempfile.TemporaryDirectory(prefix='bench_rag_') as tmp_dir:
+            characters = []
+            for book in books:
+                path = Path(tmp_dir) / f"book_{book.id}"
+                chunks = build_bench_store(book, embeddings, path)
+                self.stdout.write(f"📚 {book.title}: {len(chunks)} chunks")
+                # The real book with its store swapped for the benchmark copy
+                bench_book = copy.copy(book)
+                bench_book.vector_store_path = str(path)
+                character = book.characters.first() or Character(book=book, name="Narrator")
+                character.book = bench_book
+                characters.append(character)
+
+            turns = [
+                (character, question)
+                for character in characters
+                for question in questions
+                for _ in range(options['iterations'])
+            ]
+
+            async def run_turn(character, question):
+                """One chat turn as send_message runs it, minus the database"""
+                if not options['cached_stores']:
+                    vector_store_cache.invalidate(character.book.id)
+                with trace('bench_rag', character) as turn:
+                    query_embedding, cached = await alookup_response(character, question)
+                    if cached:
+                        response = cached.response
+                    else:
+                        response = await aquery_character(character, question, query_embedding=query_embedding)
+                        remember_response(character, query_embedding, response)
+                    with stage('tts'):
+                        await asyncio.to_thread(synthesizer.synthesize, speech_request(response, character).text)
+                return turn
+
+            async def run_all():
+                semaphore = asyncio.Semaphore(options['concurrency'])
+
+                async def limited(turn):
+                    async with semaphore:
+                        return await run_turn(*turn)
+
+                return await asyncio.gather(*(limited(turn) for turn in turns))
+
+            self.stdout.write(
+                f"⏱️ Running {len(turns)} turns over {len(characters)} book(s) "
+                f"with concurrency {options['concurrency']}"
+            )
+            # Per-turn trace logs would drown the summary
+            trace_logger = logging.getLogger('books.tracing')
+            log_level = trace_logger.level
+            trace_logger.setLevel(logging.WARNING)
+            wall_start = time.perf_counter()
+            try:
+                with use_clients(embeddings=embeddings, chat_model=llm):
+                    traces = asyncio.run(run_all())
+            finally:
+                trace_logger.setLevel(log_level)
+            wall_time = time.perf_counter() - wall_start
+            for character in characters:
+                vector_store_cache.invalidate(character.book.id)
+
+        # Stage timings as recorded by the production code's tracing
+        samples = defaultdict(list)
+        for turn in traces:
+            per_stage = defaultdict(float)
+            for stage_name, duration in turn.stages:
+                per_stage[stage_name] += duration
+            for stage_name, duration in per_stage.items():
+                samples[stage_name].append(duration)
+            samples['total'].append(turn.total)
+
+        results = {
+            'timestamp': timezone.now().isoformat(),
+            'commit': git_commit(),
+            'config': {
+                'books': [book.id for book in books],
+                'questions': len(questions),
+                'iterations': options['iterations'],
+                'concurrency': options['concurrency'],
+                'cached_stores': options['cached_stores'],
+                'llm_latency': options['llm_latency'],
+                'tts_latency': options['tts_latency'],
+                'vector_store_format': settings.VECTOR_STORE_FORMAT,
+                'hybrid_retrieval': settings.HYBRID_RETRIEVAL_ENABLED,
+                'character_scope': settings.CHARACTER_SCOPE,
+                'reranker': settings.RERANKER_MODEL,
+                'response_cache': settings.RESPONSE_CACHE_ENABLED,
+            },
+            'turns': len(turns),
+            'wall_time_s': round(wall_time, 3),
+            'throughput_per_s': round(len(turns) / wall_time, 3) if wall_time else None,
+            'stages': {stage_name: summarize(durations) for stage_name, durations in samples.items()},
+        }
+
+        self.stdout.write(f"{'stage':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for stage_name, summary in results['stages'].items():
+            self.stdout.write(
+                f"{stage_name:<20}{summary['count']:>7}{summary['p50_ms']:>10.2f}"
+                f"{summary['p95_ms']:>10.2f}{summary['p99_ms']:>10.2f}"
+            )
+        self.stdout.write(f"🚀 Throughput: {results['throughput_per_s']} turns/s")
+
+        Path(options['output']).write_text(json.dumps(results, indent=2))
+        self.stdout.write(f"💾 Results written to {options['output']}")
@@ -0,0 +1,176 @@
+import copy
+import json
+import tempfile
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from books.benchmarking import (
+    HashingEmbeddings, build_bench_store, git_commit, load_retrieval_queries, make_retrieval_queries,
+    paraphrase_queries
+)
+from books.clients import get_chat_model, get_embeddings
+from books.lexical_index import load_lexical_index
+from books.models import Book
+from books.retrieval import retrieve
+from books.vector_store_cache import load_store
+
+MODES = ['vector', 'lexical', 'hybrid']
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure retrieval precision and recall of vector, BM25 and hybrid search "
+        "(the production retrieve()) on questions with known answer passages"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--book', type=int, action='append', dest='book_ids',
+            help="Book id to evaluate (repeatable; default: all processed books)"
+        )
+        parser.add_argument(
+            '--samples', type=int, default=50,
+            help="Questions generated per book"
+        )
+        parser.add_argument('--k', type=int, default=3, help="Passages retrieved per question")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for question sampling")
+        parser.add_argument(
+            '--live', action='store_true',
+            help="Use the books' real vector stores and embedding API instead of the offline hashing embedder"
+        )
+        parser.add_argument(
+            '--paraphrase', action='store_true',
+            help="Also ask each question reworded by Gemini (needs --live)"
+        )
+        parser.add_argument(
+            '--queries',
+            help='JSON Lines file of hand-written {"question": ..., "passage": ...} pairs to ask as well'
+        )
+        parser.add_argument(
+            '--output', default='bench_retrieval.json',
+            help="Where to write the JSON results"
+        )
+
+    def handle(self, *args, **options):
+        books = Book.objects.filter(is_processed=True)
+        if options['book_ids']:
+            books = Book.objects.filter(id__in=options['book_ids'])
+        books = [book for book in books if book.text_file]
+        if not books:
+            raise CommandError("No books with a text file to evaluate")
+        if options['paraphrase'] and not options['live']:
+            raise CommandError("--paraphrase needs --live (questions are reworded by Gemini)")
+        if not settings.HYBRID_RETRIEVAL_ENABLED:
+            self.stdout.write("⚠️ HYBRID_RETRIEVAL_ENABLED is off, so 'hybrid' is vector search alone")
+        if not options['live']:
+            self.stdout.write(
+                "ℹ️ The offline hashing embedder only matches words, so vector and hybrid scores "
+                "say little about meaning; use --live --paraphrase for that"
+            )
+
+        totals = {}
+        with tempfile.TemporaryDirectory(prefix='bench_retrieval_') as tmp_dir:
+            for book in books:
+                book, vector_store, lexical, chunks = self._load(book, options['live'], Path(tmp_dir))
+                query_sets = {'keyword': make_retrieval_queries(chunks, options['samples'], options['seed'])}
+                if options['paraphrase']:
+                    query_sets['paraphrase'] = paraphrase_queries(query_sets['keyword'], get_chat_model())
+                if options['queries']:
+                    query_sets['hand_written'] = load_retrieval_queries(options['queries'], chunks)
+                self.stdout.write(
+                    f"📚 {book.title}: {len(chunks)} chunks, "
+                    + ", ".join(f"{len(queries)} {style}" for style, queries in query_sets.items())
+                    + " questions"
+                )
+
+                for style, queries in query_sets.items():
+                    for query in queries:
+                        for mode in MODES:
+                            start = time.perf_counter()
+                            docs = self._search(mode, book, vector_store, lexical, query['question'], options['k'])
+                            self._score(totals, style, mode, docs, query, options['k'], time.perf_counter() - start)
+
+        if not totals:
+            raise CommandError("Could not generate any questions from the selected books")
+
+        results = {
+            'timestamp': timezone.now().isoformat(),
+            'commit': git_commit(),
+            'config': {
+                'books': [book.id for book in books],
+                'samples': options['samples'],
+                'k': options['k'],
+                'seed': options['seed'],
+                'live': options['live'],
+                'hybrid_retrieval': settings.HYBRID_RETRIEVAL_ENABLED,
+                'hybrid_candidates': settings.HYBRID_CANDIDATES,
+                'reranker': settings.RERANKER_MODEL,
+            },
+            'styles': {
+                style: {
+                    'questions': modes['vector']['count'],
+                    'modes': {
+                        mode: {
+                            f"precision@{options['k']}": round(scores['precision'] / scores['count'], 4),
+                            f"recall@{options['k']}": round(scores['recall'] / scores['count'], 4),
+                            'hit_rate': round(scores['hits'] / scores['count'], 4),
+                            'mrr': round(scores['reciprocal_rank'] / scores['count'], 4),
+                            'mean_ms': round(scores['seconds'] / scores['count'] * 1000, 3),
+                        }
+                        for mode, scores in modes.items()
+                    },
+                }
+                for style, modes in totals.items()
+            },
+        }
+
+        self.stdout.write(f"{'questions':<14}{'mode':<10}{'precision':>11}{'recall':>9}{'hit rate':>10}{'mrr':>8}{'ms':>9}")
+        for style, summary in results['styles'].items():
+            for mode, scores in summary['modes'].items():
+                precision, recall, hit_rate, mrr, mean_ms = scores.values()
+                self.stdout.write(
+                    f"{style:<14}{mode:<10}{precision:>11.3f}{recall:>9.3f}{hit_rate:>10.3f}{mrr:>8.3f}{mean_ms:>9.2f}"
+                )
+
+        Path(options['output']).write_text(json.dumps(results, indent=2))
+        self.stdout.write(f"💾 Results written to {options['output']}")
+
+    def _load(self, book, live, tmp_dir):
+        """
+        The book (pointing at the store to evaluate), its vector store, BM25
+        index and chunk texts.
+        """
+        if not live:
+            path = tmp_dir / f"book_{book.id}"
+            chunks = build_bench_store(book, HashingEmbeddings(), path)
+            book = copy.copy(book)
+            book.vector_store_path = str(path)
+            return book, load_store(path, HashingEmbeddings()), load_lexical_index(path), chunks
+
+        if not book.vector_store_path:
+            raise CommandError(f"{book.title} has no vector store; process it first")
+        lexical = load_lexical_index(book.vector_store_path)
+        if lexical is None:
+            raise CommandError(f"{book.title} has no BM25 index; re-process it first")
+        return book, load_store(book.vector_store_path, get_embeddings()), lexical, lexical.texts
+
+    def _search(self, mode, book, vector_store, lexical, question, k):
+        if mode == 'vector':
+            return vector_store.similarity_search(question, k=k)
+        if mode == 'lexical':
+            return [doc for doc, _ in lexical.search(question, k=k)]
+        return retrieve(book, vector_store, question, k=k)
+
+    def _score(self, totals, style, mode, docs, query, k, elapsed):
+        scores = totals.setdefault(style, {}).setdefault(mode, {
+            'count': 0, 'precision': 0.0, 'recall': 0.0, 'hits': 0, 'reciprocal_rank': 0.0, 'seconds': 0.0
+        })
+        found = [doc.page_content in query['relevant'] for doc in docs]
+        scores['count'] += 1
+        scores['precision'] += sum(found) / k
+        scores['recall'] += len({doc.page_content for doc in docs} & query['relevant']) / len(query['relevant'])
+        scores['hits'] += any(found)
+        scores['reciprocal_rank'] += next((1 / (i + 1) for i, hit in enumerate(found) if hit), 0.0)
+        scores['seconds'] += elapsed
@@ -0,0 +1,55 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from books.models import Character
+from books.tts_prewarm import prewarm_characters
+
+
+class Command(BaseCommand):
+    help = "Pre-generate TTS audio for the fallback reply and each character's most frequent replies"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--book', type=int, action='append', dest='book_ids',
+            help="Only characters of this book (repeatable; default: all processed books)"
+        )
+        parser.add_argument(
+            '--top', type=int, default=settings.TTS_PREWARM_TOP_RESPONSES,
+            help="Most frequent replies per character to pre-generate (default: TTS_PREWARM_TOP_RESPONSES)"
+        )
+        parser.add_argument(
+            '--min-count', type=int, default=2,
+            help="Times a reply must have been given to count as frequent"
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.TTS_PREWARM_CONCURRENCY,
+            help="Concurrent TTS requests (default: TTS_PREWARM_CONCURRENCY)"
+        )
+        parser.add_argument(
+            '--interval', type=float, default=0,
+            help="Keep running, pre-warming again every this many seconds (default: run once)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                characters = Character.objects.select_related('book').filter(book__is_processed=True)
+                if options['book_ids']:
+                    characters = characters.filter(book_id__in=options['book_ids'])
+
+                counts = prewarm_characters(
+                    list(characters),
+                    options['top'],
+                    min_count=options['min_count'],
+                    concurrency=options['concurrency'],
+                    log=self.stdout.write
+                )
+                self.stdout.write(
+                    f"✅ {counts['synthesized']} synthesized, {counts['cached']} already cached, "
+                    f"{counts['failed']} failed"
+                )
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from books.tts_generator import audio_cache
+
+
+class Command(BaseCommand):
+    help = "Evict old and least recently played audio from the TTS cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-bytes', type=int, default=settings.TTS_CACHE_MAX_BYTES,
+            help="Size budget of the cache in bytes (default: TTS_CACHE_MAX_BYTES)"
+        )
+        parser.add_argument(
+            '--max-age-days', type=float, default=settings.TTS_CACHE_MAX_AGE_DAYS,
+            help="Evict clips not played for this many days; 0 disables (default: TTS_CACHE_MAX_AGE_DAYS)"
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Report what would be evicted without deleting anything"
+        )
+
+    def handle(self, *args, **options):
+        removed, freed = audio_cache.prune(
+            max_bytes=options['max_bytes'],
+            max_age=options['max_age_days'] * 24 * 60 * 60,
+            dry_run=options['dry_run']
+        )
+        stats = audio_cache.stats()
+        verb = "Would evict" if options['dry_run'] else "Evicted"
+        self.stdout.write(f"🧹 {verb} {removed} clips ({freed / 1024 / 1024:.1f} MB)")
+        self.stdout.write(f"🎧 {stats['entries']} clips cached ({stats['size_bytes'] / 1024 / 1024:.1f} MB)")
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from books.ingest_queue import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Process queued book ingestion jobs (creates RAG vector stores)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Exit once no runnable jobs are left instead of polling"
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=5.0,
+            help="Seconds to wait between polls when the queue is empty"
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("📥 Ingest worker started")
+        try:
+            while True:
+                requeue_stale_jobs()
+                job = claim_next_job()
+                if job is None:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                self.stdout.write(f"📚 Job {job.id}: {job.book.title} (attempt {job.attempts})")
+                run_job(job)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("👋 Ingest worker stopped")
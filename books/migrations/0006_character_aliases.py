@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0005_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='aliases',
+            field=models.CharField(blank=True, help_text='Comma-separated other names used for this character in the book (e.g. Lizzy, Eliza)', max_length=500),
+        ),
+    ]
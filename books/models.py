@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class Book(models.Model):
@@ -31,6 +32,11 @@ class Character(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     personality_traits = models.TextField()
+    aliases = models.CharField(
+        max_length=500,
+        blank=True,
+        help_text='Comma-separated other names used for this character in the book (e.g. Lizzy, Eliza)'
+    )
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
     voice = models.CharField(
         max_length=50,
@@ -46,6 +52,9 @@ class Conversation(models.Model):
     character = models.ForeignKey(Character, on_delete=models.CASCADE)
     user_session = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Rolling summary of the turns too old to fit the prompt's history budget
+    summary = models.TextField(blank=True)
+    summary_through = models.BigIntegerField(default=0)  # Id of the last message folded into summary
     
     def __str__(self):
         return f"Chat with {self.character.name}"
@@ -54,7 +63,48 @@ class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     role = models.CharField(max_length=20)  # 'user' or 'character'
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is created, not inserted, so write-behind keeps the turn's time
+    timestamp = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        indexes = [
+            # Chat pages read a conversation's messages newest first
+            models.Index(fields=['conversation', 'timestamp'], name='message_conversation_time_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}"
+
+class IngestJob(models.Model):
+    """A queued run of process_book_for_rag, picked up by the ingest worker"""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='ingest_jobs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    chunks_done = models.PositiveIntegerField(default=0)
+    chunks_total = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def progress(self):
+        if not self.chunks_total:
+            return "-"
+        return f"{self.chunks_done}/{self.chunks_total} chunks"
     
     def __str__(self):
-        return f"{self.role}: {self.content[:50]}"
\ No newline at end of file
+        return f"Ingest {self.book.title} ({self.status})"
@@ -0,0 +1,61 @@
+"""
+Cursor pagination of a conversation's messages.
+
+The chat page renders only the newest CHAT_PAGE_SIZE messages; older ones
+are fetched a page at a time from the ``older_messages`` endpoint. Pages
+are keyed on (timestamp, id) rather than offsets, so each one is a single
+range scan of the (conversation, timestamp) index however long the
+conversation has run, and messages arriving meanwhile don't shift pages.
+"""
+from datetime import datetime, timedelta, timezone
+from django.conf import settings
+from django.db.models import Q
+from .models import Message
+from .turn_store import pending_messages
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_cursor(message):
+    """Opaque cursor pointing just before a message."""
+    return f"{(message.timestamp - _EPOCH) // _MICROSECOND}-{message.id}"
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        tuple: (timestamp, id), or None if the cursor is malformed
+    """
+    try:
+        micros, message_id = (int(part) for part in cursor.split('-'))
+        return _EPOCH + micros * _MICROSECOND, message_id
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def message_page(conversation_id, before=None, limit=None):
+    """
+    One page of a conversation's messages, in one query.
+
+    Args:
+        conversation_id: Conversation id
+        before: Cursor from a previous page; None for the newest messages
+        limit: Page size (default CHAT_PAGE_SIZE)
+
+    Returns:
+        tuple: (messages oldest first, cursor for the page before them or
+        None when there are no older messages)
+    """
+    limit = limit or settings.CHAT_PAGE_SIZE
+    messages = Message.objects.filter(conversation_id=conversation_id)
+    position = decode_cursor(before) if before else None
+    if position:
+        timestamp, message_id = position
+        messages = messages.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id))
+    page = list(messages.order_by('-timestamp', '-id')[:limit + 1])
+    older = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    if not before:
+        # Turns still in the write-behind buffer are the newest of all
+        return page[:limit][::-1] + pending_messages(conversation_id), older
+    return page[:limit][::-1], older
@@ -1,69 +1,225 @@
+import json
 import os
+import shutil
+import time
+from collections import deque
 from pathlib import Path
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from django.conf import settings
+from .character_index import save_character_index, text_key
+from .chunker import iter_chunks
+from .clients import get_embeddings
+from .compact_store import is_compact_store, write_compact_from_faiss
+from .embedding_engine import iter_embedded_batches
+from .lexical_index import BM25Index, has_lexical_index
+from .unified_index import add_book_from_store
+from .vector_store_cache import invalidate_vector_store
+
+# Written next to the FAISS files: the content hash id of every chunk, in order
+CHUNK_MANIFEST = "chunks.json"
+
+def chunk_ids(chunks):
+    """
+    Content-hash ids for chunks, stable across re-processing.
+
+    Repeated chunks get an occurrence suffix so every id is unique.
+    """
+    seen = {}
+    ids = []
+    for chunk in chunks:
+        digest = text_key(chunk)
+        count = seen.get(digest, 0)
+        seen[digest] = count + 1
+        ids.append(digest if count == 0 else f"{digest}-{count}")
+    return ids
+
+def read_chunks(book):
+    """
+    Stream a book's text file into chunks, in book order.
+
+    Yields:
+        Chunk: Text plus chapter and offset metadata
+    """
+    return iter_chunks(book.text_file.path)
+
+def _load_previous_store(book, embeddings):
+    """
+    Load the book's current store for incremental updates, or None if it has
+    no store or one saved without a chunk manifest.
+
+    A private copy is loaded from disk so the cached store other requests
+    are reading is never modified in place. Compact stores hold quantized
+    vectors only, so they are rebuilt in full instead (unchanged chunks
+    are then served by the embedding cache).
+    """
+    if not book.vector_store_path:
+        return None, []
+    manifest_path = Path(book.vector_store_path) / CHUNK_MANIFEST
+    if not manifest_path.exists() or is_compact_store(book.vector_store_path):
+        return None, []
+    vector_store = FAISS.load_local(
+        book.vector_store_path,
+        embeddings,
+        allow_dangerous_deserialization=True
+    )
+    return vector_store, json.loads(manifest_path.read_text())['chunk_ids']
+
+def _save_atomically(vector_store, texts, metadatas, ids, vector_store_dir, book):
+    """
+    Save a store under a new versioned directory, in the format selected by
+    VECTOR_STORE_FORMAT, with the BM25 and character indexes of its chunks
+    alongside.
+
+    The store is written to a temp dir which is then renamed into place, so
+    readers never see a half-written store. The previous version (still
+    referenced by the Book until the caller saves the new path) is kept for
+    in-flight readers; anything older is removed.
+    """
+    vector_store_dir.mkdir(exist_ok=True)
+    version_path = vector_store_dir / f"book_{book.id}_v{time.time_ns()}"
+    tmp_path = version_path.with_name(version_path.name + ".tmp")
+
+    if settings.VECTOR_STORE_FORMAT == 'compact':
+        write_compact_from_faiss(tmp_path, vector_store)
+    else:
+        vector_store.save_local(str(tmp_path))
+    (tmp_path / CHUNK_MANIFEST).write_text(json.dumps({'chunk_ids': ids}))
+    BM25Index.build(texts, metadatas, ids).save(tmp_path)
+    save_character_index(tmp_path, book.characters.all(), texts)
+    os.rename(tmp_path, version_path)
+
+    keep = {version_path.resolve()}
+    if book.vector_store_path:
+        keep.add(Path(book.vector_store_path).resolve())
+    # Older versions, plus the unversioned directory earlier releases used
+    old_paths = list(vector_store_dir.glob(f"book_{book.id}_v*")) + [vector_store_dir / f"book_{book.id}"]
+    for old_path in old_paths:
+        if old_path.is_dir() and old_path.resolve() not in keep:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    return version_path
+
+def build_vector_store(book, progress_callback=None):
+    """
+    Split and embed a book and save its vector store, without touching the
+    Book record.
+
+    If the book already has a store, only chunks that were added or changed
+    since are embedded, and deleted chunks are removed by id.
+
+    Args:
+        book: Book model instance
+        progress_callback: Optional callable(chunks_done, chunks_total)
+            called after each embedded batch
+
+    Returns:
+        str: Path the new vector store version was saved to
+
+    Raises:
+        Exception: Any error reading, embedding or saving the book
+    """
+    print(f"📚 Processing: {book.title}")
+    print(f"📄 Text size: {book.text_file.size} bytes")
+
+    # 1. First pass over the text: hash every chunk, keeping only the ids
+    ids = chunk_ids(chunk.text for chunk in read_chunks(book))
+    if not ids:
+        raise ValueError(f"{book.title} has no text to index")
+    print(f"✂️ Created {len(ids)} chunks")
+
+    # 2. Diff against the current store
+    embeddings = get_embeddings()
+    vector_store, previous_ids = _load_previous_store(book, embeddings)
+    previous = set(previous_ids)
+    current = set(ids)
+    new_count = sum(1 for chunk_id in ids if chunk_id not in previous)
+    removed_ids = [chunk_id for chunk_id in previous_ids if chunk_id not in current]
+    if vector_store is not None:
+        print(f"🔁 Incremental update: {new_count} new, {len(removed_ids)} removed chunks")
+        if not new_count and not removed_ids and settings.VECTOR_STORE_FORMAT != 'compact':
+            # Store unchanged; add the keyword index if it predates it, refresh
+            # the character index and make sure the book is in the unified index
+            texts = [vector_store.docstore.search(chunk_id).page_content for chunk_id in ids]
+            if not has_lexical_index(book.vector_store_path):
+                metadatas = [vector_store.docstore.search(chunk_id).metadata for chunk_id in ids]
+                BM25Index.build(texts, metadatas, ids).save(book.vector_store_path)
+            save_character_index(book.vector_store_path, book.characters.all(), texts)
+            if settings.UNIFIED_INDEX_ENABLED:
+                add_book_from_store(book.id, vector_store, ids)
+            return book.vector_store_path
+        if removed_ids:
+            vector_store.delete(removed_ids)
+
+    # 3. Second pass: stream new chunks through rate-limited, checkpointed
+    # batch embedding, adding each batch to the store as it arrives
+    vector_store_dir = Path(settings.BASE_DIR) / "vector_stores"
+    checkpoint_dir = vector_store_dir / f"book_{book.id}.checkpoint"
+    texts, metadatas, pending = [], [], deque()
+
+    def new_texts():
+        for chunk_id, chunk in zip(ids, read_chunks(book)):
+            texts.append(chunk.text)
+            metadatas.append(chunk.metadata)
+            if chunk_id in previous:
+                # Unchanged chunks may have moved (e.g. text inserted before them)
+                vector_store.docstore.search(chunk_id).metadata = chunk.metadata
+            else:
+                pending.append((chunk_id, chunk.metadata))
+                yield chunk.text
+
+    print("🔢 Embedding chunks...")
+    print("🗂️ Updating vector store..." if vector_store is not None else "🗂️ Creating vector store...")
+    batches = iter_embedded_batches(new_texts(), embeddings, checkpoint_dir, progress_callback, new_count)
+    for batch, vectors in batches:
+        batch_ids, batch_metadatas = zip(*(pending.popleft() for _ in batch))
+        text_embeddings = list(zip(batch, vectors))
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(
+                text_embeddings, embeddings, metadatas=list(batch_metadatas), ids=list(batch_ids)
+            )
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas=list(batch_metadatas), ids=list(batch_ids))
+    if chunk_ids(texts) != ids:
+        raise RuntimeError(f"{book.title}'s text changed while it was being processed")
+
+    # 4. Save the new version
+    vector_store_path = _save_atomically(vector_store, texts, metadatas, ids, vector_store_dir, book)
+    if settings.UNIFIED_INDEX_ENABLED:
+        add_book_from_store(book.id, vector_store, ids)
+
+    # The store is safely on disk, so the checkpoint is no longer needed
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    print(f"💾 Vector store saved to: {vector_store_path}")
+
+    return str(vector_store_path)
 
 def process_book_for_rag(book):
     """
     Process a book to create RAG vector store.
-    
+
     Args:
         book: Book model instance
-    
+
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        # 1. Read the book text
-        file_path = book.text_file.path
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-        
-        print(f"📚 Processing: {book.title}")
-        print(f"📄 Text length: {len(text)} characters")
-        
-        # 2. Split text into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
-        chunks = text_splitter.split_text(text)
-        print(f"✂️ Created {len(chunks)} chunks")
-        
-        # 3. Create embeddings
-        embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=settings.GOOGLE_API_KEY
-        )
-        
-        # 4. Create vector store
-        print("🔢 Creating vector store...")
-        vector_store = FAISS.from_texts(chunks, embeddings)
-        
-        # 5. Save vector store
-        vector_store_dir = Path(settings.BASE_DIR) / "vector_stores"
-        vector_store_dir.mkdir(exist_ok=True)
-        
-        vector_store_path = vector_store_dir / f"book_{book.id}"
-        vector_store.save_local(str(vector_store_path))
-        
-        # 6. Update book record
-        book.vector_store_path = str(vector_store_path)
+        vector_store_path = build_vector_store(book)
+
+        # Update book record
+        book.vector_store_path = vector_store_path
         book.is_processed = True
         book.save()
-        
+        invalidate_vector_store(book)
+
         print(f"✅ Successfully processed {book.title}")
-        print(f"💾 Vector store saved to: {vector_store_path}")
-        
+
         return True
-        
+
     except Exception as e:
-        print(f"❌ Error processing book: {str(e)}")
         import traceback
         print(f"❌ Error processing book: {str(e)}")
         print("Full traceback:")
         traceback.print_exc()
-        return False
\ No newline at end of file
+        return False
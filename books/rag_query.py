@@ -1,39 +1,39 @@
-from pathlib import Path
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from django.conf import settings
+from asgiref.sync import sync_to_async
+from .clients import get_chat_model
+from .retrieval import aretrieve, retrieve
+from .tracing import stage
+from .vector_store_cache import get_vector_store
 
-def query_character(character, user_message, conversation_history=None):
+FALLBACK_RESPONSE = "I apologize, but I seem to be having difficulty responding at the moment."
+
+
+def format_passages(docs):
+    """Join retrieved passages for the prompt, labelled with their chapter when known."""
+    passages = []
+    for doc in docs:
+        chapter = doc.metadata.get('chapter')
+        passages.append(f"[{chapter}]\n{doc.page_content}" if chapter else doc.page_content)
+    return "\n\n".join(passages)
+
+
+def build_prompt(character, context, user_message, history=''):
     """
-    Query a character using RAG to retrieve relevant context from their book.
-    
+    Build the in-character prompt sent to Gemini.
+
     Args:
         character: Character model instance
+        context: Relevant passages retrieved from the book
         user_message: User's message string
-        conversation_history: List of previous messages (optional)
-    
+        history: Formatted earlier turns of the conversation (optional)
+
     Returns:
-        str: Character's response
+        str: The prompt
     """
-    try:
-        # 1. Load the vector store for this character's book
-        vector_store_path = character.book.vector_store_path
-        embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            google_api_key=settings.GOOGLE_API_KEY
-        )
-        vector_store = FAISS.load_local(
-            vector_store_path, 
-            embeddings,
-            allow_dangerous_deserialization=True
-        )
-        
-        # 2. Search for relevant passages
-        relevant_docs = vector_store.similarity_search(user_message, k=3)
-        context = "\n\n".join([doc.page_content for doc in relevant_docs])
-        
-        # 3. Build the prompt
-        prompt = f"""You are {character.name} from "{character.book.title}" by {character.book.author}.
+    history_section = f"""
+THE CONVERSATION SO FAR:
+{history}
+""" if history else ""
+    return f"""You are {character.name} from "{character.book.title}" by {character.book.author}.
 
 WHO YOU ARE:
 {character.description}
@@ -43,7 +43,7 @@ YOUR PERSONALITY:
 
 RELEVANT PASSAGES FROM THE BOOK:
 {context}
-
+{history_section}
 CRITICAL INSTRUCTIONS:
 - Respond AS {character.name} in first person ("I", "my")
 - Do NOT use generic greetings like "Sir/Madam" or "Good day"
@@ -55,18 +55,125 @@ CRITICAL INSTRUCTIONS:
 User says: {user_message}
 
 Respond directly in character. Do NOT include your character name or labels in your response - just speak as {character.name} would speak:"""
-        
+
+
+def query_character(character, user_message, conversation_history=None):
+    """
+    Query a character using RAG to retrieve relevant context from their book.
+
+    Args:
+        character: Character model instance
+        user_message: User's message string
+        conversation_history: Earlier turns, formatted by conversation_memory (optional)
+
+    Returns:
+        str: Character's response
+    """
+    try:
+        # 1. Get the vector store for this character's book (cached per process)
+        with stage('store_load'):
+            vector_store = get_vector_store(character.book)
+
+        # 2. Search for relevant passages
+        with stage('retrieval'):
+            relevant_docs = retrieve(character.book, vector_store, user_message, k=3, character=character)
+        context = format_passages(relevant_docs)
+
+        # 3. Build the prompt
+        with stage('prompt_build'):
+            prompt = build_prompt(character, context, user_message, conversation_history or '')
+
         # 4. Generate response
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            google_api_key=settings.GOOGLE_API_KEY
+        llm = get_chat_model()
+        with stage('generation'):
+            response = llm.invoke(prompt)
+
+        return response.content
+
+    except Exception as e:
+        print(f"Error querying character: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return FALLBACK_RESPONSE
+
+
+async def _abuild_prompt(character, user_message, query_embedding=None, conversation_history=None):
+    """Retrieve passages for a message and build the prompt, asynchronously."""
+    with stage('store_load'):
+        vector_store = await sync_to_async(get_vector_store, thread_sensitive=False)(character.book)
+
+    with stage('retrieval'):
+        relevant_docs = await aretrieve(
+            character.book, vector_store, user_message, k=3,
+            query_embedding=query_embedding, character=character
         )
-        response = llm.invoke(prompt)
-        
+    context = format_passages(relevant_docs)
+
+    with stage('prompt_build'):
+        return build_prompt(character, context, user_message, conversation_history or '')
+
+
+async def aquery_character(character, user_message, conversation_history=None, query_embedding=None):
+    """
+    Async version of query_character for use from async views.
+
+    The embedding and Gemini calls are awaited on the event loop, so many
+    slow LLM calls can be in flight at once. Only loading a store from disk
+    on a cache miss is pushed to a worker thread.
+
+    Args:
+        character: Character model instance (with book already loaded)
+        user_message: User's message string
+        conversation_history: Earlier turns, formatted by conversation_memory (optional)
+        query_embedding: Embedding of user_message, if already computed
+
+    Returns:
+        str: Character's response
+    """
+    try:
+        prompt = await _abuild_prompt(character, user_message, query_embedding, conversation_history)
+
+        llm = get_chat_model()
+        with stage('generation'):
+            response = await llm.ainvoke(prompt)
+
         return response.content
-        
+
     except Exception as e:
         print(f"Error querying character: {str(e)}")
         import traceback
         traceback.print_exc()
-        return f"I apologize, but I seem to be having difficulty responding at the moment."
\ No newline at end of file
+        return FALLBACK_RESPONSE
+
+
+async def astream_character(character, user_message, conversation_history=None, query_embedding=None):
+    """
+    Stream a character's response token by token.
+
+    Args:
+        character: Character model instance (with book already loaded)
+        user_message: User's message string
+        conversation_history: Earlier turns, formatted by conversation_memory (optional)
+        query_embedding: Embedding of user_message, if already computed
+
+    Yields:
+        str: Pieces of the character's response as Gemini produces them
+    """
+    started = False
+    try:
+        prompt = await _abuild_prompt(character, user_message, query_embedding, conversation_history)
+
+        llm = get_chat_model()
+        with stage('generation'):
+            async for chunk in llm.astream(prompt):
+                if chunk.content:
+                    started = True
+                    yield chunk.content
+
+    except Exception as e:
+        print(f"Error streaming character response: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        # Only fall back if nothing was sent yet; otherwise keep the partial reply
+        if not started:
+            yield FALLBACK_RESPONSE
@@ -0,0 +1,149 @@
+"""
+Semantic cache of character responses.
+
+Users often ask a character nearly the same question. When the embedding
+of a new question is close enough (cosine similarity above a threshold) to
+one already answered by the same character, the stored response and its
+TTS audio are returned instead of running retrieval, Gemini and TTS again.
+Entries expire after a TTL and each character keeps at most a fixed number
+of entries, evicting the least recently used.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from django.conf import settings
+from .clients import get_embeddings
+from .rag_query import FALLBACK_RESPONSE
+from .tracing import stage
+
+
+class CachedResponse:
+    def __init__(self, entry_id, vector, response, audio_url=None, audio_playlist=None):
+        self.entry_id = entry_id
+        self.vector = vector
+        self.response = response
+        self.audio_url = audio_url
+        self.audio_playlist = audio_playlist or ([audio_url] if audio_url else [])
+        self.created = time.monotonic()
+
+
+class SemanticResponseCache:
+    """Per-character nearest-neighbour cache of responses, in process memory."""
+
+    def __init__(self, threshold, ttl, max_entries):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # character id -> OrderedDict(entry id -> CachedResponse)
+        self._hits = {}
+        self._misses = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, character_id, vector):
+        """
+        Find the closest cached response for a character.
+
+        Args:
+            character_id: Primary key of the character
+            vector: Embedding of the user's message
+
+        Returns:
+            CachedResponse or None if nothing is similar enough
+        """
+        query = self._normalize(vector)
+        with self._lock:
+            entries = self._entries.get(character_id)
+            best = None
+            if entries:
+                self._expire(entries)
+            if entries:
+                matrix = np.stack([entry.vector for entry in entries.values()])
+                scores = matrix @ query
+                index = int(np.argmax(scores))
+                if scores[index] >= self.threshold:
+                    best = list(entries.values())[index]
+                    entries.move_to_end(best.entry_id)
+
+            counter = self._hits if best else self._misses
+            counter[character_id] = counter.get(character_id, 0) + 1
+            return best
+
+    def store(self, character_id, vector, response, audio_url=None, audio_playlist=None):
+        """Cache a response for a character; returns the new entry."""
+        with self._lock:
+            entries = self._entries.setdefault(character_id, OrderedDict())
+            entry = CachedResponse(next(self._ids), self._normalize(vector), response, audio_url, audio_playlist)
+            entries[entry.entry_id] = entry
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            return entry
+
+    def clear(self, character_id=None):
+        with self._lock:
+            if character_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(character_id, None)
+
+    def stats(self):
+        """Hit rate and size per character id."""
+        with self._lock:
+            result = {}
+            for character_id in set(self._hits) | set(self._misses) | set(self._entries):
+                hits = self._hits.get(character_id, 0)
+                misses = self._misses.get(character_id, 0)
+                result[character_id] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+                    'entries': len(self._entries.get(character_id, ())),
+                }
+            return result
+
+    def _expire(self, entries):
+        cutoff = time.monotonic() - self.ttl
+        for entry_id in [e.entry_id for e in entries.values() if e.created < cutoff]:
+            del entries[entry_id]
+
+
+response_cache = SemanticResponseCache(
+    threshold=settings.RESPONSE_CACHE_SIMILARITY,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES
+)
+
+
+async def alookup_response(character, user_message):
+    """
+    Embed the message and look it up in the semantic response cache.
+
+    Returns:
+        tuple: (query embedding, CachedResponse or None); both None when the
+        cache is disabled or the message could not be embedded
+    """
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None, None
+    try:
+        with stage('query_embedding'):
+            query_embedding = await get_embeddings().aembed_query(user_message)
+    except Exception as e:
+        print(f"❌ Could not embed message for response cache: {str(e)}")
+        return None, None
+    with stage('response_cache'):
+        return query_embedding, response_cache.lookup(character.id, query_embedding)
+
+
+def remember_response(character, query_embedding, character_response, audio_url=None, audio_playlist=None):
+    """Store a fresh reply in the semantic response cache (if enabled)"""
+    if query_embedding is None or character_response == FALLBACK_RESPONSE:
+        return
+    response_cache.store(character.id, query_embedding, character_response, audio_url, audio_playlist)
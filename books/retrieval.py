@@ -0,0 +1,191 @@
+"""
+Hybrid passage retrieval: vector and BM25 search fused by reciprocal rank.
+
+Both searches run in parallel and return HYBRID_CANDIDATES passages each.
+Reciprocal rank fusion merges the two rankings without having to compare
+their scores, and an optional local cross-encoder (RERANKER_MODEL, needs
+``sentence-transformers``) reorders the fused candidates before the top k
+go into the prompt. Books processed before the BM25 index existed fall
+back to vector search alone.
+
+When the character being asked is known, passages that mention them (see
+character_index) are boosted, or kept exclusively with
+CHARACTER_SCOPE='restrict'.
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .character_index import character_scope, text_key
+from .lexical_index import load_lexical_index
+from .tracing import stage
+
+# Standard constant from the RRF paper; damps the weight of top ranks
+RRF_K = 60
+
+# Vector search can't be limited to passages mentioning the character, so in
+# restrict mode it fetches this many times the candidates before filtering
+RESTRICT_OVERFETCH = 4
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='retrieval')
+
+_reranker = None
+_reranker_loaded = False
+_reranker_lock = threading.Lock()
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Merge ranked document lists; a passage found by both searches rises.
+
+    Documents are matched by text, since ids differ between store formats.
+
+    Returns:
+        list: Documents, best first; ties keep the order they were first seen in
+    """
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            documents.setdefault(doc.page_content, doc)
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1.0 / (k + rank + 1)
+    return [documents[text] for text in sorted(scores, key=scores.get, reverse=True)]
+
+
+def get_reranker():
+    """The configured cross-encoder, loaded once; None if disabled or unavailable."""
+    global _reranker, _reranker_loaded
+    if not settings.RERANKER_MODEL:
+        return None
+    with _reranker_lock:
+        if not _reranker_loaded:
+            _reranker_loaded = True
+            try:
+                from sentence_transformers import CrossEncoder
+                _reranker = CrossEncoder(settings.RERANKER_MODEL)
+            except Exception as e:
+                print(f"❌ Reranker {settings.RERANKER_MODEL} unavailable, skipping reranking: {str(e)}")
+        return _reranker
+
+
+def rerank(query, documents, k):
+    """Reorder candidates with the cross-encoder (if any) and keep the top k."""
+    reranker = get_reranker()
+    if reranker is None or len(documents) <= 1:
+        return documents[:k]
+    with stage('rerank'):
+        scores = reranker.predict([(query, doc.page_content) for doc in documents])
+    ranked = sorted(zip(scores, range(len(documents))), reverse=True)
+    return [documents[index] for _, index in ranked[:k]]
+
+
+def scope_to_character(documents, scope, k):
+    """
+    Favour passages that mention the character.
+
+    Returns:
+        list: Documents, best first
+    """
+    if not scope:
+        return documents
+    mentions = [doc for doc in documents if text_key(doc.page_content) in scope.keys]
+    if settings.CHARACTER_SCOPE == 'restrict':
+        # Fill up with other passages if the character is rarely mentioned
+        others = [doc for doc in documents if text_key(doc.page_content) not in scope.keys]
+        return mentions + others[:max(0, k - len(mentions))]
+    return reciprocal_rank_fusion([documents, mentions])
+
+
+def _lexical_index_for(book):
+    if not settings.HYBRID_RETRIEVAL_ENABLED:
+        return None
+    return load_lexical_index(book.vector_store_path)
+
+
+def _character_scope_for(book, character):
+    if character is None or settings.CHARACTER_SCOPE not in ('boost', 'restrict'):
+        return None
+    return character_scope(book, character)
+
+
+def _candidate_count(k, lexical, scope):
+    if lexical is None and scope is None and not settings.RERANKER_MODEL:
+        return k
+    return max(k, settings.HYBRID_CANDIDATES)
+
+
+def _vector_candidate_count(candidates, scope):
+    if scope and settings.CHARACTER_SCOPE == 'restrict':
+        return candidates * RESTRICT_OVERFETCH
+    return candidates
+
+
+def _lexical_search(lexical, query, candidates, scope=None):
+    # In restrict mode only passages mentioning the character are searched
+    positions = scope.positions if scope and settings.CHARACTER_SCOPE == 'restrict' else None
+    with stage('lexical_search'):
+        return [doc for doc, _ in lexical.search(query, k=candidates, positions=positions)]
+
+
+def _select(query, fused, scope, k, candidates):
+    """Apply the character scope to the fused candidates, then rerank them down to k."""
+    fused = scope_to_character(fused, scope, k)
+    return rerank(query, fused[:candidates], k)
+
+
+def retrieve(book, vector_store, query, k=3, character=None):
+    """
+    Find the passages most relevant to a query.
+
+    Args:
+        book: Book the vector store belongs to
+        vector_store: The book's loaded vector store
+        query: User's message string
+        k: Number of passages to return
+        character: Character being asked, to favour passages mentioning them
+
+    Returns:
+        list: Documents, most relevant first
+    """
+    lexical = _lexical_index_for(book)
+    scope = _character_scope_for(book, character)
+    candidates = _candidate_count(k, lexical, scope)
+    vector_candidates = _vector_candidate_count(candidates, scope)
+
+    if lexical is None:
+        fused = vector_store.similarity_search(query, k=vector_candidates)
+    else:
+        lexical_future = _executor.submit(
+            contextvars.copy_context().run, _lexical_search, lexical, query, candidates, scope
+        )
+        vector_docs = vector_store.similarity_search(query, k=vector_candidates)
+        fused = reciprocal_rank_fusion([vector_docs, lexical_future.result()])
+    return _select(query, fused, scope, k, candidates)
+
+
+def _load_indexes(book, character):
+    return _lexical_index_for(book), _character_scope_for(book, character)
+
+
+async def aretrieve(book, vector_store, query, k=3, query_embedding=None, character=None):
+    """Async version of retrieve; reuses query_embedding when given."""
+    lexical, scope = await sync_to_async(_load_indexes, thread_sensitive=False)(book, character)
+    candidates = _candidate_count(k, lexical, scope)
+    vector_candidates = _vector_candidate_count(candidates, scope)
+
+    if query_embedding is not None:
+        vector_search = vector_store.asimilarity_search_by_vector(query_embedding, k=vector_candidates)
+    else:
+        vector_search = vector_store.asimilarity_search(query, k=vector_candidates)
+
+    if lexical is None:
+        fused = await vector_search
+    else:
+        vector_docs, lexical_docs = await asyncio.gather(
+            vector_search,
+            sync_to_async(_lexical_search, thread_sensitive=False)(lexical, query, candidates, scope)
+        )
+        fused = reciprocal_rank_fusion([vector_docs, lexical_docs])
+    return await sync_to_async(_select, thread_sensitive=False)(query, fused, scope, k, candidates)
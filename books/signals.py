@@ -0,0 +1,12 @@
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from .models import Book
+from .unified_index import remove_book
+
+
+@receiver(post_delete, sender=Book)
+def remove_book_from_unified_index(sender, instance, **kwargs):
+    """A deleted book's chunks and segments leave the unified index once the delete commits."""
+    book_id = instance.id
+    transaction.on_commit(lambda: remove_book(book_id))
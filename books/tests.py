@@ -1,3 +1,1320 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from pathlib import Path
+from unittest.mock import patch
+import faiss
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError
+from django.db.models import QuerySet
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from .audio_jobs import audio_jobs
+from .audio_serving import audio_response
+from .benchmarking import FakeChatModel, FakeResponse, HashingEmbeddings
+from .embedding_cache import CachedEmbeddings
+from .character_index import (
+    CharacterScope, build_character_index, character_scope, character_terms, save_character_index, text_key
+)
+from .chunker import iter_chunks
+from .clients import use_clients
+from .compact_store import CompactVectorStore, write_compact_from_faiss, write_compact_store
+from .conversation_memory import abuild_history, aupdate_summary, pack_history
+from .embedding_engine import TokenBucket, embed_chunks, iter_embedded_batches
+from .ingest_queue import claim_next_job, enqueue_book, requeue_stale_jobs, run_job
+from .lexical_index import BM25Index, has_lexical_index, load_lexical_index
+from .models import Book, Character, Conversation, IngestJob, Message
+from . import unified_index
+from .pagination import message_page
+from .rag_processor import build_vector_store, chunk_ids
+from .response_cache import SemanticResponseCache
+from .retrieval import aretrieve, reciprocal_rank_fusion, retrieve
+from .tts_generator import SpeechRequest
+from .tracing import StageHistograms, Trace, stage, trace
+from .turn_store import MessageBuffer, aget_conversation, asave_turn
+from .vector_store_cache import VectorStoreCache, get_vector_store, vector_store_cache
 
-# Create your tests here.
+
+@override_settings(CHAT_PAGE_SIZE=20)
+class ChatPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(
+            title="Pride and Prejudice", author="Jane Austen", description="A novel",
+            text_file='books/pride_and_prejudice.txt', is_processed=True
+        )
+        cls.character = Character.objects.create(
+            book=cls.book, name="Elizabeth Bennet", description="Second daughter",
+            personality_traits="Witty"
+        )
+        for name in ("Jane Bennet", "Mr. Darcy", "Mr. Bingley"):
+            Character.objects.create(book=cls.book, name=name, description="-", personality_traits="-")
+
+    def setUp(self):
+        session = self.client.session
+        session['session_id'] = 'test-session'
+        session.save()
+        self.conversation = Conversation.objects.create(character=self.character, user_session='test-session')
+
+    def add_messages(self, count):
+        # bulk_create stamps every row with the same time, so pages must fall back to ids
+        Message.objects.bulk_create(
+            Message(conversation=self.conversation, role='user' if i % 2 == 0 else 'character', content=f"Message {i}")
+            for i in range(count)
+        )
+
+    def test_chat_renders_only_the_latest_page(self):
+        self.add_messages(45)
+        response = self.client.get(reverse('books:chat', args=[self.character.id]))
+        messages = response.context['messages']
+        self.assertEqual([m.content for m in messages], [f"Message {i}" for i in range(25, 45)])
+        self.assertTrue(response.context['older_cursor'])
+        self.assertContains(response, 'Load older messages')
+
+    def test_chat_queries_do_not_grow_with_the_conversation(self):
+        url = reverse('books:chat', args=[self.character.id])
+        self.add_messages(3)
+        with self.assertNumQueries(4):  # Session, character with book, conversation, messages
+            response = self.client.get(url)
+        self.assertIsNone(response.context['older_cursor'])
+        self.assertNotContains(response, 'Load older messages')
+
+        self.add_messages(200)
+        with self.assertNumQueries(4):
+            self.client.get(url)
+
+    def test_older_messages_pages_back_to_the_first_message(self):
+        self.add_messages(45)
+        response = self.client.get(reverse('books:chat', args=[self.character.id]))
+        cursor = response.context['older_cursor']
+        seen = [m.content for m in response.context['messages']]
+        url = reverse('books:older_messages', args=[self.conversation.id])
+        while cursor:
+            with self.assertNumQueries(3):  # Session, conversation, messages
+                data = self.client.get(url, {'before': cursor}).json()
+            seen = [m['content'] for m in data['messages']] + seen
+            cursor = data['older_cursor']
+        self.assertEqual(seen, [f"Message {i}" for i in range(45)])
+
+    def test_older_messages_rejects_a_bad_cursor(self):
+        url = reverse('books:older_messages', args=[self.conversation.id])
+        self.assertEqual(self.client.get(url, {'before': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_older_messages_are_only_shown_to_the_conversation_owner(self):
+        self.add_messages(45)
+        cursor = self.client.get(reverse('books:chat', args=[self.character.id])).context['older_cursor']
+        other = Conversation.objects.create(character=self.character, user_session='someone-else')
+        url = reverse('books:older_messages', args=[other.id])
+        self.assertEqual(self.client.get(url, {'before': cursor}).status_code, 404)
+        missing = reverse('books:older_messages', args=[other.id + 1])
+        self.assertEqual(self.client.get(missing, {'before': cursor}).status_code, 404)
+
+    def test_book_detail_loads_characters_in_one_query(self):
+        with self.assertNumQueries(2):  # Book, characters
+            response = self.client.get(reverse('books:book_detail', args=[self.book.id]))
+        self.assertEqual(len(response.context['characters']), 4)
+
+
+class TurnStoreTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title="Frankenstein", author="Mary Shelley", description="A novel",
+                                   text_file='books/frankenstein.txt', is_processed=True)
+        character = Character.objects.create(book=book, name="Victor Frankenstein", description="-",
+                                             personality_traits="-")
+        cls.conversation = Conversation.objects.create(character=character, user_session='test-session')
+
+    def test_turn_is_read_and_written_in_two_queries(self):
+        with self.assertNumQueries(2):  # Conversation with character and book, both messages
+            conversation = async_to_sync(aget_conversation)(self.conversation.id)
+            async_to_sync(asave_turn)(conversation, "Who are you?", "A creature of my own making.")
+            self.assertEqual(conversation.character.book.title, "Frankenstein")
+        roles = list(Message.objects.filter(conversation=conversation).order_by('id').values_list('role', flat=True))
+        self.assertEqual(roles, ['user', 'character'])
+
+    @override_settings(MESSAGE_WRITE_BEHIND=True)
+    def test_write_behind_messages_show_until_flushed(self):
+        buffer = MessageBuffer(interval=60, batch_size=100)
+        with patch('books.turn_store.message_buffer', buffer):
+            before = timezone.now()
+            async_to_sync(asave_turn)(self.conversation, "Hello", "Begone, daemon!")
+            queued_at = timezone.now()
+            page, _ = message_page(self.conversation.id)
+            self.assertEqual([m.content for m in page], ["Hello", "Begone, daemon!"])
+            self.assertTrue(all(before <= m.timestamp <= queued_at for m in page))
+            self.assertFalse(Message.objects.exists())
+
+            buffer.flush()
+            page, _ = message_page(self.conversation.id)
+            self.assertEqual([m.content for m in page], ["Hello", "Begone, daemon!"])
+            stored = list(Message.objects.order_by('id').values_list('content', 'timestamp'))
+            self.assertEqual([content for content, _ in stored], ["Hello", "Begone, daemon!"])
+            # Rows keep the time the turn was queued, not the time of the flush
+            self.assertTrue(all(before <= timestamp <= queued_at for _, timestamp in stored))
+
+
+    @override_settings(MESSAGE_WRITE_BEHIND=True)
+    def test_messages_are_kept_when_the_retry_after_an_integrity_error_fails(self):
+        buffer = MessageBuffer(interval=60, batch_size=100)
+        with patch('books.turn_store.message_buffer', buffer):
+            async_to_sync(asave_turn)(self.conversation, "Hello", "Begone, daemon!")
+            with patch.object(buffer, '_insert', side_effect=IntegrityError("CHECK constraint failed")):
+                buffer.flush()
+            self.assertEqual(buffer.stats()['pending'], 2)
+            self.assertEqual(buffer.stats()['dropped'], 0)
+            self.assertFalse(Message.objects.exists())
+
+            buffer.flush()
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)),
+                         ["Hello", "Begone, daemon!"])
+        self.assertEqual(buffer.stats(), {'pending': 0, 'flushed': 2, 'dropped': 0})
+
+
+class SummaryModel:
+    """Chat model that records its prompts and answers with a fixed summary."""
+
+    def __init__(self, error=None):
+        self.prompts = []
+        self.error = error
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        if self.error:
+            raise self.error
+        return FakeResponse("  They discussed Mr. Knightley.\n")
+
+
+@override_settings(HISTORY_SUMMARY_ENABLED=True, HISTORY_SUMMARY_BATCH=2, HISTORY_SUMMARY_WORDS=50)
+class ConversationMemoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title="Emma", author="Jane Austen", description="-", text_file='books/emma.txt')
+        cls.character = Character.objects.create(book=book, name="Emma Woodhouse", description="-",
+                                                 personality_traits="-")
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(character=self.character, user_session='test-session')
+
+    def add_messages(self, *contents):
+        return [
+            Message.objects.create(conversation=self.conversation, role=('user', 'character')[i % 2], content=content)
+            for i, content in enumerate(contents)
+        ]
+
+    def test_newest_messages_are_packed_into_the_budget(self):
+        # 39 characters is 10 estimated tokens
+        messages = [Message(content=str(i) * 39) for i in range(5)]
+        kept, overflow = pack_history(messages, budget=25)
+        self.assertEqual(kept, messages[3:])
+        self.assertEqual(overflow, messages[:3])
+        self.assertEqual(pack_history(messages, budget=50), (messages, []))
+        self.assertEqual(pack_history(messages, budget=9), ([], messages))
+
+    @override_settings(HISTORY_TOKEN_BUDGET=25, HISTORY_MAX_MESSAGES=4)
+    def test_history_starts_after_the_summary_and_keeps_the_newest_turns(self):
+        messages = self.add_messages(*(f"Turn {i}. " + "x" * 31 for i in range(6)))
+        self.conversation.summary = "They met at Hartfield."
+        self.conversation.summary_through = messages[0].id
+
+        history, overflow = async_to_sync(abuild_history)(self.conversation)
+        self.assertEqual(history.splitlines(), [
+            "(Earlier in this conversation: They met at Hartfield.)",
+            "User: Turn 4. " + "x" * 31,
+            "Emma Woodhouse: Turn 5. " + "x" * 31,
+        ])
+        # Only the newest four are loaded; the two that did not fit overflow
+        self.assertEqual(overflow, messages[2:4])
+
+        with override_settings(HISTORY_TOKEN_BUDGET=0):
+            self.assertEqual(async_to_sync(abuild_history)(self.conversation), ('', []))
+
+    def test_overflow_is_folded_into_the_summary(self):
+        messages = self.add_messages("Who is Mr. Knightley?", "A dear old friend.")
+        self.conversation.summary = "They met at Hartfield."
+        model = SummaryModel()
+        with use_clients(chat_model=model):
+            async_to_sync(aupdate_summary)(self.conversation, messages[:1])  # Below the batch size
+            self.assertEqual(model.prompts, [])
+            async_to_sync(aupdate_summary)(self.conversation, messages)
+
+        self.assertIn("Summary so far: They met at Hartfield.", model.prompts[0])
+        self.assertIn("User: Who is Mr. Knightley?\nEmma Woodhouse: A dear old friend.", model.prompts[0])
+        self.assertIn("at most 50 words", model.prompts[0])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, "They discussed Mr. Knightley.")
+        self.assertEqual(self.conversation.summary_through, messages[-1].id)
+
+    def test_a_failed_summary_leaves_the_conversation_unchanged(self):
+        messages = self.add_messages("Who is Mr. Knightley?", "A dear old friend.")
+        with use_clients(chat_model=SummaryModel(error=RuntimeError("503"))):
+            async_to_sync(aupdate_summary)(self.conversation, messages)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summary_through), ('', 0))
+
+
+class IngestQueueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Emma", author="Jane Austen", description="A novel",
+                                       text_file='books/emma.txt')
+
+    def test_a_job_is_claimed_only_once(self):
+        job, created = enqueue_book(self.book)
+        self.assertTrue(created)
+        self.assertEqual(enqueue_book(self.book), (job, False))
+
+        claimed = claim_next_job()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, IngestJob.STATUS_RUNNING)
+        self.assertIsNone(claim_next_job())
+        self.assertEqual(IngestJob.objects.get(id=job.id).attempts, 1)
+
+    def test_a_claim_lost_to_another_worker_moves_on(self):
+        first, _ = enqueue_book(self.book)
+        other_book = Book.objects.create(title="Persuasion", author="Jane Austen", description="-",
+                                         text_file='books/persuasion.txt')
+        second, _ = enqueue_book(other_book)
+        original_update = QuerySet.update
+
+        def update(queryset, **kwargs):
+            # Another worker claims the first job between our read and our UPDATE
+            if not hasattr(update, 'raced'):
+                update.raced = True
+                IngestJob.objects.filter(id=first.id).update(status=IngestJob.STATUS_RUNNING)
+            return original_update(queryset, **kwargs)
+
+        with patch.object(QuerySet, 'update', update):
+            claimed = claim_next_job()
+        self.assertEqual(claimed.id, second.id)
+        self.assertEqual(IngestJob.objects.get(id=first.id).attempts, 0)
+
+    @override_settings(INGEST_STALE_AFTER=60, INGEST_RETRY_DELAY=30)
+    def test_stale_running_jobs_are_requeued_with_backoff(self):
+        job, _ = enqueue_book(self.book)
+        claim_next_job()
+        self.assertEqual(requeue_stale_jobs(), 0)
+
+        IngestJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.STATUS_QUEUED)
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=25))
+        self.assertIn("Worker died", job.error)
+        self.assertIsNone(claim_next_job())  # Not due yet
+
+        IngestJob.objects.filter(id=job.id).update(run_after=timezone.now())
+        reclaimed = claim_next_job()
+        self.assertEqual(reclaimed.id, job.id)
+        self.assertEqual(reclaimed.attempts, 2)
+
+    @override_settings(INGEST_STALE_AFTER=60, INGEST_MAX_ATTEMPTS=2)
+    def test_a_book_that_keeps_killing_its_worker_fails(self):
+        job, _ = enqueue_book(self.book)
+        for _ in range(2):
+            IngestJob.objects.filter(id=job.id).update(run_after=timezone.now())
+            claim_next_job()
+            # The worker dies: the job stays RUNNING and stops making progress
+            IngestJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(minutes=5))
+            requeue_stale_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.STATUS_FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn("Worker died", job.error)
+        self.assertIsNone(claim_next_job())
+
+    @override_settings(INGEST_MAX_ATTEMPTS=2, INGEST_RETRY_DELAY=30)
+    def test_failures_are_retried_with_backoff_then_fail(self):
+        job, _ = enqueue_book(self.book)
+        with patch('books.ingest_queue.build_vector_store', side_effect=RuntimeError("quota exceeded")):
+            self.assertFalse(run_job(claim_next_job()))
+            job.refresh_from_db()
+            self.assertEqual(job.status, IngestJob.STATUS_QUEUED)
+            self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=25))
+            self.assertIsNone(claim_next_job())  # Not due yet
+
+            IngestJob.objects.filter(id=job.id).update(run_after=timezone.now())
+            self.assertFalse(run_job(claim_next_job()))
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.STATUS_FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn("quota exceeded", job.error)
+        self.assertIsNone(claim_next_job())
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.is_processed)
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings: [length, first character code, 0]."""
+
+    model = 'fake-embedding'
+
+    def __init__(self, fail_on=()):
+        self.calls = []
+        self.fail_on = set(fail_on)  # Texts whose batch raises (once each)
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        failing = self.fail_on.intersection(texts)
+        if failing:
+            self.fail_on -= failing
+            raise RuntimeError("429 Resource exhausted")
+        return [[float(len(text)), float(ord(text[0])), 0.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+@override_settings(INGEST_BATCH_SIZE=2, INGEST_MAX_WORKERS=1, EMBEDDING_REQUESTS_PER_MINUTE=6000,
+                   EMBEDDING_MAX_RETRIES=0, EMBEDDING_RETRY_BASE_DELAY=0)
+class EmbeddingEngineTests(TestCase):
+    texts = ["alpha", "bravo", "charlie", "delta", "echo"]
+
+    def setUp(self):
+        self.checkpoint_dir = Path(tempfile.mkdtemp()) / 'checkpoint'
+        self.addCleanup(shutil.rmtree, self.checkpoint_dir.parent)
+
+    def test_token_bucket_waits_for_a_refill_once_empty(self):
+        clock = [100.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        with patch('books.embedding_engine.time.monotonic', lambda: clock[0]), \
+                patch('books.embedding_engine.time.sleep', sleep):
+            bucket = TokenBucket(rate=2, capacity=2)
+            bucket.acquire()
+            bucket.acquire()
+            self.assertEqual(sleeps, [])
+            bucket.acquire()
+        self.assertEqual(sleeps, [0.5])
+
+    def test_interrupted_run_resumes_from_the_checkpoint(self):
+        failing = FakeEmbeddings(fail_on={"echo"})
+        with self.assertRaises(RuntimeError):
+            embed_chunks(self.texts, failing, self.checkpoint_dir)
+        self.assertEqual(len(list(self.checkpoint_dir.glob('batch_*.npy'))), 2)
+
+        resumed = FakeEmbeddings()
+        vectors = embed_chunks(self.texts, resumed, self.checkpoint_dir)
+        self.assertEqual(resumed.calls, [["echo"]])
+        self.assertEqual([list(vector[:2]) for vector in vectors], [[len(t), ord(t[0])] for t in self.texts])
+
+    def test_only_batches_whose_chunks_changed_are_embedded_again(self):
+        embed_chunks(self.texts, FakeEmbeddings(), self.checkpoint_dir)
+        changed = FakeEmbeddings()
+        vectors = embed_chunks(["zulu"] + self.texts[1:], changed, self.checkpoint_dir)
+        self.assertEqual(changed.calls, [["zulu", "bravo"]])
+        self.assertEqual(list(vectors[0][:2]), [4, ord("z")])
+        self.assertEqual(len(list(self.checkpoint_dir.glob('batch_*.npy'))), 3)
+
+    def test_chunks_are_read_only_as_fast_as_they_are_embedded(self):
+        pulled = []
+
+        def chunks():
+            for i in range(100):
+                pulled.append(i)
+                yield f"chunk {i}"
+
+        batches = iter_embedded_batches(chunks(), FakeEmbeddings())
+        texts, vectors = next(batches)
+        batches.close()
+        self.assertEqual(texts, ["chunk 0", "chunk 1"])
+        self.assertEqual(len(vectors), 2)
+        self.assertEqual(len(pulled), 4)  # Two batches in flight for the one worker
+
+    @override_settings(EMBEDDING_MAX_RETRIES=2)
+    def test_failed_batch_is_retried(self):
+        embeddings = FakeEmbeddings(fail_on={"charlie"})
+        vectors = embed_chunks(self.texts, embeddings)
+        self.assertEqual(len(vectors), 5)
+        self.assertEqual([call for call in embeddings.calls if "charlie" in call], [["charlie", "delta"]] * 2)
+
+
+class ChunkerTests(TestCase):
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = directory / 'book.txt'
+
+    def chunks(self, text, **kwargs):
+        self.path.write_text(text, encoding='utf-8')
+        return list(iter_chunks(self.path, **kwargs))
+
+    def test_gutenberg_header_and_footer_are_skipped(self):
+        chunks = self.chunks(
+            "The Project Gutenberg eBook of Emma\n\nRelease date: 1994\n\n"
+            "*** START OF THE PROJECT GUTENBERG EBOOK EMMA ***\n\n"
+            "Emma Woodhouse, handsome, clever, and rich.\n\n"
+            "*** END OF THE PROJECT GUTENBERG EBOOK EMMA ***\n\n"
+            "Section 1. General Terms of Use and Redistributing Project Gutenberg works.\n"
+        )
+        self.assertEqual([chunk.text for chunk in chunks], ["Emma Woodhouse, handsome, clever, and rich."])
+        start = self.path.read_text().index("Emma Woodhouse")
+        self.assertEqual(chunks[0].metadata['start'], start)
+
+    def test_text_without_a_gutenberg_header_is_kept(self):
+        chunks = self.chunks("It is a truth universally acknowledged.\n\nHowever little known.\n")
+        self.assertEqual(chunks[0].text, "It is a truth universally acknowledged.\n\nHowever little known.")
+
+    def test_chapter_headings_start_new_chunks(self):
+        chunks = self.chunks(
+            "CHAPTER I.\n\nMr. Bennet was among the earliest.\n\n"
+            "Chapter 2\n\nMr. Bingley was good-looking.\n\n"
+            "STAVE III: THE SECOND OF THE THREE SPIRITS\n\nAwaking in the middle of a prodigiously tough snore.\n"
+        )
+        self.assertEqual(
+            [(chunk.metadata['chapter'], chunk.metadata['chapter_index'], chunk.text) for chunk in chunks],
+            [
+                ("CHAPTER I.", 1, "Mr. Bennet was among the earliest."),
+                ("Chapter 2", 2, "Mr. Bingley was good-looking."),
+                ("STAVE III: THE SECOND OF THE THREE SPIRITS", 3,
+                 "Awaking in the middle of a prodigiously tough snore."),
+            ]
+        )
+
+    def test_long_chapters_are_split_with_sentence_overlap(self):
+        sentences = [f"Sentence number {i} is here." for i in range(20)]
+        chunks = self.chunks(" ".join(sentences) + "\n", chunk_size=100, chunk_overlap=30)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk.text) <= 100 for chunk in chunks))
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertEqual(chunk.text.split(". ")[0] + ".", previous.text.split(". ")[-1])
+
+
+class EmbeddingCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.fake = FakeEmbeddings()
+        self.cache = CachedEmbeddings(self.fake, 'fake-embedding', Path(directory) / 'cache.sqlite3', 1024 * 1024)
+
+    def test_documents_and_queries_are_cached_separately(self):
+        self.cache.embed_documents(["Who is Mr. Darcy?"])
+        self.cache.embed_query("Who is Mr. Darcy?")
+        self.assertEqual(len(self.fake.calls), 2)
+
+        self.cache.embed_query("Who is Mr. Darcy?")
+        self.cache.embed_documents(["Who is Mr. Darcy?", "Who is Mr. Darcy?"])
+        self.assertEqual(len(self.fake.calls), 2)
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+
+class VectorStoreCacheTests(TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.embeddings = FakeEmbeddings()
+
+    def save_store(self, name, texts):
+        path = self.root / name
+        FAISS.from_texts(texts, self.embeddings).save_local(str(path))
+        return path
+
+    def get(self, cache, book_id, path):
+        return cache.get(book_id, path, lambda: self.embeddings)
+
+    def test_least_recently_used_store_is_evicted_over_the_budget(self):
+        paths = [self.save_store(name, ["alpha", "bravo"]) for name in ("a", "b", "c")]
+        size = sum(f.stat().st_size for f in paths[0].iterdir())
+        cache = VectorStoreCache(max_bytes=2 * size)
+        first = self.get(cache, 1, paths[0])
+        self.get(cache, 2, paths[1])
+        self.assertIs(self.get(cache, 1, paths[0]), first)  # Now most recently used
+        self.get(cache, 3, paths[2])
+
+        self.assertEqual(cache.stats(), {
+            'stores': 2, 'total_bytes': 2 * size, 'max_bytes': 2 * size,
+            'hits': 1, 'misses': 3, 'evictions': 1,
+        })
+        self.assertIs(self.get(cache, 1, paths[0]), first)
+        self.get(cache, 2, paths[1])
+        self.assertEqual(cache.stats()['misses'], 4)  # Book 2 was the one evicted
+
+    def test_a_store_rewritten_on_disk_is_reloaded(self):
+        path = self.save_store("a", ["alpha"])
+        cache = VectorStoreCache(max_bytes=10 ** 6)
+        first = self.get(cache, 1, path)
+        self.assertIs(self.get(cache, 1, path), first)
+
+        FAISS.from_texts(["alpha", "bravo"], self.embeddings).save_local(str(path))
+        index_file = path / "index.faiss"
+        mtime = index_file.stat().st_mtime_ns + 1_000_000_000  # Coarse filesystem clocks
+        os.utime(index_file, ns=(mtime, mtime))
+        reloaded = self.get(cache, 1, path)
+        self.assertIsNot(reloaded, first)
+        self.assertEqual(reloaded.index.ntotal, 2)
+        self.assertEqual(cache.stats()['stores'], 1)
+
+    def test_invalidate_drops_only_that_books_stores(self):
+        cache = VectorStoreCache(max_bytes=10 ** 6)
+        self.get(cache, 1, self.save_store("a", ["alpha"]))
+        self.get(cache, 1, self.save_store("a2", ["alpha", "bravo"]))
+        kept = self.get(cache, 2, self.save_store("b", ["bravo"]))
+        cache.invalidate(1)
+        self.assertEqual(cache.stats()['stores'], 1)
+        self.assertEqual(cache.stats()['total_bytes'], sum(f.stat().st_size for f in (self.root / "b").iterdir()))
+        self.assertIs(self.get(cache, 2, self.root / "b"), kept)
+
+    def test_memory_mapped_compact_stores_do_not_count_against_the_budget(self):
+        documents = [Document(page_content=text, id=text) for text in ("alpha", "bravo")]
+        write_compact_store(self.root / "compact", documents, self.embeddings.embed_documents(["alpha", "bravo"]))
+        cache = VectorStoreCache(max_bytes=1)
+        self.assertIsInstance(self.get(cache, 1, self.root / "compact"), CompactVectorStore)
+        self.assertEqual(cache.stats()['total_bytes'], 0)
+
+
+class CompactStoreTests(TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.embeddings = HashingEmbeddings(size=64)
+        words = ("garden letter ball carriage sister rain portrait estate officer dinner parish walk "
+                 "fortune pride marriage cousin sermon piano fever visit").split()
+        rng = random.Random(7)
+        texts = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 12))) for _ in range(50)]
+        metadatas = [{'chapter': i} for i in range(50)]
+        self.flat = FAISS.from_texts(texts, self.embeddings, metadatas=metadatas, ids=[f"c{i}" for i in range(50)])
+        # Their top three are far enough apart that 8-bit quantization can't reorder them
+        self.queries = ["a letter about the ball", "rain on the estate", "the officer at dinner"]
+
+    def convert(self):
+        write_compact_from_faiss(self.root / "compact", self.flat)
+        return CompactVectorStore.load_local(str(self.root / "compact"), self.embeddings)
+
+    def assertSameResults(self, compact):
+        for query in self.queries:
+            expected = self.flat.similarity_search_with_score(query, k=3)
+            vector = self.embeddings.embed_query(query)
+            results = compact.similarity_search_with_score_by_vector(vector, k=3)
+            self.assertEqual([doc for doc, _ in results], [doc for doc, _ in expected])
+            for (_, score), (_, flat_score) in zip(results, expected):
+                self.assertAlmostEqual(score, flat_score, places=2)  # 8-bit quantized vectors
+
+            docs = [doc for doc, _ in expected]
+            self.assertEqual(compact.similarity_search(query, k=3), docs)
+            self.assertEqual(async_to_sync(compact.asimilarity_search)(query, k=3), docs)
+            self.assertEqual(async_to_sync(compact.asimilarity_search_by_vector)(vector, k=3), docs)
+
+    def index_type(self):
+        return json.loads((self.root / "compact" / "format.json").read_text())['index']
+
+    @override_settings(COMPACT_INDEX_FACTORY='', COMPACT_IVF_MIN_VECTORS=51)
+    def test_small_books_round_trip_through_a_flat_sq8_index(self):
+        compact = self.convert()
+        self.assertEqual(self.index_type(), "SQ8")
+        self.assertEqual(len(compact), 50)
+        self.assertEqual(compact.get_document(7), Document(
+            page_content=self.flat.docstore.search("c7").page_content, metadata={'chapter': 7}, id="c7"
+        ))
+        self.assertSameResults(compact)
+
+    @override_settings(COMPACT_INDEX_FACTORY='', COMPACT_IVF_MIN_VECTORS=50, COMPACT_IVF_NPROBE=64)
+    def test_books_at_the_threshold_use_an_ivf_index(self):
+        compact = self.convert()
+        self.assertEqual(self.index_type(), "IVF28,SQ8")  # About 4 * sqrt(50) lists
+        self.assertIsInstance(compact.index, faiss.IndexIVF)
+        self.assertEqual(compact.index.nprobe, 64)
+        self.assertSameResults(compact)  # Probing every list makes the search exhaustive
+
+    @override_settings(COMPACT_INDEX_FACTORY='Flat', COMPACT_IVF_MIN_VECTORS=1)
+    def test_an_explicit_index_factory_wins(self):
+        compact = self.convert()
+        self.assertEqual(self.index_type(), "Flat")
+        self.assertSameResults(compact)
+
+
+class CharacterIndexTests(TestCase):
+    texts = [
+        "Mr. Darcy danced with nobody.",
+        "Elizabeth laughed at Darcy's pride.",
+        "Lizzy walked to Netherfield.",
+        "Mr. Bingley admired Jane.",
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Pride and Prejudice", author="Jane Austen", description="-",
+                                       text_file='books/pride_and_prejudice.txt')
+        cls.darcy = Character.objects.create(book=cls.book, name="Mr.  Fitzwilliam Darcy", description="-",
+                                             personality_traits="-")
+        cls.elizabeth = Character.objects.create(book=cls.book, name="Elizabeth Bennet", description="-",
+                                                 personality_traits="-", aliases="Lizzy, Eliza,")
+
+    def test_terms_are_the_name_and_its_significant_words_or_the_aliases(self):
+        self.assertEqual(character_terms(self.darcy), ["Darcy", "Fitzwilliam", "Mr. Fitzwilliam Darcy"])
+        # Aliases replace the single words, so "Bennet" alone doesn't match her sisters
+        self.assertEqual(character_terms(self.elizabeth), ["Eliza", "Elizabeth Bennet", "Lizzy"])
+
+    def test_index_lists_the_chunks_mentioning_each_character(self):
+        index = build_character_index([self.darcy, self.elizabeth], self.texts)
+        self.assertEqual(index['chunks'], {str(self.darcy.id): [0, 1], str(self.elizabeth.id): [2]})
+        self.assertEqual(index['terms'][str(self.elizabeth.id)], ["Eliza", "Elizabeth Bennet", "Lizzy"])
+
+    def test_scope_is_loaded_until_the_characters_names_change(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.assertIsNone(character_scope(self.book, self.darcy))  # No store yet
+        self.book.vector_store_path = directory
+        self.assertIsNone(character_scope(self.book, self.darcy))  # No character index
+        BM25Index.build(self.texts).save(directory)
+        save_character_index(directory, [self.darcy], self.texts)
+
+        scope = character_scope(self.book, self.darcy)
+        self.assertEqual(scope.positions, frozenset({0, 1}))
+        self.assertEqual(scope.keys, frozenset(chunk_ids(self.texts[:2])))  # Same hash as the chunk ids
+        self.assertIsNone(character_scope(self.book, self.elizabeth))  # Not indexed
+
+        self.darcy.aliases = "Darcy"
+        self.assertIsNone(character_scope(self.book, self.darcy))  # Terms changed: index is stale
+
+
+class LexicalIndexTests(TestCase):
+    texts = ["Mr. Collins proposed.", "Collins, Collins again!", "Elizabeth refused him."]
+
+    def setUp(self):
+        self.index = BM25Index.build(self.texts, [{'chapter': i} for i in range(3)], ['a', 'b', 'c'])
+
+    def test_scores_follow_bm25(self):
+        results = self.index.search("What did Mr. Collins say?", k=3)
+        self.assertEqual([doc.id for doc, _ in results], ['a', 'b'])  # Stopwords and unknown terms are ignored
+
+        # Lengths are 3, 3 and 2 tokens; "collins" is in two of the three chunks
+        idf = math.log(1 + 1.5 / 2.5)
+        norm = 1.5 * (0.25 + 0.75 * 3 / (8 / 3))
+        collins = [idf * 1 * 2.5 / (1 + norm), idf * 2 * 2.5 / (2 + norm)]
+        mr = math.log(1 + 2.5 / 1.5) * 2.5 / (1 + norm)
+        self.assertAlmostEqual(results[0][1], collins[0] + mr)
+        self.assertAlmostEqual(results[1][1], collins[1])
+
+        only_b = self.index.search("Collins", k=3, positions={1, 2})
+        self.assertEqual([(doc.id, doc.metadata) for doc, _ in only_b], [('b', {'chapter': 1})])
+        self.assertAlmostEqual(only_b[0][1], collins[1])
+
+    def test_ties_are_returned_in_book_order(self):
+        index = BM25Index.build(["Emma smiled", "Emma laughed", "Harriet smiled", "Emma wept"])
+        self.assertEqual([doc.page_content for doc, _ in index.search("emma", k=2)], ["Emma smiled", "Emma laughed"])
+
+    def test_index_round_trips_through_disk(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.assertFalse(has_lexical_index(directory))
+        self.assertIsNone(load_lexical_index(directory))
+        self.index.save(directory)
+
+        loaded = load_lexical_index(directory)
+        self.assertIs(load_lexical_index(directory), loaded)  # Cached until the file changes
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded.search("collins refused", k=3), self.index.search("collins refused", k=3))
+
+        BM25Index.build(["Mr. Darcy"]).save(directory)
+        index_file = Path(directory) / "bm25.json"
+        mtime = index_file.stat().st_mtime_ns + 1_000_000_000
+        os.utime(index_file, ns=(mtime, mtime))
+        self.assertEqual(len(load_lexical_index(directory)), 1)
+
+
+class ResponseCacheTests(TestCase):
+    def test_only_similar_enough_questions_hit(self):
+        cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=10)
+        cache.store(1, [1.0, 0.0], "I am Mr. Darcy.")
+        self.assertEqual(cache.lookup(1, [0.99, 0.05]).response, "I am Mr. Darcy.")
+        self.assertIsNone(cache.lookup(1, [0.7, 0.7]))
+        self.assertIsNone(cache.lookup(2, [1.0, 0.0]))  # Another character
+        self.assertEqual(cache.stats()[1], {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'entries': 1})
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=10)
+        with patch('books.response_cache.time.monotonic', return_value=1000.0):
+            cache.store(1, [1.0, 0.0], "I am Mr. Darcy.")
+        with patch('books.response_cache.time.monotonic', return_value=1059.0):
+            self.assertIsNotNone(cache.lookup(1, [1.0, 0.0]))
+        with patch('books.response_cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(cache.lookup(1, [1.0, 0.0]))
+        self.assertEqual(cache.stats()[1]['entries'], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=2)
+        cache.store(1, [1.0, 0.0, 0.0], "first")
+        cache.store(1, [0.0, 1.0, 0.0], "second")
+        cache.lookup(1, [1.0, 0.0, 0.0])
+        cache.store(1, [0.0, 0.0, 1.0], "third")
+        self.assertEqual(cache.lookup(1, [1.0, 0.0, 0.0]).response, "first")
+        self.assertIsNone(cache.lookup(1, [0.0, 1.0, 0.0]))
+
+    @override_settings(RESPONSE_CACHE_ENABLED=True, TTS_BACKGROUND_JOBS=False, HISTORY_SUMMARY_ENABLED=False)
+    def test_follow_ups_bypass_the_cache(self):
+        book = Book.objects.create(title="Emma", author="Jane Austen", description="-",
+                                   text_file='books/emma.txt', is_processed=True)
+        character = Character.objects.create(book=book, name="Emma Woodhouse", description="-",
+                                             personality_traits="-")
+        conversation = Conversation.objects.create(character=character, user_session='test-session')
+        cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=10)
+        embeddings = FakeEmbeddings()
+        embeddings.aembed_query = lambda text: asyncio.sleep(0, [1.0, 0.0])
+        cache.store(character.id, [1.0, 0.0], "Cached reply about Mr. Knightley.", audio_url="/audio/knightley.mp3")
+        url = reverse('books:send_message', args=[conversation.id])
+
+        with patch('books.response_cache.response_cache', cache), \
+                patch('books.response_cache.get_embeddings', return_value=embeddings), \
+                patch('books.views._aspeak', return_value=(None, [])), \
+                patch('books.views.aquery_character', return_value="A fresh reply.") as query:
+            first = self.client.post(url, {'message': "Tell me more"}).json()
+            self.assertEqual(first['character_response'], "Cached reply about Mr. Knightley.")
+            query.assert_not_called()
+
+            second = self.client.post(url, {'message': "Tell me more"}).json()
+        self.assertEqual(second['character_response'], "A fresh reply.")
+        self.assertEqual(cache.stats()[character.id]['entries'], 1)
+
+
+def sse_events(body):
+    """(event, data) pairs of a Server-Sent Events body."""
+    events = []
+    for block in body.decode().strip().split('\n\n'):
+        event, data = block.split('\n')
+        events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+    return events
+
+
+async def stream_body(client, url, data):
+    response = await client.post(url, data)
+    return response, b''.join([part async for part in response.streaming_content])
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=True, TTS_BACKGROUND_JOBS=False, HISTORY_SUMMARY_ENABLED=False)
+class TracingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title="Emma", author="Jane Austen", description="-",
+                                   text_file='books/emma.txt', is_processed=True)
+        cls.character = Character.objects.create(book=book, name="Emma Woodhouse", description="-",
+                                                 personality_traits="-")
+        cls.conversation = Conversation.objects.create(character=cls.character, user_session='test-session')
+
+    def setUp(self):
+        self.histograms = StageHistograms(buckets=(0.1, 1.0))
+        patcher = patch('books.tracing.histograms', self.histograms)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_histogram_buckets_are_cumulative(self):
+        self.histograms.observe('retrieval', 'Mr. "Knightley"', 0.05)
+        self.histograms.observe('retrieval', 'Mr. "Knightley"', 0.5)
+        self.histograms.observe('retrieval', 'Mr. "Knightley"', 5.0)
+        lines = self.histograms.render().splitlines()
+        labels = 'stage="retrieval",character="Mr. \\"Knightley\\""'
+        self.assertIn(f'literarychat_stage_duration_seconds_bucket{{{labels},le="0.1"}} 1', lines)
+        self.assertIn(f'literarychat_stage_duration_seconds_bucket{{{labels},le="1.0"}} 2', lines)
+        self.assertIn(f'literarychat_stage_duration_seconds_bucket{{{labels},le="+Inf"}} 3', lines)
+        self.assertIn(f'literarychat_stage_duration_seconds_sum{{{labels}}} 5.55', lines)
+        self.assertIn(f'literarychat_stage_duration_seconds_count{{{labels}}} 3', lines)
+
+    def test_stages_are_recorded_on_the_trace_with_its_final_character(self):
+        with self.assertLogs('books.tracing', 'INFO') as logs:
+            with trace('send_message') as turn:
+                with stage('retrieval'):
+                    pass
+                turn.set_character(self.character)
+        self.assertEqual([name for name, _ in turn.stages], ['retrieval'])
+        self.assertRegex(turn.server_timing(), r"^retrieval;dur=\d+\.\d, total;dur=\d+\.\d$")
+        logged = json.loads(logs.records[0].getMessage())
+        self.assertEqual((logged['trace'], logged['character']), ('send_message', "Emma Woodhouse"))
+        self.assertIn('character="Emma Woodhouse"', self.histograms.render())
+        self.assertNotIn('character=""', self.histograms.render())
+
+    def test_stages_outside_a_trace_are_unlabelled(self):
+        with stage('tts'):
+            pass
+        self.assertIn('stage="tts",character=""', self.histograms.render())
+        self.assertIsNone(Trace('x').total)
+
+    def cached_reply(self):
+        cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=10)
+        cache.store(self.character.id, [1.0, 0.0], "Cached reply.", audio_url="/audio/a.mp3")
+        embeddings = FakeEmbeddings()
+        embeddings.aembed_query = lambda text: asyncio.sleep(0, [1.0, 0.0])
+        return patch('books.response_cache.response_cache', cache), \
+            patch('books.response_cache.get_embeddings', return_value=embeddings)
+
+    def test_send_message_returns_server_timing(self):
+        cache_patch, embeddings_patch = self.cached_reply()
+        with cache_patch, embeddings_patch:
+            response = self.client.post(reverse('books:send_message', args=[self.conversation.id]),
+                                        {'message': "Who are you?"})
+        self.assertRegex(response['Server-Timing'], r"(^|, )response_cache;dur=")
+        self.assertRegex(response['Server-Timing'], r", total;dur=[\d.]+$")
+
+    def test_stream_message_is_traced_and_sends_its_timings(self):
+        cache_patch, embeddings_patch = self.cached_reply()
+        url = reverse('books:stream_message', args=[self.conversation.id])
+        with cache_patch, embeddings_patch, self.assertLogs('books.tracing', 'INFO') as logs:
+            _, body = async_to_sync(stream_body)(self.async_client, url, {'message': "Who are you?"})
+        done = dict(sse_events(body))['done']
+        self.assertRegex(done['server_timing'], r"(^|, )response_cache;dur=.*, total;dur=")
+        logged = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((logged['trace'], logged['character']), ('stream_message', "Emma Woodhouse"))
+        self.assertIn('db_write', [entry['stage'] for entry in logged['stages']])
+        self.assertNotIn('character=""', self.histograms.render())
+
+    def test_metrics_endpoint(self):
+        self.histograms.observe('generation', "Emma Woodhouse", 0.5)
+        with patch('books.views.histograms', self.histograms):
+            with override_settings(METRICS_ENABLED=False):
+                self.assertEqual(self.client.get(reverse('books:metrics')).status_code, 404)
+            with override_settings(METRICS_ENABLED=True):
+                response = self.client.get(reverse('books:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertContains(response, "# TYPE literarychat_stage_duration_seconds histogram")
+        self.assertContains(
+            response, 'literarychat_stage_duration_seconds_count{stage="generation",character="Emma Woodhouse"} 1'
+        )
+
+
+@override_settings(INGEST_BATCH_SIZE=2, UNIFIED_INDEX_ENABLED=False, VECTOR_STORE_FORMAT='faiss')
+class IncrementalIndexingTests(TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        overrides = override_settings(MEDIA_ROOT=self.root, BASE_DIR=self.root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        (self.root / 'books').mkdir()
+        self.book = Book.objects.create(title="Middlemarch", author="George Eliot", description="-",
+                                        text_file='books/middlemarch.txt')
+        self.embeddings = FakeEmbeddings()
+        patcher = patch('books.rag_processor.get_embeddings', return_value=self.embeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_book(self, paragraphs):
+        (self.root / 'books' / 'middlemarch.txt').write_text('\n\n'.join(paragraphs))
+
+    def build(self):
+        self.embeddings.calls.clear()
+        self.book.vector_store_path = build_vector_store(self.book)
+        self.book.save()
+        return sum(len(call) for call in self.embeddings.calls)
+
+    def versions(self):
+        return sorted(path.name for path in (self.root / 'vector_stores').glob(f"book_{self.book.id}_v*"))
+
+    def test_only_changed_chunks_are_embedded(self):
+        paragraphs = [f"Paragraph {i} of the provincial life. " * 12 for i in range(12)]
+        self.write_book(paragraphs)
+        total = self.build()
+        self.assertGreater(total, 5)
+        self.assertTrue(all(len(call) <= 2 for call in self.embeddings.calls))
+        first_version = self.book.vector_store_path
+
+        self.assertEqual(self.build(), 0)  # Unchanged book: nothing embedded, no new version
+        self.assertEqual(self.book.vector_store_path, first_version)
+
+        paragraphs[5] = "Dorothea changed her mind entirely. " * 12
+        self.write_book(paragraphs)
+        changed = self.build()
+        self.assertTrue(0 < changed < total)
+        store = FAISS.load_local(self.book.vector_store_path, self.embeddings, allow_dangerous_deserialization=True)
+        self.assertEqual(store.index.ntotal, total)
+        texts = [doc.page_content for doc in store.docstore._dict.values()]
+        self.assertTrue(any("Dorothea" in text for text in texts))
+        self.assertFalse(any("Paragraph 5 " in text for text in texts))
+
+        # The version in use and the one before it are kept, older ones removed
+        paragraphs[6] = "Lydgate arrived in town. " * 12
+        self.write_book(paragraphs)
+        previous_version = self.book.vector_store_path
+        self.build()
+        self.assertEqual(self.versions(), sorted([Path(previous_version).name, Path(self.book.vector_store_path).name]))
+        self.assertNotIn(Path(first_version).name, self.versions())
+
+    def test_an_empty_book_is_rejected(self):
+        self.write_book([])
+        with self.assertRaisesMessage(ValueError, "no text"):
+            build_vector_store(self.book)
+
+
+@override_settings(TTS_SENTENCE_CHUNKING=False)
+class AudioJobTests(TestCase):
+    def setUp(self):
+        self.character = Character(book=Book(title="Emma", author="Jane Austen"), name="Emma Woodhouse")
+
+    def test_a_failed_job_reports_an_error_instead_of_raising(self):
+        with patch('books.audio_jobs.generate_speech_audio', side_effect=RuntimeError("TTS quota exceeded")):
+            job = audio_jobs.start("A job that is doomed to fail.", self.character)
+            response = self.client.get(reverse('books:audio_job', args=[job.id]), {'wait': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {'audio_job': job.id, 'status': 'error', 'audio_url': None, 'audio_playlist': []}
+        )
+
+    def stream(self, reply):
+        character = Character.objects.create(
+            book=Book.objects.create(title="Emma", author="Jane Austen", description="-", text_file='books/emma.txt'),
+            name="Emma Woodhouse", description="-", personality_traits="-"
+        )
+        conversation = Conversation.objects.create(character=character, user_session='test-session')
+
+        async def astream_character(*args, **kwargs):
+            yield reply
+
+        url = reverse('books:stream_message', args=[conversation.id])
+        with patch('books.views.astream_character', astream_character):
+            _, body = async_to_sync(stream_body)(self.async_client, url, {'message': "Hello"})
+        return sse_events(body)
+
+    @override_settings(TTS_BACKGROUND_JOBS=True, AUDIO_JOB_MAX_WAIT=0.05, RESPONSE_CACHE_ENABLED=False,
+                       HISTORY_SUMMARY_ENABLED=False)
+    def test_audio_still_pending_when_the_stream_ends_is_reported(self):
+        release = threading.Event()
+
+        def slow_synthesis(text, character):
+            release.wait(5)
+            return 'media/tts_cache/slow.mp3'
+
+        with patch('books.audio_jobs.generate_speech_audio', slow_synthesis):
+            events = self.stream("A reply whose audio takes its time.")
+            job_id = events[-2][1]['audio_job']
+            self.assertEqual([event for event, _ in events], ['token', 'done', 'audio_status'])
+            self.assertEqual(events[-1][1], {'audio_job': job_id, 'status': 'pending'})
+
+            release.set()
+            job = self.client.get(reverse('books:audio_job', args=[job_id]), {'wait': 5}).json()
+        self.assertEqual((job['status'], job['audio_playlist']), ('done', ['media/tts_cache/slow.mp3']))
+
+    @override_settings(TTS_BACKGROUND_JOBS=True, RESPONSE_CACHE_ENABLED=False, HISTORY_SUMMARY_ENABLED=False)
+    def test_an_expired_job_ends_the_stream_with_an_error_status(self):
+        with patch('books.audio_jobs.generate_speech_audio', return_value=None), \
+                patch.object(audio_jobs, 'get', return_value=None):
+            events = self.stream("A reply whose job vanished.")
+        self.assertEqual(events[-1], ('audio_status', {'audio_job': events[-2][1]['audio_job'], 'status': 'error'}))
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=True, TTS_BACKGROUND_JOBS=True, TTS_SENTENCE_CHUNKING=False,
+                   HISTORY_SUMMARY_ENABLED=False, HYBRID_RETRIEVAL_ENABLED=False, CHARACTER_SCOPE='off',
+                   RERANKER_MODEL='', AUDIO_JOB_MAX_WAIT=5)
+class StreamMessageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        book = Book.objects.create(title="Emma", author="Jane Austen", description="-",
+                                   text_file='books/emma.txt', is_processed=True)
+        cls.character = Character.objects.create(book=book, name="Emma Woodhouse", description="-",
+                                                 personality_traits="-")
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(character=self.character, user_session='test-session')
+        self.cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=10)
+        self.embeddings = HashingEmbeddings()
+        self.model = FakeChatModel()
+        store = FakeVectorStore([Document(page_content="Emma Woodhouse, handsome, clever, and rich")])
+        self.enterContext(use_clients(embeddings=self.embeddings, chat_model=self.model))
+        self.enterContext(patch('books.response_cache.response_cache', self.cache))
+        self.enterContext(patch('books.rag_query.get_vector_store', return_value=store))
+        self.enterContext(patch('books.audio_jobs.generate_speech_audio', return_value='media/tts_cache/reply.mp3'))
+
+    def stream(self, message):
+        url = reverse('books:stream_message', args=[self.conversation.id])
+        response, body = async_to_sync(stream_body)(self.async_client, url, {'message': message})
+        return response, sse_events(body)
+
+    def test_tokens_then_done_then_audio(self):
+        response, events = self.stream("Who are you?")
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(response['X-Accel-Buffering'], 'no')
+
+        names = [event for event, _ in events]
+        tokens = names.count('token')
+        self.assertGreater(tokens, 1)
+        self.assertEqual(names, ['token'] * tokens + ['done', 'audio', 'audio_status'])
+        reply = ''.join(data['text'] for _, data in events[:tokens])
+        self.assertTrue(reply.startswith("I must say, that is a question"))
+
+        done, audio, status = (data for _, data in events[tokens:])
+        self.assertEqual(done['character_response'], reply)
+        self.assertEqual((done['audio_url'], done['audio_playlist']), (None, []))
+        self.assertEqual(audio, {'audio_url': 'media/tts_cache/reply.mp3'})
+        self.assertEqual(status, {'audio_job': done['audio_job'], 'status': 'done'})
+        self.assertEqual(
+            list(self.conversation.messages.order_by('id').values_list('role', 'content')),
+            [('user', "Who are you?"), ('character', reply)]
+        )
+
+    def test_a_cached_reply_is_sent_as_one_token_with_its_audio(self):
+        self.cache.store(self.character.id, self.embeddings.embed_query("Who are you?"), "Cached reply.",
+                         audio_url='media/tts_cache/cached.mp3')
+        with patch.object(self.model, 'astream') as astream:
+            _, events = self.stream("Who are you?")
+        astream.assert_not_called()
+        self.assertEqual([event for event, _ in events], ['token', 'done'])
+        self.assertEqual(events[0][1], {'text': "Cached reply."})
+        done = events[1][1]
+        self.assertEqual(done['character_response'], "Cached reply.")
+        self.assertEqual(done['audio_playlist'], ['media/tts_cache/cached.mp3'])
+        self.assertIsNone(done['audio_job'])
+
+    def test_follow_ups_bypass_the_cache(self):
+        self.cache.store(self.character.id, self.embeddings.embed_query("Tell me more"), "Cached reply.",
+                         audio_url='media/tts_cache/cached.mp3')
+        Message.objects.create(conversation=self.conversation, role='user', content="Who is Mr. Knightley?")
+        Message.objects.create(conversation=self.conversation, role='character', content="A dear old friend.")
+
+        _, events = self.stream("Tell me more")
+        done = dict(events)['done']
+        self.assertTrue(done['character_response'].startswith("I must say"))
+        self.assertIsNotNone(done['audio_job'])
+        self.assertEqual(self.cache.stats()[self.character.id]['entries'], 1)
+
+
+@override_settings(AUDIO_X_ACCEL_REDIRECT='')
+class AudioServingTests(TestCase):
+    content = bytes(range(100))
+
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = directory / f"{'a' * 64}.mp3"
+        self.path.write_bytes(self.content)
+        self.etag = self.get()[0]['ETag']
+
+    def get(self, **headers):
+        response = audio_response(RequestFactory().get('/', **headers), self.path)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_whole_file_with_cache_headers(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'audio/mpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_byte_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[:10])
+        self.assertEqual(response['Content-Range'], 'bytes 0-9/100')
+
+    def test_suffix_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.content[-10:])
+        self.assertEqual(response['Content-Range'], 'bytes 90-99/100')
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_invalid_range_is_ignored(self):
+        response, body = self.get(HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+        response, body = self.get(HTTP_RANGE='bytes=90-200')  # Valid, clamped to the file
+        self.assertEqual((response.status_code, response['Content-Range']), (206, 'bytes 90-99/100'))
+        self.assertEqual(self.get(HTTP_RANGE='bytes=-0')[0].status_code, 416)
+
+    def test_stale_if_range_gets_the_whole_file(self):
+        response, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.content)
+
+        response, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_matching_if_none_match_is_not_modified(self):
+        response, body = self.get(HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(response['ETag'], self.etag)
+
+    def test_if_none_match_lists_weak_tags_and_wildcard(self):
+        for header in ('*', f'W/{self.etag}', f'"other", {self.etag}', f'"other",W/{self.etag}'):
+            with self.subTest(header=header):
+                self.assertEqual(self.get(HTTP_IF_NONE_MATCH=header)[0].status_code, 304)
+        for header in ('"other"', 'W/"other", "another"', self.etag.strip('"')):
+            with self.subTest(header=header):
+                self.assertEqual(self.get(HTTP_IF_NONE_MATCH=header)[0].status_code, 200)
+
+    def test_encodings_get_their_own_cache_entries(self):
+        mp3 = SpeechRequest("Good morning.", 'en-GB-Neural2-A', 1.0, 0.0, 'MP3')
+        opus = mp3._replace(encoding='OGG_OPUS')
+        self.assertNotEqual(mp3.key, opus.key)
+        self.assertTrue(mp3.filename.endswith('.mp3'))
+        self.assertTrue(opus.filename.endswith('.ogg'))
+
+
+class FakeVectorStore:
+    """Returns its documents in order, recording the k of each search."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.searches = []
+
+    def similarity_search(self, query, k=4):
+        self.searches.append(k)
+        return self.documents[:k]
+
+    async def asimilarity_search(self, query, k=4):
+        return self.similarity_search(query, k)
+
+    async def asimilarity_search_by_vector(self, embedding, k=4):
+        return self.similarity_search(None, k)
+
+
+class ReverseReranker:
+    """Scores later candidates higher, so reranking reverses the order."""
+
+    def predict(self, pairs):
+        return list(range(len(pairs)))
+
+
+@override_settings(HYBRID_RETRIEVAL_ENABLED=False, HYBRID_CANDIDATES=5)
+class RetrievalTests(TestCase):
+    def setUp(self):
+        self.documents = [Document(page_content=f"Passage {i}") for i in range(40)]
+        self.book = Book(title="Emma", author="Jane Austen")
+        self.character = Character(book=self.book, name="Emma Woodhouse")
+
+    def both(self, query="Who is Emma?", **kwargs):
+        sync_store, async_store = FakeVectorStore(self.documents), FakeVectorStore(self.documents)
+        sync_docs = retrieve(self.book, sync_store, query, k=3, **kwargs)
+        async_docs = async_to_sync(aretrieve)(self.book, async_store, query, k=3, **kwargs)
+        self.assertEqual(sync_store.searches, async_store.searches)
+        self.assertEqual(sync_docs, async_docs)
+        return sync_docs, sync_store.searches
+
+    def test_rank_fusion_favours_passages_both_searches_found(self):
+        a, b, c, d = (Document(page_content=text) for text in "ABCD")
+        same_text = Document(page_content="C", id="other-format-id")
+        fused = reciprocal_rank_fusion([[a, b, c], [same_text, d]])
+        # C: 1/63 + 1/61; A: 1/61; B and D tie on 1/62 and keep first-seen order
+        self.assertEqual([doc.page_content for doc in fused], ["C", "A", "B", "D"])
+        self.assertIs(fused[0], c)
+        self.assertEqual(reciprocal_rank_fusion([[a, b], [b, a]]), [a, b])  # Exact tie
+
+    @override_settings(HYBRID_RETRIEVAL_ENABLED=True, RERANKER_MODEL='')
+    def test_hybrid_results_are_fused_in_both_paths(self):
+        lexical = BM25Index.build([doc.page_content for doc in self.documents])
+        with patch('books.retrieval._lexical_index_for', return_value=lexical):
+            docs, searches = self.both(query="Passage 30 or passage 2")
+        self.assertEqual(searches, [5])
+        # Vector: 0 1 2 3 4; lexical: 2 30 0 1 3 (ties in book order). Passages 0 and 2
+        # tie on 1/61 + 1/63, and 0 was seen first
+        self.assertEqual([doc.page_content for doc in docs], ["Passage 0", "Passage 2", "Passage 1"])
+
+    @override_settings(RERANKER_MODEL='fake-reranker')
+    def test_vector_only_results_are_reranked_in_both_paths(self):
+        with patch('books.retrieval.get_reranker', return_value=ReverseReranker()):
+            docs, searches = self.both()
+        self.assertEqual(searches, [5])
+        self.assertEqual([doc.page_content for doc in docs], ["Passage 4", "Passage 3", "Passage 2"])
+
+    @override_settings(CHARACTER_SCOPE='restrict')
+    def test_restrict_scope_over_fetches_vector_candidates(self):
+        mentioned = {text_key(f"Passage {i}") for i in (7, 12, 18)}
+        scope = CharacterScope(keys=frozenset(mentioned), positions=frozenset({7, 12, 18}))
+        with patch('books.retrieval._character_scope_for', return_value=scope):
+            docs, searches = self.both(character=self.character)
+        self.assertEqual(searches, [20])
+        self.assertEqual([doc.page_content for doc in docs], ["Passage 7", "Passage 12", "Passage 18"])
+
+
+class UnifiedIndexTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        overrides = override_settings(UNIFIED_INDEX_ENABLED=True, UNIFIED_INDEX_DIR=Path(directory) / 'unified')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.segments = Path(directory) / 'unified' / 'segments'
+
+    def test_books_are_searched_separately_and_replaced_in_place(self):
+        unified_index.add_book(1, ["Emma", "Harriet"], [[1.0, 0.0], [0.0, 1.0]])
+        unified_index.add_book(2, ["Anne"], [[1.0, 0.0]])
+        index = unified_index.get_unified_index()
+        self.assertEqual([doc.page_content for doc, _ in index.search(1, [0.9, 0.1], k=5)], ["Emma", "Harriet"])
+        self.assertEqual([doc.page_content for doc, _ in index.search(2, [0.0, 1.0], k=5)], ["Anne"])
+
+        for text in ("Mr. Knightley", "Mr. Elton", "Mr. Weston"):
+            unified_index.add_book(1, [text], [[0.0, 1.0]])
+        self.assertEqual([doc.page_content for doc, _ in index.search(1, [1.0, 0.0], k=5)], ["Mr. Weston"])
+        self.assertEqual(len(list(self.segments.glob('book_1_v*.faiss'))), 2)  # Current and previous
+        self.assertEqual([doc.page_content for doc, _ in index.search(2, [0.0, 1.0], k=5)], ["Anne"])
+
+    @override_settings(UNIFIED_INDEX_OPEN_SEGMENTS=2)
+    def test_only_recently_searched_segments_stay_open(self):
+        for book_id in (1, 2, 3):
+            unified_index.add_book(book_id, [f"Book {book_id}"], [[1.0, 0.0]])
+        index = unified_index.get_unified_index()
+        for book_id in (1, 2, 3, 1):
+            self.assertEqual([doc.page_content for doc, _ in index.search(book_id, [1.0, 0.0], k=1)],
+                             [f"Book {book_id}"])
+            self.assertLessEqual(index.stats()['open_segments'], 2)
+
+    def test_a_slow_search_does_not_block_other_books(self):
+        unified_index.add_book(1, ["Emma"], [[1.0, 0.0]])
+        unified_index.add_book(2, ["Anne"], [[1.0, 0.0]])
+        index = unified_index.get_unified_index()
+        release, searching = threading.Event(), threading.Event()
+        open_segment = index._segment
+
+        class SlowSegment:
+            def __init__(self, segment):
+                self.segment = segment
+
+            def search(self, query, k):
+                searching.set()
+                release.wait(5)
+                return self.segment.search(query, k)
+
+        def segment(book_id, filename):
+            found = open_segment(book_id, filename)
+            return SlowSegment(found) if book_id == 1 else found
+
+        with patch.object(index, '_segment', segment):
+            slow = threading.Thread(target=index.search, args=(1, [1.0, 0.0], 1))
+            slow.start()
+            self.assertTrue(searching.wait(5))
+            self.assertEqual([doc.page_content for doc, _ in index.search(2, [1.0, 0.0], k=1)], ["Anne"])
+            release.set()
+            slow.join()
+
+    def test_deleting_a_book_removes_it_from_the_index(self):
+        book = Book.objects.create(title="Emma", author="Jane Austen", description="-", text_file='books/emma.txt')
+        unified_index.add_book(book.id, ["Emma"], [[1.0, 0.0]])
+        index = unified_index.get_unified_index()
+        self.assertTrue(index.search(book.id, [1.0, 0.0], k=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            book.delete()
+        self.assertFalse(index.has_book(book.id))
+        self.assertEqual(index.search(book.id, [1.0, 0.0], k=1), [])
+        self.assertEqual(list(self.segments.glob(f'book_{book.id}_v*.faiss')), [])
+
+    def test_books_missing_from_the_index_use_their_own_store(self):
+        unified_index.add_book(1, ["Emma"], [[1.0, 0.0]])
+        indexed = Book(id=1, title="Emma", vector_store_path='vector_stores/book_1')
+        missing = Book(id=2, title="Persuasion", vector_store_path='vector_stores/book_2')
+        with patch('books.vector_store_cache.get_embeddings'), \
+                patch.object(vector_store_cache, 'get', return_value='per-book store') as get:
+            self.assertIsInstance(get_vector_store(indexed), unified_index.BookIndexView)
+            self.assertEqual(get_vector_store(missing), 'per-book store')
+        get.assert_called_once()
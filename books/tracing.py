@@ -0,0 +1,170 @@
+"""
+Lightweight per-stage timing for chat turns.
+
+A view opens a ``trace`` for the request; code anywhere below it wraps its
+work in ``stage(name)``. Each stage's duration is recorded on the current
+trace (found through a context variable, so it follows the request across
+awaits, ``sync_to_async`` and ``asyncio.gather``) and in a process-wide
+histogram keyed by stage and character. When the trace ends it is logged as
+one JSON line and can be rendered as a ``Server-Timing`` header; the
+histograms are exposed in Prometheus text format by the metrics view.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; Gemini and TTS calls sit in the top buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """Stage timings collected while handling one request."""
+
+    def __init__(self, name, character=None):
+        self.name = name
+        self.character = character.name if character is not None else ''
+        self.started = time.perf_counter()
+        self.total = None
+        self.stages = []  # (stage, seconds), in completion order
+        self._lock = threading.Lock()
+
+    def set_character(self, character):
+        """Label the trace once the request's character is known."""
+        self.character = character.name
+
+    def record(self, stage_name, duration):
+        with self._lock:
+            self.stages.append((stage_name, duration))
+
+    def server_timing(self):
+        """Value for the ``Server-Timing`` response header (durations in ms)."""
+        with self._lock:
+            entries = [f"{name};dur={duration * 1000:.1f}" for name, duration in self.stages]
+        total = self.total if self.total is not None else time.perf_counter() - self.started
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+    def as_dict(self):
+        with self._lock:
+            stages = [{'stage': name, 'ms': round(duration * 1000, 2)} for name, duration in self.stages]
+        return {
+            'trace': self.name,
+            'character': self.character,
+            'total_ms': round((self.total or 0) * 1000, 2),
+            'stages': stages,
+        }
+
+
+class StageHistograms:
+    """Cumulative latency histograms per (stage, character)."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._series = defaultdict(lambda: [[0] * len(self.buckets), 0.0, 0])  # counts, sum, count
+        self._lock = threading.Lock()
+
+    def observe(self, stage_name, character, duration):
+        with self._lock:
+            series = self._series[(stage_name, character)]
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    series[0][i] += 1
+            series[1] += duration
+            series[2] += 1
+
+    def render(self):
+        """The histograms in Prometheus text exposition format."""
+        name = 'literarychat_stage_duration_seconds'
+        lines = [
+            f"# HELP {name} Time spent in each stage of a chat turn.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+            for (stage_name, character), (counts, total, count) in series:
+                labels = f'stage="{_escape(stage_name)}",character="{_escape(character)}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{{labels}}} {total}')
+                lines.append(f'{name}_count{{{labels}}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+histograms = StageHistograms()
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(name, character=None):
+    """
+    Collect stage timings for one request.
+
+    Yields:
+        Trace: Attach ``trace.server_timing()`` to the response
+    """
+    current = Trace(name, character)
+    with within(current):
+        try:
+            yield current
+        finally:
+            finish(current)
+
+
+@contextmanager
+def within(current):
+    """
+    Record stages on an already started trace, without finishing it.
+
+    For requests whose work continues after the view returns, like a
+    streaming response's generator, which then calls ``finish``.
+    """
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+
+
+def finish(current):
+    """End a trace: record its stages in the histograms and log it."""
+    current.total = time.perf_counter() - current.started
+    # Observed at the end so every stage carries the final character label
+    for stage_name, duration in current.stages:
+        histograms.observe(stage_name, current.character, duration)
+    histograms.observe('total', current.character, current.total)
+    logger.info(json.dumps(current.as_dict()))
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage of the current trace (if any)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        current = _current_trace.get()
+        if current is not None:
+            current.record(name, duration)
+        else:
+            histograms.observe(name, '', duration)
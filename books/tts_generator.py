@@ -1,82 +1,355 @@
-from google.cloud import texttospeech
-from django.conf import settings
-import os
+"""
+Text-to-speech for character replies, with a persistent audio cache.
+
+Audio files live in ``MEDIA_ROOT/tts_cache`` named by sha256 of everything
+that changes the sound (text, voice, speaking rate, pitch and encoding), so
+two characters saying the same line never share a clip, and are served by
+the ``audio`` view (see audio_serving). A SQLite index next to the
+embedding cache records each file's size and last access; files are written
+through a temp file and renamed into place, so readers never see a partial
+clip. `python manage.py prune_tts_cache` evicts least recently used
+files past a size budget and files not played for too long.
+"""
+import asyncio
+import contextvars
 import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+from google.cloud import texttospeech
+from .clients import get_async_tts_client, get_tts_client
+from .tracing import stage
+
+DEFAULT_VOICE = "en-GB-Neural2-A"
+SPEAKING_RATE = 0.95  # Slightly slower for elegance
+PITCH = 0.0
+AUDIO_EXTENSIONS = {"MP3": "mp3", "OGG_OPUS": "ogg"}
+
+_FILENAME = re.compile(r"^[0-9a-f]{64}\.(" + "|".join(AUDIO_EXTENSIONS.values()) + r")$")
+
+# Temp files older than this are left over from a crashed write
+_STALE_TMP_SECONDS = 60 * 60
+
+
+class SpeechRequest(NamedTuple):
+    text: str
+    voice: str
+    rate: float
+    pitch: float
+    encoding: str
+
+    @property
+    def key(self):
+        """Cache key: sha256 over every parameter that changes the audio."""
+        return hashlib.sha256(json.dumps(self, ensure_ascii=False).encode()).hexdigest()
+
+    @property
+    def filename(self):
+        return f"{self.key}.{AUDIO_EXTENSIONS[self.encoding]}"
+
+
+def clean_text(text):
+    """Strip markup the TTS voice would read out or stumble over."""
+    cleaned_text = text.replace('*', '')  # Remove asterisks
+    cleaned_text = cleaned_text.replace('_', '')  # Remove underscores
+    cleaned_text = cleaned_text.replace('"', '')  # Remove quotes
+    cleaned_text = cleaned_text.replace("'", '')  # Remove apostrophes in quotes
+    return ' '.join(cleaned_text.split())  # Normalize whitespace
+
+
+def speech_request(text, character):
+    """The synthesis parameters for a character saying some text."""
+    # Use character's voice from database, with fallback
+    voice = getattr(character, 'voice', None) or DEFAULT_VOICE
+    return SpeechRequest(clean_text(text), voice, SPEAKING_RATE, PITCH, settings.TTS_AUDIO_ENCODING)
+
+
+def synthesis_kwargs(speech):
+    """Keyword arguments for the Google TTS client's synthesize_speech."""
+    # Determine gender from voice name
+    is_female_voice = any(letter in speech.voice for letter in ['A', 'C', 'F'])
+    gender = texttospeech.SsmlVoiceGender.FEMALE if is_female_voice else texttospeech.SsmlVoiceGender.MALE
+    return {
+        'input': texttospeech.SynthesisInput(text=speech.text),
+        'voice': texttospeech.VoiceSelectionParams(
+            language_code='-'.join(speech.voice.split('-')[:2]),
+            name=speech.voice,
+            ssml_gender=gender
+        ),
+        'audio_config': texttospeech.AudioConfig(
+            audio_encoding=texttospeech.AudioEncoding[speech.encoding],
+            speaking_rate=speech.rate,
+            pitch=speech.pitch
+        ),
+    }
+
+
+class AudioCache:
+    """Content-addressed audio files plus a SQLite index of size and last access."""
 
-def generate_speech_audio(text, character_name, conversation_id):
+    def __init__(self, directory, index_path):
+        self.directory = Path(directory)
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.index_path), check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS audio ("
+                "filename TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS audio_last_access ON audio (last_access)")
+            self._db = db
+        return self._db
+
+    def _touch(self, filename, size, when=None):
+        when = when or time.time()
+        self._connect().execute(
+            "INSERT INTO audio (filename, size, created, last_access) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(filename) DO UPDATE SET size = excluded.size, last_access = excluded.last_access",
+            (filename, size, when, when)
+        )
+
+    def url(self, filename):
+        """Relative URL of the audio view serving a clip."""
+        return reverse('books:audio', args=[filename]).lstrip('/')
+
+    def path(self, filename):
+        """Filesystem path of a cached clip, or None if it isn't cached."""
+        if not _FILENAME.match(filename):
+            return None
+        path = self.directory / filename
+        return path if path.is_file() else None
+
+    def get(self, filename):
+        """Return the URL of a cached clip (recording the access), or None."""
+        try:
+            size = (self.directory / filename).stat().st_size
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._touch(filename, size)
+        return self.url(filename)
+
+    def put(self, filename, audio_content):
+        """Write a clip atomically, index it and return its URL."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(audio_content)
+            os.replace(tmp_path, self.directory / filename)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self._touch(filename, len(audio_content))
+        return self.url(filename)
+
+    def _sync_index(self):
+        """Index files written before the index existed and forget deleted ones."""
+        db = self._connect()
+        indexed = {row[0] for row in db.execute("SELECT filename FROM audio")}
+        present = set()
+        now = time.time()
+        for path in self.directory.iterdir():
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            if path.suffix == '.tmp':
+                if now - stat.st_mtime > _STALE_TMP_SECONDS:
+                    path.unlink(missing_ok=True)
+                continue
+            present.add(path.name)
+            if path.name not in indexed:
+                self._touch(path.name, stat.st_size, stat.st_mtime)
+        db.executemany("DELETE FROM audio WHERE filename = ?", [(name,) for name in indexed - present])
+
+    def prune(self, max_bytes=None, max_age=None, dry_run=False):
+        """
+        Evict clips not played within max_age seconds, then least recently
+        used clips until the cache fits in max_bytes.
+
+        Returns:
+            tuple: (files removed, bytes freed)
+        """
+        with self._lock:
+            self._sync_index()
+            db = self._connect()
+            doomed = []
+            if max_age:
+                doomed += db.execute(
+                    "SELECT filename, size FROM audio WHERE last_access < ?", (time.time() - max_age,)
+                ).fetchall()
+            if max_bytes is not None:
+                total = db.execute("SELECT COALESCE(SUM(size), 0) FROM audio").fetchone()[0]
+                total -= sum(size for _, size in doomed)
+                expired = {filename for filename, _ in doomed}
+                for filename, size in db.execute("SELECT filename, size FROM audio ORDER BY last_access"):
+                    if total <= max_bytes:
+                        break
+                    if filename not in expired:
+                        doomed.append((filename, size))
+                        total -= size
+            if not dry_run:
+                for filename, _ in doomed:
+                    (self.directory / filename).unlink(missing_ok=True)
+                db.executemany("DELETE FROM audio WHERE filename = ?", [(filename,) for filename, _ in doomed])
+        return len(doomed), sum(size for _, size in doomed)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio"
+            ).fetchone()
+        return {'entries': entries, 'size_bytes': size}
+
+
+audio_cache = AudioCache(Path(settings.MEDIA_ROOT) / 'tts_cache', settings.TTS_CACHE_INDEX_PATH)
+
+
+def generate_speech_audio(text, character, conversation_id=None):
     """
-    Generate speech audio using Google Cloud TTS.
-    
-    Args:
-        text: Text to convert to speech
-        character_name: Name of character (for voice selection)
-        conversation_id: ID for caching
-    
+    Generate speech audio for a character using Google Cloud TTS.
+
     Returns:
-        str: Path to generated audio file
+        str: URL of the cached audio file, or None if synthesis failed
     """
     try:
-        # Create cache directory
-        cache_dir = Path(settings.MEDIA_ROOT) / 'tts_cache'
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Create unique filename based on text hash
-        text_hash = hashlib.md5(text.encode()).hexdigest()
-        audio_filename = f"{text_hash}.mp3"
-        audio_path = cache_dir / audio_filename
-        
+        speech = speech_request(text, character)
+
         # Return cached file if it exists
-        if audio_path.exists():
-            return f"media/tts_cache/{audio_filename}"
-        
-        # Initialize TTS client
-        client = texttospeech.TextToSpeechClient(
-            client_options={"api_key": settings.GOOGLE_API_KEY}
-        )
-        
-        # Select voice based on character
-        is_female = any(name in character_name.lower() 
-                       for name in ['elizabeth', 'bennet', 'jane', 'lydia', 'mary', 'kitty'])
-        
-        if is_female:
-            voice = texttospeech.VoiceSelectionParams(
-                language_code="en-GB",
-                name="en-GB-Neural2-A",  # Female British voice
-                ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
-            )
-        else:
-            voice = texttospeech.VoiceSelectionParams(
-                language_code="en-GB",
-                name="en-GB-Neural2-B",  # Male British voice
-                ssml_gender=texttospeech.SsmlVoiceGender.MALE
-            )
-        
-        # Set the text input
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-        
-        # Select audio format
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=0.95,  # Slightly slower for elegance
-            pitch=0.0
-        )
-        
+        audio_url = audio_cache.get(speech.filename)
+        if audio_url:
+            return audio_url
+
+        # Reuse the shared TTS client
+        client = get_tts_client()
+
+        print(f"🎙️ Using voice: {speech.voice} for {character.name}")
+
         # Generate speech
-        response = client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
-        )
-        
+        with stage('tts_synthesis'):
+            response = client.synthesize_speech(**synthesis_kwargs(speech))
+
         # Save audio file
-        with open(audio_path, 'wb') as out:
-            out.write(response.audio_content)
-        
-        return f"media/tts_cache/{audio_filename}"
-        
+        with stage('tts_write'):
+            audio_url = audio_cache.put(speech.filename, response.audio_content)
+
+        print(f"✅ Generated TTS audio for {character.name}")
+
+        return audio_url
+
     except Exception as e:
-        print(f"TTS Error: {str(e)}")
+        print(f"❌ TTS Error: {str(e)}")
         import traceback
         traceback.print_exc()
-        return None
\ No newline at end of file
+        return None
+
+
+async def agenerate_speech_audio(text, character, conversation_id=None):
+    """
+    Async version of generate_speech_audio using the async TTS client.
+    """
+    try:
+        speech = speech_request(text, character)
+
+        audio_url = await sync_to_async(audio_cache.get, thread_sensitive=False)(speech.filename)
+        if audio_url:
+            return audio_url
+
+        client = get_async_tts_client()
+
+        print(f"🎙️ Using voice: {speech.voice} for {character.name}")
+
+        with stage('tts_synthesis'):
+            response = await client.synthesize_speech(**synthesis_kwargs(speech))
+
+        with stage('tts_write'):
+            audio_url = await sync_to_async(audio_cache.put, thread_sensitive=False)(
+                speech.filename, response.audio_content
+            )
+
+        print(f"✅ Generated TTS audio for {character.name}")
+
+        return audio_url
+
+    except Exception as e:
+        print(f"❌ TTS Error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+# Bounded pool for synthesizing sentence segments concurrently
+_tts_executor = ThreadPoolExecutor(
+    max_workers=settings.TTS_MAX_WORKERS,
+    thread_name_prefix='tts'
+)
+
+# Sentence ends, ignoring the titles common in the books ("Mr. Darcy")
+_SENTENCE_BREAK = re.compile(r'(?<!\bMr\.)(?<!\bMrs\.)(?<!\bMs\.)(?<!\bDr\.)(?<!\bSt\.)(?<=[.!?])\s+')
+
+
+def split_sentences(text, min_length=40):
+    """
+    Split a response into sentences for incremental TTS.
+
+    Very short sentences are merged into the following one so playback
+    isn't made of many tiny clips.
+    """
+    sentences = []
+    pending = ''
+    for sentence in _SENTENCE_BREAK.split(text.strip()):
+        pending = f"{pending} {sentence}".strip()
+        if len(pending) >= min_length:
+            sentences.append(pending)
+            pending = ''
+    if pending:
+        if sentences and len(pending) < min_length:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+    return sentences
+
+
+async def aiter_speech_segments(text, character, conversation_id=None):
+    """
+    Synthesize a response sentence by sentence.
+
+    All sentences are submitted to the TTS pool at once and each segment is
+    cached under its own key. Audio URLs are yielded in sentence order as
+    soon as each one is ready, so playback can start after the first.
+
+    Yields:
+        str: Audio URL of each segment (None if a segment failed)
+    """
+    loop = asyncio.get_running_loop()
+    # run_in_executor doesn't carry context variables, so pass the current
+    # context along for the stage timings of the request being traced
+    futures = [
+        loop.run_in_executor(
+            _tts_executor,
+            contextvars.copy_context().run,
+            generate_speech_audio, sentence, character, conversation_id
+        )
+        for sentence in split_sentences(text)
+    ]
+    for future in futures:
+        yield await future
@@ -0,0 +1,70 @@
+"""
+Speculative TTS pre-generation.
+
+Replies are generated fresh by Gemini, so only text the chat is known to
+speak again can be synthesized before it is needed. The ``prewarm_tts``
+management command synthesizes, for every character, the fallback reply
+and the lines the character has said most often (mined from Message
+history) ahead of time, so those turns are served straight from the audio
+cache. Chats have no scripted openers, so there is nothing else to warm.
+Synthesis runs on a small pool so pre-warming never competes with live
+chats for the whole TTS quota.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db.models import Count
+from .models import Message
+from .rag_query import FALLBACK_RESPONSE
+from .tts_generator import audio_cache, generate_speech_audio, speech_request, split_sentences
+
+
+def frequent_responses(character, limit, min_count=2):
+    """The character's most repeated replies, most frequent first."""
+    if limit <= 0:
+        return []
+    rows = (
+        Message.objects
+        .filter(conversation__character=character, role='character')
+        .values('content')
+        .annotate(count=Count('id'))
+        .filter(count__gte=min_count)
+        .order_by('-count')[:limit]
+    )
+    return [row['content'] for row in rows]
+
+
+def prewarm_lines(character, top_responses, min_count=2):
+    """
+    Texts worth having audio for before anyone asks.
+
+    Lines are split into the same sentence segments the chat synthesizes
+    when TTS_SENTENCE_CHUNKING is on, so the cache keys match.
+    """
+    lines = [FALLBACK_RESPONSE] + frequent_responses(character, top_responses, min_count)
+    if settings.TTS_SENTENCE_CHUNKING:
+        lines = [segment for line in lines for segment in split_sentences(line)]
+    return list(dict.fromkeys(line for line in lines if line.strip()))
+
+
+def prewarm_characters(characters, top_responses, min_count=2, concurrency=2, log=print):
+    """
+    Synthesize the pre-warm lines of each character that aren't cached yet.
+
+    Returns:
+        dict: Counts of lines already cached, synthesized and failed
+    """
+    work = []
+    counts = {'cached': 0, 'synthesized': 0, 'failed': 0}
+    for character in characters:
+        for line in prewarm_lines(character, top_responses, min_count):
+            if audio_cache.get(speech_request(line, character).filename):
+                counts['cached'] += 1
+            else:
+                work.append((line, character))
+
+    log(f"🔥 Pre-warming {len(work)} lines ({counts['cached']} already cached)")
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='tts-prewarm') as executor:
+        results = executor.map(lambda item: generate_speech_audio(*item), work)
+        for audio_url in results:
+            counts['synthesized' if audio_url else 'failed'] += 1
+    return counts
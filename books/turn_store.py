@@ -0,0 +1,152 @@
+"""
+Persistence of chat turns with the fewest database round-trips.
+
+A turn reads its conversation once, with the character and book joined
+in, and writes the user's message and the reply together in one
+``bulk_create`` (a single INSERT, so both rows land or neither does).
+
+With MESSAGE_WRITE_BEHIND on, turns are instead queued in memory and a
+background thread inserts them in batches every MESSAGE_FLUSH_INTERVAL
+seconds, taking the writes off the request path entirely under heavy
+traffic. Queued messages are merged into the conversation history and the
+newest chat page until they are flushed; a crash loses at most one flush
+interval of messages.
+"""
+import atexit
+import threading
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.http import Http404
+from .models import Conversation, Message
+from .tracing import stage
+
+
+async def aget_conversation(conversation_id):
+    """Fetch a conversation with its character and book in one query, or 404"""
+    try:
+        with stage('db_read'):
+            return await Conversation.objects.select_related(
+                'character__book'
+            ).aget(id=conversation_id)
+    except Conversation.DoesNotExist:
+        raise Http404("No Conversation matches the given query.")
+
+
+class MessageBuffer:
+    """In-memory queue of unsaved messages, flushed in batches by a daemon thread."""
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flushed = 0
+        self.dropped = 0
+        self._pending = []
+        self._flushing = []  # Taken from _pending, insert not yet committed
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One flush at a time (timer thread or exit)
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, messages):
+        with self._lock:
+            self._pending.extend(messages)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-flush', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def pending(self, conversation_id):
+        """Queued messages of one conversation, oldest first."""
+        with self._lock:
+            return [
+                message for message in self._flushing + self._pending
+                if message.conversation_id == conversation_id and message.pk is None  # pk is set once inserted
+            ]
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Message flush failed: {str(e)}")
+
+    def flush(self):
+        """Insert everything queued so far, in batches of batch_size."""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            self._flushing = batch
+        if not batch:
+            return
+        try:
+            self._insert(batch)
+        except IntegrityError:
+            # A conversation was deleted while its messages were queued
+            kept = batch
+            try:
+                live = set(Conversation.objects.filter(
+                    id__in={message.conversation_id for message in batch}
+                ).values_list('id', flat=True))
+                kept = [message for message in batch if message.conversation_id in live]
+                self._insert(kept)
+            except Exception as e:
+                self._retry_later(kept, e)
+            finally:
+                self.dropped += len(batch) - len(kept)
+        except Exception as e:
+            self._retry_later(batch, e)
+        finally:
+            with self._lock:
+                self._flushing = []
+
+    def _retry_later(self, messages, error):
+        print(f"❌ Could not flush {len(messages)} messages, retrying: {str(error)}")
+        with self._lock:
+            self._pending[:0] = messages
+
+    def _insert(self, messages):
+        with transaction.atomic():
+            Message.objects.bulk_create(messages, batch_size=self.batch_size)
+        self.flushed += len(messages)
+
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending), 'flushed': self.flushed, 'dropped': self.dropped}
+
+
+message_buffer = MessageBuffer(settings.MESSAGE_FLUSH_INTERVAL, settings.MESSAGE_FLUSH_BATCH)
+
+
+def pending_messages(conversation_id):
+    """Messages of a conversation still waiting in the write-behind buffer."""
+    if not settings.MESSAGE_WRITE_BEHIND:
+        return []
+    return message_buffer.pending(conversation_id)
+
+
+async def asave_turn(conversation, user_message, character_response):
+    """
+    Persist the user's message and the character's reply together.
+
+    Returns:
+        list: The two Message instances (without ids while write-behind
+        buffered)
+    """
+    messages = [
+        Message(conversation=conversation, role='user', content=user_message),
+        Message(conversation=conversation, role='character', content=character_response),
+    ]
+    if settings.MESSAGE_WRITE_BEHIND:
+        message_buffer.add(messages)
+        return messages
+    with stage('db_write'):
+        return await Message.objects.abulk_create(messages)
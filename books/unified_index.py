@@ -0,0 +1,283 @@
+"""
+Optional single vector index shared by every book.
+
+Instead of one LangChain FAISS store per Book, all processed books live in
+one index directory: a SQLite docstore holding every chunk's text and
+metadata, plus one flat FAISS segment per book, memory-mapped read-only
+and opened on a book's first query. A query for a character searches only
+its book's segment, so its cost depends on the book rather than the
+catalog, and adding or replacing a book writes that book's segment alone.
+
+A segment is written to a temp file and renamed into place before the
+docstore transaction that points the book at it commits, so readers always
+see a book's chunks and vectors from the same version. Only the
+UNIFIED_INDEX_OPEN_SEGMENTS most recently queried segments stay mapped,
+so open files don't grow with the catalog, and the FAISS search itself
+runs outside the reader's lock so queries for different books don't wait
+on each other.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+import faiss
+import numpy as np
+from asgiref.sync import sync_to_async
+from langchain_core.documents import Document
+from django.conf import settings
+
+DOCS_FILE = "docs.sqlite3"
+SEGMENTS_DIR = "segments"
+
+_MMAP_FLAG = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+
+_write_lock = threading.Lock()
+_reader = None
+_reader_lock = threading.Lock()
+
+
+def chunk_id(book_id, position):
+    return (book_id << 32) | position
+
+
+def _connect(directory):
+    db = sqlite3.connect(str(Path(directory) / DOCS_FILE), check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS chunks ("
+        "id INTEGER PRIMARY KEY, book_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+        "text TEXT NOT NULL, metadata TEXT NOT NULL)"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS segments ("
+        "book_id INTEGER PRIMARY KEY, filename TEXT NOT NULL, ntotal INTEGER NOT NULL)"
+    )
+    return db
+
+
+class UnifiedIndex:
+    """Read-only view of the unified index; book segments are memory-mapped."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._db = _connect(self.directory)
+        self._segments = OrderedDict()  # book id -> (filename, faiss index), least recently used first
+        self._lock = threading.Lock()  # Guards the SQLite connection and _segments
+
+    def has_book(self, book_id):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM segments WHERE book_id = ?", (book_id,)).fetchone() is not None
+
+    def _segment(self, book_id, filename):
+        """The book's mapped segment, opening it (and closing the least recently used) as needed."""
+        cached = self._segments.get(book_id)
+        if cached is None or cached[0] != filename:
+            path = self.directory / SEGMENTS_DIR / filename
+            cached = (filename, faiss.read_index(str(path), _MMAP_FLAG | faiss.IO_FLAG_READ_ONLY))
+            self._segments[book_id] = cached
+        self._segments.move_to_end(book_id)
+        while len(self._segments) > settings.UNIFIED_INDEX_OPEN_SEGMENTS:
+            # Unmapped once no search still holds it
+            self._segments.popitem(last=False)
+        return cached[1]
+
+    def stats(self):
+        with self._lock:
+            return {'open_segments': len(self._segments)}
+
+    def forget(self, book_id):
+        """Drop a book's mapped segment."""
+        with self._lock:
+            self._segments.pop(book_id, None)
+
+    def search(self, book_id, embedding, k):
+        """
+        Search one book's chunks.
+
+        Returns:
+            list: (Document, score) pairs, closest first
+        """
+        query = np.asarray([embedding], dtype=np.float32)
+        while True:
+            with self._lock:
+                row = self._db.execute("SELECT filename FROM segments WHERE book_id = ?", (book_id,)).fetchone()
+                if row is None:
+                    return []
+                segment = self._segment(book_id, row[0])
+            scores, positions = segment.search(query, k)
+            hits = [
+                (chunk_id(book_id, int(position)), float(score))
+                for position, score in zip(positions[0], scores[0]) if position != -1
+            ]
+            if not hits:
+                return []
+            with self._lock:
+                # One read transaction, so the chunk rows belong to the segment searched
+                self._db.execute("BEGIN")
+                try:
+                    current = self._db.execute(
+                        "SELECT filename FROM segments WHERE book_id = ?", (book_id,)
+                    ).fetchone()
+                    placeholders = ','.join('?' * len(hits))
+                    rows = self._db.execute(
+                        f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})",
+                        [i for i, _ in hits]
+                    ).fetchall()
+                finally:
+                    self._db.execute("COMMIT")
+            if current is None:
+                return []
+            if current[0] == row[0]:
+                break
+            # The book was re-indexed during the search; search the new segment
+        docs = {
+            row_id: Document(page_content=text, metadata=json.loads(metadata), id=str(row_id))
+            for row_id, text, metadata in rows
+        }
+        return [(docs[i], score) for i, score in hits if i in docs]
+
+    def for_book(self, book_id, embeddings):
+        return BookIndexView(self, book_id, embeddings)
+
+
+class BookIndexView:
+    """One book's slice of the unified index, with the vector store search API."""
+
+    def __init__(self, unified, book_id, embeddings):
+        self.unified = unified
+        self.book_id = book_id
+        self.embedding_function = embeddings
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        return self.unified.search(self.book_id, embedding, k)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k, **kwargs)
+
+    async def asimilarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return await sync_to_async(self.similarity_search_by_vector, thread_sensitive=False)(embedding, k, **kwargs)
+
+    async def asimilarity_search(self, query, k=4, **kwargs):
+        embedding = await self.embedding_function.aembed_query(query)
+        return await self.asimilarity_search_by_vector(embedding, k, **kwargs)
+
+
+def get_unified_index():
+    """
+    The process-wide reader.
+
+    Returns:
+        UnifiedIndex or None if no book has been added yet
+    """
+    global _reader
+    directory = Path(settings.UNIFIED_INDEX_DIR)
+    if not (directory / DOCS_FILE).exists():
+        return None
+    with _reader_lock:
+        if _reader is None or _reader.directory != directory:
+            _reader = UnifiedIndex(directory)
+        return _reader
+
+
+def add_book(book_id, texts, vectors, metadatas=None):
+    """
+    Replace a book's chunks in the unified index.
+
+    Only the book's own segment is written; other books are untouched.
+
+    Args:
+        book_id: Primary key of the book
+        texts: Chunk texts in book order
+        vectors: One embedding per chunk
+        metadatas: Optional metadata dict per chunk
+    """
+    directory = Path(settings.UNIFIED_INDEX_DIR)
+    segments_dir = directory / SEGMENTS_DIR
+    segments_dir.mkdir(parents=True, exist_ok=True)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    metadatas = metadatas or [{} for _ in texts]
+
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    filename = f"book_{book_id}_v{time.time_ns()}.faiss"
+    tmp_path = segments_dir / (filename + ".tmp")
+    faiss.write_index(index, str(tmp_path))
+    os.replace(tmp_path, segments_dir / filename)
+
+    with _write_lock:
+        db = _connect(directory)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                previous = db.execute("SELECT filename FROM segments WHERE book_id = ?", (book_id,)).fetchone()
+                db.execute("DELETE FROM chunks WHERE book_id = ?", (book_id,))
+                db.executemany(
+                    "INSERT INTO chunks (id, book_id, position, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (chunk_id(book_id, position), book_id, position, text, json.dumps(metadata))
+                        for position, (text, metadata) in enumerate(zip(texts, metadatas))
+                    ]
+                )
+                db.execute(
+                    "INSERT OR REPLACE INTO segments (book_id, filename, ntotal) VALUES (?, ?, ?)",
+                    (book_id, filename, index.ntotal)
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                (segments_dir / filename).unlink(missing_ok=True)
+                raise
+        finally:
+            db.close()
+
+    # The previous segment is kept for readers still on the old docstore
+    # snapshot; anything older is removed
+    keep = {filename, previous[0] if previous else None}
+    for old_path in segments_dir.glob(f"book_{book_id}_v*.faiss"):
+        if old_path.name not in keep:
+            old_path.unlink(missing_ok=True)
+
+    print(f"🗃️ Unified index: {len(texts)} chunks for book {book_id}")
+
+
+def remove_book(book_id):
+    """Delete a book's chunks and segments from the unified index."""
+    directory = Path(settings.UNIFIED_INDEX_DIR)
+    if not (directory / DOCS_FILE).exists():
+        return
+    with _write_lock:
+        db = _connect(directory)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("DELETE FROM chunks WHERE book_id = ?", (book_id,))
+                db.execute("DELETE FROM segments WHERE book_id = ?", (book_id,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+    reader = get_unified_index()
+    if reader is not None:
+        reader.forget(book_id)
+    for path in (directory / SEGMENTS_DIR).glob(f"book_{book_id}_v*.faiss"):
+        path.unlink(missing_ok=True)
+
+
+def add_book_from_store(book_id, vector_store, ordered_ids):
+    """Copy a book's chunks from its LangChain FAISS store, in book order."""
+    positions = {doc_id: position for position, doc_id in vector_store.index_to_docstore_id.items()}
+    texts, vectors, metadatas = [], [], []
+    for doc_id in ordered_ids:
+        doc = vector_store.docstore.search(doc_id)
+        texts.append(doc.page_content)
+        metadatas.append(doc.metadata)
+        vectors.append(vector_store.index.reconstruct(positions[doc_id]))
+    add_book(book_id, texts, np.asarray(vectors), metadatas)
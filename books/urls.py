@@ -8,5 +8,11 @@ urlpatterns = [
     path('book/<int:book_id>/', views.book_detail, name='book_detail'),
     path('chat/<int:character_id>/', views.chat, name='chat'),
     path('send/<int:conversation_id>/', views.send_message, name='send_message'),
+    path('stream/<int:conversation_id>/', views.stream_message, name='stream_message'),
+    path('messages/<int:conversation_id>/', views.older_messages, name='older_messages'),
+    path('audio-job/<str:job_id>/', views.audio_job_status, name='audio_job'),
+    path('audio/<str:filename>', views.audio, name='audio'),
     path('delete-conversation/<int:conversation_id>/', views.delete_conversation, name='delete_conversation'),
+    path('stats/runtime/', views.runtime_stats, name='runtime_stats'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -0,0 +1,187 @@
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from langchain_community.vectorstores import FAISS
+from django.conf import settings
+from .clients import get_embeddings
+from .unified_index import get_unified_index
+from .compact_store import CompactVectorStore, is_compact_store, INDEX_FILE as COMPACT_INDEX_FILE
+
+
+def _store_size(path):
+    """
+    Approximate the in-memory size of a store by its size on disk.
+
+    Compact stores are memory-mapped, so their pages sit in the OS page
+    cache (shared between workers and dropped under memory pressure)
+    rather than in this process's heap; they count as 0.
+    """
+    if is_compact_store(path):
+        return 0
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.is_file())
+
+
+def _store_version(path):
+    """Modification time of the index file, used to spot rewritten stores."""
+    index_file = COMPACT_INDEX_FILE if is_compact_store(path) else "index.faiss"
+    return os.stat(Path(path) / index_file).st_mtime_ns
+
+
+def load_store(path, embeddings):
+    """Load a vector store from disk in whichever format it was saved."""
+    if is_compact_store(path):
+        return CompactVectorStore.load_local(str(path), embeddings)
+    return FAISS.load_local(
+        str(path),
+        embeddings,
+        allow_dangerous_deserialization=True
+    )
+
+
+class VectorStoreCache:
+    """
+    Process-wide LRU cache of loaded vector stores (FAISS or compact).
+
+    Stores are keyed by (book id, vector store path) and evicted least
+    recently used first once their combined size exceeds ``max_bytes``
+    (memory-mapped compact stores are not counted against it).
+    A store whose index file changed on disk (e.g. rewritten by another
+    process) is reloaded on its next lookup.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stores = OrderedDict()  # key -> (store, size, version)
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, book_id, vector_store_path, embeddings_factory):
+        """
+        Return the loaded store for a book, loading it from disk on a miss.
+
+        Args:
+            book_id: Primary key of the book
+            vector_store_path: Directory the store was saved to
+            embeddings_factory: Callable returning the embeddings to load with
+
+        Returns:
+            FAISS: The loaded vector store
+        """
+        key = (book_id, str(vector_store_path))
+        version = _store_version(vector_store_path)
+
+        with self._lock:
+            entry = self._stores.get(key)
+            if entry and entry[2] == version:
+                self._stores.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given store; the others wait and reuse it
+        with load_lock:
+            with self._lock:
+                entry = self._stores.get(key)
+                if entry and entry[2] == version:
+                    self._stores.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self.misses += 1
+
+            store = load_store(vector_store_path, embeddings_factory())
+            size = _store_size(vector_store_path)
+
+            with self._lock:
+                self._discard(key)
+                self._stores[key] = (store, size, version)
+                self.total_bytes += size
+                self._evict()
+            return store
+
+    def invalidate(self, book_id):
+        """Drop every cached store belonging to a book."""
+        with self._lock:
+            for key in [k for k in self._stores if k[0] == book_id]:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._stores.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'stores': len(self._stores),
+                'total_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _discard(self, key):
+        entry = self._stores.pop(key, None)
+        if entry:
+            self.total_bytes -= entry[1]
+
+    def _evict(self):
+        # Always keep the most recently loaded store, even if it alone
+        # exceeds the budget
+        while self.total_bytes > self.max_bytes and len(self._stores) > 1:
+            key = next(iter(self._stores))
+            self._discard(key)
+            self.evictions += 1
+
+
+vector_store_cache = VectorStoreCache(settings.VECTOR_STORE_CACHE_MAX_BYTES)
+
+
+def get_vector_store(book):
+    """
+    Get the vector store for a book from the process-wide cache.
+
+    With UNIFIED_INDEX_ENABLED, this is the book's slice of the shared
+    multi-book index instead, once the book has been added to it (until
+    then its per-book store is used).
+
+    Args:
+        book: Book model instance
+
+    Returns:
+        FAISS: The loaded vector store
+    """
+    if settings.UNIFIED_INDEX_ENABLED:
+        unified = get_unified_index()
+        if unified is not None and unified.has_book(book.id):
+            return unified.for_book(book.id, get_embeddings())
+    return vector_store_cache.get(book.id, book.vector_store_path, get_embeddings)
+
+
+def invalidate_vector_store(book):
+    """Forget any cached store for a book after it has been rewritten."""
+    vector_store_cache.invalidate(book.id)
+
+
+def warm_up():
+    """Load the vector stores of all processed books into the cache."""
+    from .models import Book
+
+    books = Book.objects.filter(is_processed=True).exclude(vector_store_path='')
+    for book in books:
+        try:
+            get_vector_store(book)
+            print(f"🔥 Warmed vector store for {book.title}")
+        except Exception as e:
+            print(f"❌ Could not warm vector store for {book.title}: {str(e)}")
+
+
+def warm_up_on_startup():
+    """Warm the cache at server startup when VECTOR_STORE_CACHE_WARMUP is set."""
+    if settings.VECTOR_STORE_CACHE_WARMUP:
+        warm_up()
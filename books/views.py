@@ -1,11 +1,23 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, get_object_or_404
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
 from django.conf import settings
-from .models import Book, Character, Conversation, Message
-from .rag_query import query_character
-from google.cloud import texttospeech
-from pathlib import Path
-import hashlib
+from django.contrib.admin.views.decorators import staff_member_required
+from .models import Book, Character, Conversation
+from .audio_jobs import audio_jobs
+from .audio_serving import audio_response
+from .pagination import decode_cursor, message_page
+from .rag_query import aquery_character, astream_character
+from .conversation_memory import abuild_history, aupdate_summary
+from .clients import client_stats, embedding_cache_stats
+from .response_cache import alookup_response, remember_response, response_cache
+from .tracing import Trace, finish, histograms, stage, trace, within
+from .tts_generator import agenerate_speech_audio, aiter_speech_segments, audio_cache
+from .turn_store import aget_conversation, asave_turn, message_buffer
+from .unified_index import get_unified_index
+from .vector_store_cache import vector_store_cache
+import asyncio
+import json
 import uuid
 
 def home(request):
@@ -23,8 +35,8 @@ def book_detail(request, book_id):
     })
 
 def chat(request, character_id):
-    """Chat interface with a character"""
-    character = get_object_or_404(Character, id=character_id)
+    """Chat interface with a character, showing the newest page of messages"""
+    character = get_object_or_404(Character.objects.select_related('book'), id=character_id)
     
     # Get or create session ID
     session_id = request.session.get('session_id')
@@ -38,145 +50,320 @@ def chat(request, character_id):
         user_session=session_id
     )
     
-    # Get message history
-    messages = conversation.messages.all().order_by('timestamp')
+    # Get the latest messages; older pages are loaded from older_messages
+    messages, older_cursor = message_page(conversation.id)
     
     return render(request, 'books/chat.html', {
         'character': character,
         'conversation': conversation,
-        'messages': messages
+        'messages': messages,
+        'older_cursor': older_cursor
     })
 
-def generate_speech_audio(text, character, conversation_id):
+def older_messages(request, conversation_id):
+    """The page of messages before a cursor, as JSON (only for the session's own conversations)"""
+    before = request.GET.get('before', '')
+    if not decode_cursor(before):
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    conversation = get_object_or_404(
+        Conversation, id=conversation_id, user_session=request.session.get('session_id')
+    )
+    messages, older_cursor = message_page(conversation.id, before=before)
+    return JsonResponse({
+        'messages': [
+            {
+                'id': message.id,
+                'role': message.role,
+                'content': message.content,
+                'timestamp': message.timestamp.isoformat(),
+            }
+            for message in messages
+        ],
+        'older_cursor': older_cursor
+    })
+
+async def _acollect(segments):
+    return [url async for url in segments if url]
+
+async def _aspeak(text, character, conversation_id):
     """
-    Generate speech audio using Google Cloud TTS.
+    Generate TTS for a reply, as one file or as sentence segments.
+
+    Returns:
+        tuple: (audio_url or None, ordered audio playlist)
     """
-    try:
-        # Clean the text before generating speech
-        cleaned_text = text.replace('*', '')  # Remove asterisks
-        cleaned_text = cleaned_text.replace('_', '')  # Remove underscores
-        cleaned_text = cleaned_text.replace('"', '')  # Remove quotes
-        cleaned_text = cleaned_text.replace("'", '')  # Remove apostrophes in quotes
-        cleaned_text = ' '.join(cleaned_text.split())  # Normalize whitespace
-        
-        # Create cache directory
-        cache_dir = Path(settings.MEDIA_ROOT) / 'tts_cache'
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Create unique filename based on text hash
-        text_hash = hashlib.md5(cleaned_text.encode()).hexdigest()
-        audio_filename = f"{text_hash}.mp3"
-        audio_path = cache_dir / audio_filename
-        
-        # Return cached file if it exists
-        if audio_path.exists():
-            return f"media/tts_cache/{audio_filename}"
-        
-        # Initialize TTS client
-        client = texttospeech.TextToSpeechClient(
-            client_options={"api_key": settings.GOOGLE_API_KEY}
-        )
-        
-        # Use character's voice from database, with fallback
-        voice_name = character.voice if hasattr(character, 'voice') and character.voice else "en-GB-Neural2-A"
-        
-        # Determine gender from voice name
-        is_female_voice = any(letter in voice_name for letter in ['A', 'C', 'F'])
-        gender = texttospeech.SsmlVoiceGender.FEMALE if is_female_voice else texttospeech.SsmlVoiceGender.MALE
-        
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="en-GB",
-            name=voice_name,
-            ssml_gender=gender
-        )
-        
-        print(f"🎙️ Using voice: {voice_name} for {character.name}")
-        
-        # Set the text input with cleaned text
-        synthesis_input = texttospeech.SynthesisInput(text=cleaned_text)
-        
-        # Select audio format
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=0.95,
-            pitch=0.0
-        )
-        
-        # Generate speech
-        response = client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
+    with stage('tts'):
+        if settings.TTS_SENTENCE_CHUNKING:
+            return None, await _acollect(aiter_speech_segments(text, character, conversation_id))
+        audio_url = await agenerate_speech_audio(text, character, conversation_id)
+        return audio_url, [audio_url] if audio_url else []
+
+def _without_history(history, cached, query_embedding):
+    """
+    Keep the response cache to conversations without earlier turns.
+
+    A reply to a follow-up ("tell me more") depends on the turns before it,
+    so it is neither answered from the cache nor stored in it.
+
+    Returns:
+        tuple: (cached response to use or None, embedding to store the new
+        reply under or None)
+    """
+    if history:
+        return None, None
+    return cached, query_embedding
+
+async def _astart_audio_job(character, character_response, query_embedding):
+    """
+    Speech for a fresh reply without waiting for TTS.
+
+    Returns:
+        tuple: (audio_url, audio_playlist, audio job id); the audio is
+        returned directly when every clip is already cached, otherwise a
+        background job is started (or joined) and its id returned
+    """
+    # The audio cache index is SQLite, so it is checked off the event loop
+    cached_audio = await sync_to_async(audio_jobs.cached, thread_sensitive=False)(character_response, character)
+    if cached_audio:
+        remember_response(character, query_embedding, character_response, *cached_audio)
+        return (*cached_audio, None)
+    job = audio_jobs.start(
+        character_response, character,
+        on_done=lambda audio_url, audio_playlist: remember_response(
+            character, query_embedding, character_response, audio_url, audio_playlist
         )
-        
-        # Save audio file
-        with open(audio_path, 'wb') as out:
-            out.write(response.audio_content)
-        
-        print(f"✅ Generated TTS audio for {character.name}")
-        
-        return f"media/tts_cache/{audio_filename}"
-        
-    except Exception as e:
-        print(f"❌ TTS Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return Nonepty
-
-def send_message(request, conversation_id):
-    """Handle sending a message and getting response"""
+    )
+    return None, [], job.id
+
+def _sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def send_message(request, conversation_id):
+    """
+    Handle sending a message and getting response.
+
+    This view is async: under ASGI the embedding, Gemini and TTS calls are
+    awaited on the event loop instead of holding a worker thread each.
+    Stage timings are logged and returned in a ``Server-Timing`` header.
+    """
     if request.method == 'POST':
-        conversation = get_object_or_404(Conversation, id=conversation_id)
-        user_message = request.POST.get('message', '').strip()
-        
-        if not user_message:
-            return JsonResponse({'error': 'Message cannot be empty'}, status=400)
-        
-        # Save user message
-        Message.objects.create(
-            conversation=conversation,
-            role='user',
-            content=user_message
-        )
-        
-        # 
-        # Get character response
-        character_response = query_character(
-            conversation.character,
-            user_message
-        )
-        
-        # Save character response
-        Message.objects.create(
-            conversation=conversation,
-            role='character',
-            content=character_response
-        )
-        
-        # Generate TTS audio
-        audio_url = generate_speech_audio(
-            character_response,
-            conversation.character,
-            conversation_id
-        )
-        
-        avatar_url = conversation.character.avatar.url if conversation.character.avatar else None
-
-        return JsonResponse({
-            'user_message': user_message,
-            'character_response': character_response,
-            'audio_url': audio_url,
-            'avatar_url': avatar_url
-        })
+        with trace('send_message') as turn:
+            conversation = await aget_conversation(conversation_id)
+            user_message = request.POST.get('message', '').strip()
+            
+            if not user_message:
+                return JsonResponse({'error': 'Message cannot be empty'}, status=400)
+            
+            character = conversation.character
+            turn.set_character(character)
+            
+            # Answer from the response cache when a near-identical question was asked,
+            # while loading the recent history for the prompt
+            (query_embedding, cached), (history, overflow) = await asyncio.gather(
+                alookup_response(character, user_message),
+                abuild_history(conversation)
+            )
+            cached, cache_embedding = _without_history(history, cached, query_embedding)
+            
+            audio_job = None
+            if cached and cached.audio_playlist:
+                character_response = cached.response
+                audio_url, audio_playlist = cached.audio_url, cached.audio_playlist
+                await asave_turn(conversation, user_message, character_response)
+            else:
+                # Get character response
+                if cached:
+                    character_response = cached.response
+                else:
+                    character_response = await aquery_character(
+                        character, user_message,
+                        conversation_history=history,
+                        query_embedding=query_embedding
+                    )
+                
+                if settings.TTS_BACKGROUND_JOBS:
+                    # Reply with the text now; the audio is fetched from the job
+                    audio_url, audio_playlist, audio_job = await _astart_audio_job(
+                        character, character_response, cache_embedding
+                    )
+                    await asyncio.gather(
+                        asave_turn(conversation, user_message, character_response),
+                        aupdate_summary(conversation, overflow)
+                    )
+                else:
+                    # Save the turn and fold old turns into the summary
+                    # while the TTS audio is generated
+                    _, (audio_url, audio_playlist), _ = await asyncio.gather(
+                        asave_turn(conversation, user_message, character_response),
+                        _aspeak(character_response, character, conversation_id),
+                        aupdate_summary(conversation, overflow)
+                    )
+                    remember_response(character, cache_embedding, character_response, audio_url, audio_playlist)
+            
+            avatar_url = character.avatar.url if character.avatar else None
+
+            response = JsonResponse({
+                'user_message': user_message,
+                'character_response': character_response,
+                'audio_url': audio_url,
+                'audio_playlist': audio_playlist,
+                'audio_job': audio_job,
+                'avatar_url': avatar_url
+            })
+        response['Server-Timing'] = turn.server_timing()
+        return response
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
+async def stream_message(request, conversation_id):
+    """
+    Handle sending a message and stream the response as Server-Sent Events.
+
+    Emits a ``token`` event for each piece of the reply as Gemini generates
+    it, then saves the full reply and emits a final ``done`` event carrying
+    the ``audio_url`` once TTS has finished. With TTS_BACKGROUND_JOBS (and
+    whole-reply audio), ``done`` is sent as soon as the reply is saved and
+    the audio follows in an ``audio`` event from a shared background job,
+    then an ``audio_status`` event with the job's status ('pending' if it
+    outlasted AUDIO_JOB_MAX_WAIT, so the client polls for it).
+    The turn is traced like send_message; as the headers are sent before
+    the reply exists, ``done`` carries the Server-Timing value instead.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    
+    # The trace stays open until the stream ends; it is finished by the generator
+    turn = Trace('stream_message')
+    try:
+        with within(turn):
+            conversation = await aget_conversation(conversation_id)
+            user_message = request.POST.get('message', '').strip()
+            
+            if not user_message:
+                finish(turn)
+                return JsonResponse({'error': 'Message cannot be empty'}, status=400)
+            
+            character = conversation.character
+            turn.set_character(character)
+            
+            (query_embedding, cached), (history, overflow) = await asyncio.gather(
+                alookup_response(character, user_message),
+                abuild_history(conversation)
+            )
+            cached, cache_embedding = _without_history(history, cached, query_embedding)
+    except BaseException:
+        finish(turn)
+        raise
+    
+    async def event_stream():
+        with within(turn):
+            try:
+                # Fold old turns into the summary while the reply is generated
+                summarize = asyncio.ensure_future(aupdate_summary(conversation, overflow))
+                
+                if cached:
+                    character_response = cached.response
+                    yield _sse_event('token', {'text': character_response})
+                else:
+                    parts = []
+                    async for token in astream_character(
+                        character, user_message,
+                        conversation_history=history,
+                        query_embedding=query_embedding
+                    ):
+                        parts.append(token)
+                        yield _sse_event('token', {'text': token})
+                    character_response = ''.join(parts)
+                
+                # Persist the turn only once the stream has completed
+                save = asyncio.ensure_future(asave_turn(conversation, user_message, character_response))
+                
+                audio_job = None
+                if cached and cached.audio_playlist:
+                    audio_url, audio_playlist = cached.audio_url, cached.audio_playlist
+                elif settings.TTS_BACKGROUND_JOBS and not settings.TTS_SENTENCE_CHUNKING:
+                    audio_url, audio_playlist, audio_job = await _astart_audio_job(
+                        character, character_response, None if cached else cache_embedding
+                    )
+                elif settings.TTS_SENTENCE_CHUNKING:
+                    # Send each sentence's audio as soon as it is ready
+                    audio_url = None
+                    audio_playlist = []
+                    async for segment_url in aiter_speech_segments(character_response, character, conversation_id):
+                        if segment_url:
+                            audio_playlist.append(segment_url)
+                            yield _sse_event('audio', {'audio_url': segment_url})
+                else:
+                    audio_url = await agenerate_speech_audio(character_response, character, conversation_id)
+                    audio_playlist = [audio_url] if audio_url else []
+                
+                await asyncio.gather(save, summarize)
+                
+                if not cached and audio_job is None:
+                    remember_response(character, cache_embedding, character_response, audio_url, audio_playlist)
+                
+                yield _sse_event('done', {
+                    'character_response': character_response,
+                    'audio_url': audio_url,
+                    'audio_playlist': audio_playlist,
+                    'audio_job': audio_job,
+                    'avatar_url': character.avatar.url if character.avatar else None,
+                    # Headers are long gone, so the stage timings travel with the last reply event
+                    'server_timing': turn.server_timing()
+                })
+                
+                if audio_job:
+                    # Wait a while for the job's audio, then say how it stands; the
+                    # browser long-polls /audio-job/<id>/ if it is still pending
+                    job = audio_jobs.get(audio_job)
+                    if job is None:
+                        status = 'error'  # Expired already
+                    else:
+                        await audio_jobs.await_job(job, settings.AUDIO_JOB_MAX_WAIT)
+                        for segment_url in job.result()[1]:
+                            yield _sse_event('audio', {'audio_url': segment_url})
+                        status = job.status
+                    yield _sse_event('audio_status', {'audio_job': audio_job, 'status': status})
+            finally:
+                finish(turn)
+    
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+async def audio_job_status(request, job_id):
+    """
+    Status of a background TTS job as JSON.
+
+    ``?wait=N`` long-polls: the response is held until the job finishes or
+    N seconds pass (at most AUDIO_JOB_MAX_WAIT).
+    """
+    job = audio_jobs.get(job_id)
+    if job is None:
+        raise Http404("No audio job matches the given query.")
+    try:
+        wait = min(float(request.GET.get('wait', 0)), settings.AUDIO_JOB_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    await audio_jobs.await_job(job, wait)
+    return JsonResponse(job.as_dict())
+
+def audio(request, filename):
+    """Serve a cached TTS clip with ETag, Range and long-lived caching"""
+    path = audio_cache.path(filename)
+    if path is None:
+        raise Http404("No audio matches the given query.")
+    audio_cache.get(filename)  # Count the play for LRU eviction
+    return audio_response(request, path)
+
 def delete_conversation(request, conversation_id):
     """Delete a conversation and start fresh"""
     if request.method == 'POST':
         try:
             conversation = get_object_or_404(Conversation, id=conversation_id)
-            character_id = conversation.character.id
+            character_id = conversation.character_id
             
             # Delete the conversation (messages are deleted automatically via CASCADE)
             conversation.delete()
@@ -195,4 +382,26 @@ def delete_conversation(request, conversation_id):
                 'error': str(e)
             }, status=400)
     
-    return JsonResponse({'error': 'Invalid request'}, status=400)
\ No newline at end of file
+    return JsonResponse({'error': 'Invalid request'}, status=400)
+
+
+def metrics(request):
+    """Stage latency histograms in Prometheus format (when METRICS_ENABLED)"""
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metrics are disabled.")
+    return HttpResponse(histograms.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def runtime_stats(request):
+    """Per-process client reuse and cache counters (staff only)"""
+    unified = get_unified_index()
+    return JsonResponse({
+        'clients': client_stats(),
+        'vector_store_cache': vector_store_cache.stats(),
+        'embedding_cache': embedding_cache_stats(),
+        'response_cache': response_cache.stats(),
+        'tts_cache': audio_cache.stats(),
+        'message_buffer': message_buffer.stats(),
+        'unified_index': unified.stats() if unified else None,
+    })
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'literarychat.settings')
 
 application = get_asgi_application()
+
+# Optionally load every processed book's vector store before serving
+from books.vector_store_cache import warm_up_on_startup  # noqa: E402
+
+warm_up_on_startup()
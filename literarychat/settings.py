@@ -17,6 +17,10 @@ load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 
+def env_bool(name, default=False):
+    return os.getenv(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -78,13 +82,55 @@ WSGI_APPLICATION = 'literarychat.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+# DATABASE_ENGINE=sqlite (default, single node) or postgresql (several app servers or heavy write traffic)
+DATABASE_ENGINE = os.getenv('DATABASE_ENGINE', 'sqlite')
+
+# SQLite: WAL lets chat reads proceed during writes; IMMEDIATE transactions take the write
+# lock up front, so concurrent writers wait up to the busy timeout instead of failing
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # NORMAL is durable across app crashes in WAL mode
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))  # Milliseconds to wait for the write lock
+SQLITE_OPTIONS = {
+    'transaction_mode': 'IMMEDIATE',
+    'init_command': (
+        f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE};"
+        f"PRAGMA synchronous={SQLITE_SYNCHRONOUS};"
+        f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}"
+    ),
 }
 
+if DATABASE_ENGINE == 'postgresql':
+    # Pooling (needs `pip install "psycopg[pool]"`) can't be combined with persistent
+    # connections, so CONN_MAX_AGE only applies when DATABASE_POOL is off
+    DATABASE_POOL = env_bool('DATABASE_POOL')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'literarychat'),
+            'USER': os.getenv('POSTGRES_USER', 'literarychat'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if DATABASE_POOL else int(os.getenv('DATABASE_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DATABASE_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('DATABASE_POOL_MAX_SIZE', 10)),
+                    'timeout': float(os.getenv('DATABASE_POOL_TIMEOUT', 10)),
+                },
+            } if DATABASE_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': SQLITE_OPTIONS,
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -130,3 +176,97 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Media files (for book uploads)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+
+# Vector store cache (loaded FAISS stores kept in memory per process)
+VECTOR_STORE_CACHE_MAX_BYTES = int(os.getenv('VECTOR_STORE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+VECTOR_STORE_CACHE_WARMUP = env_bool('VECTOR_STORE_CACHE_WARMUP')
+
+# Vector store format written by book processing: 'faiss' (flat float32 index + pickled
+# docstore) or 'compact' (quantized index + text docstore, memory-mapped and shared by workers)
+VECTOR_STORE_FORMAT = os.getenv('VECTOR_STORE_FORMAT', 'faiss')
+COMPACT_INDEX_FACTORY = os.getenv('COMPACT_INDEX_FACTORY', '')  # FAISS factory string; '' picks SQ8/IVF,SQ8 by size
+COMPACT_IVF_MIN_VECTORS = int(os.getenv('COMPACT_IVF_MIN_VECTORS', 20000))
+COMPACT_IVF_NPROBE = int(os.getenv('COMPACT_IVF_NPROBE', 16))
+
+# One shared index for all books: a docstore plus one memory-mapped segment per book
+UNIFIED_INDEX_ENABLED = env_bool('UNIFIED_INDEX_ENABLED')
+UNIFIED_INDEX_DIR = os.getenv('UNIFIED_INDEX_DIR', BASE_DIR / 'vector_stores' / 'unified')
+UNIFIED_INDEX_OPEN_SEGMENTS = int(os.getenv('UNIFIED_INDEX_OPEN_SEGMENTS', 64))  # Book segments kept mapped per process
+
+# Text-to-speech
+TTS_SENTENCE_CHUNKING = env_bool('TTS_SENTENCE_CHUNKING')  # Synthesize replies sentence by sentence
+TTS_MAX_WORKERS = int(os.getenv('TTS_MAX_WORKERS', 4))  # Concurrent TTS requests per process
+TTS_AUDIO_ENCODING = os.getenv('TTS_AUDIO_ENCODING', 'MP3')  # 'MP3' or 'OGG_OPUS' (smaller; no Safari before 17)
+# Clips are served by /audio/<file> with ETag and Range support; the path prefix of an
+# nginx `internal` location aliased to media/tts_cache lets nginx send them instead
+AUDIO_CACHE_MAX_AGE = int(os.getenv('AUDIO_CACHE_MAX_AGE', 365 * 24 * 60 * 60))  # Browser cache, seconds
+AUDIO_X_ACCEL_REDIRECT = os.getenv('AUDIO_X_ACCEL_REDIRECT', '')  # e.g. '/internal/tts_cache/'
+TTS_BACKGROUND_JOBS = env_bool('TTS_BACKGROUND_JOBS', True)  # Reply with text first, audio via /audio-job/<id>/
+AUDIO_JOB_TTL = int(os.getenv('AUDIO_JOB_TTL', 10 * 60))  # Seconds a finished job can still be polled
+AUDIO_JOB_MAX_WAIT = float(os.getenv('AUDIO_JOB_MAX_WAIT', 25))  # Longest long-poll, in seconds
+# Audio cache index (size and last access per file); `prune_tts_cache` evicts against these limits
+TTS_CACHE_INDEX_PATH = os.getenv('TTS_CACHE_INDEX_PATH', BASE_DIR / 'tts_cache.sqlite3')
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+TTS_CACHE_MAX_AGE_DAYS = float(os.getenv('TTS_CACHE_MAX_AGE_DAYS', 90))  # 0 keeps clips however old
+# `prewarm_tts`: the fallback reply and each character's most repeated replies are synthesized ahead of time
+TTS_PREWARM_TOP_RESPONSES = int(os.getenv('TTS_PREWARM_TOP_RESPONSES', 20))  # Most repeated replies per character
+TTS_PREWARM_CONCURRENCY = int(os.getenv('TTS_PREWARM_CONCURRENCY', 2))
+
+# Embedding cache (SQLite file shared by ingestion and queries)
+EMBEDDING_CACHE_ENABLED = env_bool('EMBEDDING_CACHE_ENABLED', True)
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', BASE_DIR / 'embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Semantic response cache (reuse replies to near-identical questions per character)
+RESPONSE_CACHE_ENABLED = env_bool('RESPONSE_CACHE_ENABLED')
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', 0.95))  # Cosine similarity
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 24 * 60 * 60))  # Seconds
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 500))  # Per character
+
+# Book ingestion (see `python manage.py run_ingest_worker`)
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 100))  # Chunks embedded per batch
+INGEST_MAX_WORKERS = int(os.getenv('INGEST_MAX_WORKERS', 4))  # Batches embedded concurrently
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv('EMBEDDING_REQUESTS_PER_MINUTE', 100))
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 5))
+EMBEDDING_RETRY_BASE_DELAY = float(os.getenv('EMBEDDING_RETRY_BASE_DELAY', 2.0))  # Seconds, doubled per retry
+INGEST_MAX_ATTEMPTS = int(os.getenv('INGEST_MAX_ATTEMPTS', 3))
+INGEST_RETRY_DELAY = int(os.getenv('INGEST_RETRY_DELAY', 30))  # Seconds, doubled after each failure
+INGEST_STALE_AFTER = int(os.getenv('INGEST_STALE_AFTER', 3600))  # Requeue running jobs idle this long
+
+# Request tracing: per-stage timings are logged by `books.tracing` and sent in a
+# Server-Timing header; METRICS_ENABLED also serves Prometheus histograms at /metrics
+METRICS_ENABLED = env_bool('METRICS_ENABLED')
+TRACE_LOG_LEVEL = os.getenv('TRACE_LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'books.tracing': {'handlers': ['console'], 'level': TRACE_LOG_LEVEL, 'propagate': False},
+    },
+}
+
+# Chat turns are saved with one INSERT for both messages; MESSAGE_WRITE_BEHIND queues them
+# in memory and inserts them in batches from a background thread instead
+MESSAGE_WRITE_BEHIND = env_bool('MESSAGE_WRITE_BEHIND')
+MESSAGE_FLUSH_INTERVAL = float(os.getenv('MESSAGE_FLUSH_INTERVAL', 1.0))  # Seconds between flushes
+MESSAGE_FLUSH_BATCH = int(os.getenv('MESSAGE_FLUSH_BATCH', 500))  # Flush early once this many are queued
+CHAT_PAGE_SIZE = int(os.getenv('CHAT_PAGE_SIZE', 50))  # Messages rendered per chat page / older page
+
+# Conversation history in prompts: recent turns up to a token budget, older ones
+# folded into a rolling per-conversation summary
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 1000))  # 0 disables history
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', 30))  # Newest messages loaded per turn
+HISTORY_SUMMARY_ENABLED = env_bool('HISTORY_SUMMARY_ENABLED', True)
+HISTORY_SUMMARY_BATCH = int(os.getenv('HISTORY_SUMMARY_BATCH', 6))  # Overflowing messages before summarizing
+HISTORY_SUMMARY_WORDS = int(os.getenv('HISTORY_SUMMARY_WORDS', 150))
+
+# Retrieval: BM25 keyword search fused with vector search (reciprocal rank fusion),
+# optionally reranked by a local cross-encoder (requires sentence-transformers)
+HYBRID_RETRIEVAL_ENABLED = env_bool('HYBRID_RETRIEVAL_ENABLED', True)
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 10))  # Passages taken from each search before fusion
+RERANKER_MODEL = os.getenv('RERANKER_MODEL', '')  # e.g. 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+CHARACTER_SCOPE = os.getenv('CHARACTER_SCOPE', 'boost')  # 'boost', 'restrict' or 'off': passages mentioning the character